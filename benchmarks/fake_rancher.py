@@ -0,0 +1,377 @@
+"""
+In-process stand-in for the parts of the Rancher v1 API used by rancher-gen.
+
+It serves a synthetic environment of stacks, services and containers over
+HTTP, and pushes container events to the clients of the subscribe websocket.
+Only the standard library is used, including for the websocket handshake and
+framing.
+"""
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import json
+import logging
+import re
+import struct
+from collections import Counter
+from threading import Lock, Thread
+
+from rancher_gen.compat import (BaseHTTPRequestHandler, HTTPServer,
+                                ThreadingMixIn, monotonic, urlparse)
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Labels of the synthetic events, used to measure their latency
+SEQUENCE_LABEL = 'bench.seq'
+SENT_LABEL = 'bench.sent'
+
+PROJECT_RE = re.compile(r'^/v1/projects/(?P<project>[^/]+)/(?P<path>.*)$')
+
+
+class Environment(object):
+    """ A synthetic Rancher environment.
+
+    Args:
+        - containers: The number of containers.
+        - services_per_stack: The number of services in each stack.
+        - containers_per_service: The number of containers of each service.
+        - containers_per_host: The number of containers on each host.
+    """
+
+    def __init__(self, containers, services_per_stack=10,
+                 containers_per_service=10, containers_per_host=50,
+                 project_id='1a5'):
+        self.project_id = project_id
+        self.stacks = []
+        self.services = []
+        self.containers = []
+
+        for i in range(containers):
+            service_index = i // containers_per_service
+            stack_index = service_index // services_per_stack
+            if stack_index == len(self.stacks):
+                self.stacks.append(self._stack(stack_index))
+            if service_index == len(self.services):
+                self.services.append(self._service(
+                    service_index, self.stacks[stack_index]))
+            self.containers.append(self._container(
+                i, self.services[service_index], self.stacks[stack_index],
+                i // containers_per_host))
+
+        self._service_containers = {}
+        for i, container in enumerate(self.containers):
+            self._service_containers.setdefault(
+                container['services'][0]['id'], []).append(i)
+
+    def service_instances(self, service_id):
+        return [self.containers[i]
+                for i in self._service_containers.get(service_id, [])]
+
+    def stack_services(self, stack_id):
+        return [s for s in self.services if s['environmentId'] == stack_id]
+
+    def event(self, sequence, container_index):
+        """ Returns a resource.change event updating the IP address of a
+        container. """
+        container_index %= len(self.containers)
+        container = dict(self.containers[container_index])
+        container['labels'] = dict(container['labels'])
+        container['labels'][SEQUENCE_LABEL] = str(sequence)
+        container['labels'][SENT_LABEL] = repr(monotonic())
+        container['primaryIpAddress'] = _ip(len(self.containers) + sequence)
+        self.containers[container_index] = container
+        return {
+            'id': 'event-{0}'.format(sequence),
+            'name': 'resource.change',
+            'resourceType': 'container',
+            'resourceId': container['id'],
+            'data': {'resource': container},
+        }
+
+    def _link(self, path):
+        return 'http://{{host}}/v1/projects/{0}/{1}'.format(self.project_id,
+                                                             path)
+
+    def _stack(self, index):
+        stack_id = '1e{0}'.format(index + 1)
+        return {
+            'id': stack_id,
+            'type': 'environment',
+            'name': 'stack{0}'.format(index),
+            'state': 'active',
+            'links': {
+                'self': self._link('environments/' + stack_id),
+                'services': self._link(
+                    'environments/{0}/services'.format(stack_id)),
+            },
+        }
+
+    def _service(self, index, stack):
+        service_id = '1s{0}'.format(index + 1)
+        return {
+            'id': service_id,
+            'type': 'service',
+            'name': 'service{0}'.format(index),
+            'state': 'active',
+            'environmentId': stack['id'],
+            'links': {
+                'self': self._link('services/' + service_id),
+                'instances': self._link(
+                    'services/{0}/instances'.format(service_id)),
+            },
+        }
+
+    def _container(self, index, service, stack, host):
+        container_id = '1i{0}'.format(index + 1)
+        name = '{0}_{1}_{2}'.format(stack['name'], service['name'], index)
+        links = dict((link, self._link('containers/{0}/{1}'.format(
+            container_id, link.lower())))
+            for link in ('account', 'hosts', 'instanceLabels', 'mounts',
+                         'ports', 'services', 'stats', 'volumes'))
+        return {
+            'id': container_id,
+            'type': 'container',
+            'kind': 'container',
+            'name': name,
+            'state': 'running',
+            'healthState': 'healthy',
+            'accountId': self.project_id,
+            'hostId': '1h{0}'.format(host + 1),
+            'imageUuid': 'docker:nginx:latest',
+            'primaryIpAddress': _ip(index),
+            'created': '2016-09-08T00:00:38Z',
+            'createdTS': 1473292838000,
+            'networkMode': 'managed',
+            'dns': ['169.254.169.250'],
+            'uuid': hashlib.md5(name.encode('utf-8')).hexdigest(),
+            'labels': {
+                'io.rancher.stack.name': stack['name'],
+                'io.rancher.stack_service.name': '{0}/{1}'.format(
+                    stack['name'], service['name']),
+                'io.rancher.project.name': stack['name'],
+                'io.rancher.project_service.name': '{0}/{1}'.format(
+                    stack['name'], service['name']),
+                'io.rancher.container.name': name,
+                'io.rancher.container.ip': _ip(index) + '/16',
+            },
+            'links': links,
+            'services': [{'id': service['id'], 'type': 'service',
+                          'name': service['name']}],
+        }
+
+
+class FakeRancher(ThreadingMixIn, HTTPServer):
+    """ Serves an Environment on a local port, in a background thread.
+
+    The number of requests made to each endpoint is kept in `requests`.
+
+    Args:
+        - environment: The Environment to serve.
+        - port: The port to listen on, 0 to pick a free one.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, environment, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.environment = environment
+        self.requests = Counter()
+        self._subscribers = []
+        self._lock = Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def broadcast(self, message):
+        """ Sends a text message to every websocket client. """
+        frame = _frame(json.dumps(message).encode('utf-8'))
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for lock, wfile in subscribers:
+            with lock:
+                try:
+                    wfile.write(frame)
+                except (IOError, OSError):
+                    pass
+
+    def subscribe(self, wfile):
+        subscriber = (Lock(), wfile)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((key, values[0])
+                      for key, values in parse_qs(url.query).items())
+        match = PROJECT_RE.match(url.path)
+        environment = self.server.environment
+        if match is None or \
+                match.group('project') != environment.project_id:
+            return self._send_json(404, {'type': 'error'})
+
+        path = match.group('path').strip('/').split('/')
+        if path == ['subscribe']:
+            self.server.count('subscribe')
+            return self._subscribe()
+
+        if path == ['instances']:
+            items = environment.containers
+        elif path == ['environments']:
+            items = environment.stacks
+            if 'name' in params:
+                items = [s for s in items if s['name'] == params['name']]
+        elif len(path) == 3 and path[::2] == ['environments', 'services']:
+            items = environment.stack_services(path[1])
+        elif len(path) == 3 and path[::2] == ['services', 'instances']:
+            items = environment.service_instances(path[1])
+        else:
+            return self._send_json(404, {'type': 'error'})
+
+        self.server.count('/'.join(
+            '{id}' if i % 2 else part for i, part in enumerate(path)))
+        self._send_collection(url.path, params, items)
+
+    def _send_collection(self, path, params, items):
+        limit = int(params.get('limit', 100))
+        offset = int(params.get('marker', 'm0')[1:])
+        page = items[offset:offset + limit]
+
+        next_url = None
+        if offset + limit < len(items):
+            query = dict(params, limit=limit, marker='m{0}'.format(
+                offset + limit))
+            next_url = 'http://{0}{1}?{2}'.format(
+                self.headers['Host'], path,
+                '&'.join('{0}={1}'.format(k, v) for k, v in query.items()))
+
+        body = json.dumps({
+            'type': 'collection',
+            'data': page,
+            'pagination': {'limit': limit, 'next': next_url},
+        }).replace('{host}', self.headers['Host'])
+
+        # Pages are only sent again when they changed
+        etag = '"{0}"'.format(hashlib.sha1(body.encode('utf-8')).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count('not_modified')
+            return self._send_json(304, '', etag)
+        self._send_json(200, body, etag)
+
+    def _send_json(self, status, data, etag=None):
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        content = data.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _subscribe(self):
+        key = self.headers['Sec-WebSocket-Key']
+        accept = base64.b64encode(hashlib.sha1(
+            (key + WEBSOCKET_GUID).encode('ascii')).digest())
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode('ascii'))
+        self.end_headers()
+        self.wfile.flush()
+
+        subscriber = self.server.subscribe(self.wfile)
+        try:
+            # Read the frames sent by the client until it closes the
+            # connection
+            while True:
+                opcode, payload = _read_frame(self.rfile)
+                if opcode is None or opcode == 0x8:
+                    with subscriber[0]:
+                        self.wfile.write(_frame(b'', 0x8))
+                    break
+                if opcode == 0x9:
+                    with subscriber[0]:
+                        self.wfile.write(_frame(payload, 0xA))
+        except (IOError, OSError):
+            pass
+        finally:
+            self.server.unsubscribe(subscriber)
+            self.close_connection = True
+
+
+def _frame(payload, opcode=0x1):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def _read_frame(rfile):
+    header = rfile.read(2)
+    if len(header) < 2:
+        return None, None
+    first, second = struct.unpack('!BB', header)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', rfile.read(8))[0]
+    mask = rfile.read(4) if second & 0x80 else None
+    payload = bytearray(rfile.read(length))
+    if mask:
+        mask = bytearray(mask)
+        for i in range(len(payload)):
+            payload[i] ^= mask[i % 4]
+    return first & 0x0F, bytes(payload)
+
+
+def _ip(index):
+    return '10.42.{0}.{1}'.format((index // 250) % 250, index % 250 + 1)
@@ -0,0 +1,285 @@
+"""
+Benchmarks rancher-gen against a local fake Rancher server.
+
+For each environment size, a fresh process serves a synthetic environment,
+runs a RancherConnector against it, sends container events at the requested
+rate and measures:
+    - how long the first render takes,
+    - how many events per second are turned into files,
+    - the p50 and p99 latency from sending an event to writing the file,
+    - how many API calls are made, at startup and per event,
+    - the peak RSS of the process, which includes the fake server.
+
+The results are printed (or written to --output) as JSON, so they can be
+compared across runs.
+
+Usage:
+    python benchmarks/run.py --sizes 100,1000,10000 --events 1000
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from threading import Condition, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fake_rancher import (Environment, FakeRancher, SENT_LABEL,  # noqa
+                          SEQUENCE_LABEL)
+from rancher_gen import __version__  # noqa
+from rancher_gen.compat import monotonic  # noqa
+from rancher_gen.handler import RancherConnector  # noqa
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# An nginx upstream block per service, the kind of template rancher-gen is
+# typically used with
+TEMPLATE = """\
+{% for service, containers in by_service | dictsort %}
+upstream {{ service | replace('/', '_') }} {
+{%- for container in containers %}
+  server {{ container.primaryIpAddress }}:80;
+{%- endfor %}
+}
+{% endfor %}
+"""
+
+
+class BenchmarkConnector(RancherConnector):
+    """ Records when the events sent by the fake server have been rendered.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BenchmarkConnector, self).__init__(*args, **kwargs)
+        self.latencies = []
+        self.rendered = 0
+        self.last_rendered = None
+        self._condition = Condition()
+
+    def _on_events(self, events):
+        sent = []
+        for event in events:
+            if isinstance(event, dict) and event.get('data'):
+                labels = event['data']['resource'].get('labels') or {}
+                if SEQUENCE_LABEL in labels:
+                    sent.append(float(labels[SENT_LABEL]))
+
+        super(BenchmarkConnector, self)._on_events(events)
+
+        now = monotonic()
+        with self._condition:
+            self.latencies.extend(now - timestamp for timestamp in sent)
+            self.rendered += len(sent)
+            self.last_rendered = now
+            self._condition.notify_all()
+
+    def wait_rendered(self, count, timeout):
+        deadline = monotonic() + timeout
+        with self._condition:
+            while self.rendered < count:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+def run_scenario(options, containers):
+    """ Runs a benchmark with an environment of `containers` containers.
+
+    Returns a dict with the results.
+    """
+    environment = Environment(containers)
+    server = FakeRancher(environment)
+    server.start()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmp_dir, 'upstreams.j2')
+        with open(source, 'w') as fh:
+            fh.write(TEMPLATE)
+        template = '{0}:{1}'.format(source, os.path.join(tmp_dir,
+                                                         'upstreams.conf'))
+
+        baseline_rss = _peak_rss()
+        connector = BenchmarkConnector(
+            '127.0.0.1', server.port, environment.project_id, 'access',
+            'secret', [template], debounce=options.debounce,
+            max_wait=options.max_wait, resync_interval=0,
+            page_size=options.page_size, stack=options.stack)
+
+        start = monotonic()
+        connector._prerender()
+        startup = monotonic() - start
+        startup_calls = sum(server.requests.values())
+
+        thread = Thread(target=connector.start)
+        thread.daemon = True
+        thread.start()
+        deadline = monotonic() + options.timeout
+        while not server.subscribers and monotonic() < deadline:
+            time.sleep(0.01)
+
+        server.requests.clear()
+        first_sent = monotonic()
+        send_events(server, environment, options)
+        complete = connector.wait_rendered(options.events, options.timeout)
+
+        # The websocket thread may take a while to notice it was closed, and
+        # the results don't depend on it.
+        connector.stop()
+        thread.join(1)
+
+        elapsed = (connector.last_rendered or monotonic()) - first_sent
+        latencies = sorted(connector.latencies)
+        return {
+            'containers': containers,
+            'events': options.events,
+            'rate': options.rate,
+            'debounce': options.debounce,
+            'complete': complete,
+            'rendered_events': connector.rendered,
+            'startup_seconds': startup,
+            'throughput_events_per_second':
+                connector.rendered / elapsed if elapsed > 0 else None,
+            'latency_p50_seconds': _percentile(latencies, 50),
+            'latency_p99_seconds': _percentile(latencies, 99),
+            'api_calls_startup': startup_calls,
+            'api_calls_per_event':
+                sum(server.requests.values()) / float(options.events),
+            'baseline_rss_kb': baseline_rss,
+            'peak_rss_kb': _peak_rss(),
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+
+def send_events(server, environment, options):
+    rng = random.Random(options.seed)
+    interval = 1.0 / options.rate if options.rate else 0
+
+    # Only update containers that are watched, so every event is rendered
+    indexes = [i for i, container in enumerate(environment.containers)
+               if options.stack is None or
+               container['labels']['io.rancher.stack.name'] == options.stack]
+    if not indexes:
+        raise ValueError("No containers in stack '{0}'"
+                         .format(options.stack))
+
+    start = monotonic()
+    for sequence in range(options.events):
+        if interval:
+            delay = start + sequence * interval - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        index = rng.choice(indexes)
+        server.broadcast(environment.event(sequence, index))
+
+
+def _run_in_process(options, containers, queue):
+    try:
+        queue.put(run_scenario(options, containers))
+    except Exception as e:
+        logger.exception(e)
+        queue.put({'containers': containers, 'error': str(e)})
+
+
+def _percentile(values, percent):
+    """ Returns the nearest-rank percentile of a sorted list. """
+    if not values:
+        return None
+    rank = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks rancher-gen against a "
+                            "local fake Rancher server")
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        type=lambda value: [int(v) for v in value.split(',')],
+                        help="Comma separated numbers of containers to "
+                        "benchmark with (defaults to 100,1000,10000)")
+    parser.add_argument('--events', type=int, default=1000,
+                        help="Number of events to send (defaults to 1000)")
+    parser.add_argument('--rate', type=float, default=200,
+                        help="Events sent per second, 0 to send them as "
+                        "fast as possible (defaults to 200)")
+    parser.add_argument('--debounce', type=float, default=0.05,
+                        help="The --debounce option of rancher-gen "
+                        "(defaults to 0.05)")
+    parser.add_argument('--max-wait', type=float, default=0.5,
+                        help="The --max-wait option of rancher-gen "
+                        "(defaults to 0.5)")
+    parser.add_argument('--page-size', type=int, default=100,
+                        help="The --page-size option of rancher-gen "
+                        "(defaults to 100)")
+    parser.add_argument('--stack',
+                        help="Only watch this stack (e.g stack0)")
+    parser.add_argument('--timeout', type=float, default=300,
+                        help="Seconds to wait for the events to be rendered "
+                        "(defaults to 300)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the events sent (defaults to 0)")
+    parser.add_argument('--output', help="File to write the results to "
+                        "(defaults to stdout)")
+    options = parser.parse_args()
+
+    logging.getLogger('rancher_gen').setLevel(logging.WARNING)
+    logging.getLogger('websocket').setLevel(logging.WARNING)
+
+    # Each size runs in its own process, so the peak RSS of one doesn't
+    # hide the others
+    results = []
+    for containers in options.sizes:
+        queue = Queue()
+        process = Process(target=_run_in_process,
+                          args=(options, containers, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+        print('{0} containers: {1}'.format(
+            containers, json.dumps(results[-1], sort_keys=True)),
+            file=sys.stderr)
+
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fh:
+            fh.write(content + '\n')
+    else:
+        print(content)
+
+
+if __name__ == '__main__':
+    main()
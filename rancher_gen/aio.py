@@ -0,0 +1,608 @@
+"""
+An engine running the connector on an asyncio event loop, instead of
+websocket-client and threads.
+
+The websocket is read with asyncio streams and notify commands run as asyncio
+subprocesses. The API client and the renderer are blocking, so they run on
+small executors whose sizes bound how much work is in flight at once.
+
+Requires Python 3.5 or later.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import base64
+import functools
+import hashlib
+import logging
+import os
+import ssl as _ssl
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from .compat import monotonic
+from .handler import RESYNC, RancherConnector
+from .metrics import NOTIFY_DURATION, RECONNECTS
+from .replay import Recorder
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Websocket opcodes
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# Largest message accepted, so a corrupt frame length can't make the client
+# allocate unbounded memory. Rancher's messages are a few kilobytes.
+MAX_MESSAGE_SIZE = 2 ** 24
+
+# Seconds without receiving anything before the server is pinged, and to wait
+# for an answer before dropping the connection
+PING_INTERVAL = 30
+PING_TIMEOUT = 10
+
+
+class WebSocketError(Exception):
+    pass
+
+
+class WebSocket(object):
+    """ The client side of the websocket protocol over asyncio streams, enough
+    to read the messages rancher sends.
+
+    Use `WebSocket.connect` to open a connection. It must be created on the
+    thread running the event loop.
+
+    Args:
+        - reader: The StreamReader of the connection.
+        - writer: The StreamWriter of the connection.
+        - max_size: The largest message accepted, in bytes. Bigger messages
+            fail the connection.
+        - ping_interval: Seconds without receiving anything before pinging
+            the server, or None to never ping it.
+        - ping_timeout: Seconds to wait for the server to answer a ping
+            before dropping the connection, e.g when a proxy silently dropped
+            it.
+    """
+
+    def __init__(self, reader, writer, max_size=MAX_MESSAGE_SIZE,
+                 ping_interval=None, ping_timeout=PING_TIMEOUT):
+        self._reader = reader
+        self._writer = writer
+        self.max_size = max_size
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.closed = False
+        self._received = monotonic()
+        self._error = None
+        self._keepalive = None
+        if ping_interval:
+            self._keepalive = asyncio.ensure_future(self._ping())
+
+    @classmethod
+    async def connect(cls, host, port, path, headers=None, ssl=False,
+                      timeout=None, max_size=MAX_MESSAGE_SIZE,
+                      ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT):
+        """ Opens a websocket connection.
+
+        Args:
+            - host: The host to connect to.
+            - port: The port to connect to.
+            - path: The path and query string of the websocket.
+            - headers: Extra headers of the handshake request.
+            - ssl: Whether to use TLS.
+            - timeout: Seconds to wait for the handshake to complete.
+
+        The other arguments are the same as WebSocket's.
+        """
+        context = _ssl.create_default_context() if ssl else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context), timeout)
+
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        lines = [
+            'GET {0} HTTP/1.1'.format(path),
+            'Host: {0}:{1}'.format(host, port),
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Key: {0}'.format(key),
+            'Sec-WebSocket-Version: 13',
+        ]
+        for name, value in sorted((headers or {}).items()):
+            lines.append('{0}: {1}'.format(name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        try:
+            status, response = await asyncio.wait_for(
+                _read_response(reader), timeout)
+        except Exception:
+            writer.close()
+            raise
+
+        parts = status.split(None, 2)
+        accept = base64.b64encode(hashlib.sha1(
+            (key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        if len(parts) < 2 or parts[1] != '101':
+            writer.close()
+            raise WebSocketError('Websocket handshake failed: {0}'
+                                 .format(status))
+        if response.get('sec-websocket-accept') != accept:
+            writer.close()
+            raise WebSocketError('Invalid Sec-WebSocket-Accept header')
+        return cls(reader, writer, max_size, ping_interval, ping_timeout)
+
+    async def recv(self):
+        """ Returns the next message, or None once the connection is closed.
+        """
+        fragments = []
+        size = 0
+        while True:
+            try:
+                opcode, final, payload = await self._read_frame()
+            except asyncio.IncompleteReadError:
+                self.close()
+                if self._error is not None:
+                    raise WebSocketError(self._error)
+                return None
+
+            if opcode == CLOSE:
+                self._send(CLOSE, payload[:2])
+                self.close()
+                return None
+            if opcode == PING:
+                self._send(PONG, payload)
+                continue
+            if opcode == PONG:
+                continue
+
+            if opcode != CONTINUATION:
+                fragments = []
+                size = 0
+            fragments.append(payload)
+            size += len(payload)
+            if size > self.max_size:
+                raise WebSocketError('Received a message of more than {0} '
+                                     'bytes'.format(self.max_size))
+            if final:
+                try:
+                    return b''.join(fragments).decode('utf-8')
+                except UnicodeDecodeError:
+                    # The connection fails, as with websocket-client
+                    raise WebSocketError('Received a message that is not '
+                                         'valid UTF-8')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+        try:
+            self._send(CLOSE, struct.pack('!H', 1000))
+        except (IOError, OSError, RuntimeError):  # pragma: no cover
+            pass
+        self._writer.close()
+
+    async def _read_frame(self):
+        first, second = struct.unpack(
+            '!BB', (await self._reader.readexactly(2)))
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack(
+                '!H', (await self._reader.readexactly(2)))[0]
+        elif length == 127:
+            length = struct.unpack(
+                '!Q', (await self._reader.readexactly(8)))[0]
+        if length > self.max_size:
+            raise WebSocketError('Received a frame of {0} bytes, more than '
+                                 '{1}'.format(length, self.max_size))
+        mask = None
+        if second & 0x80:
+            mask = await self._reader.readexactly(4)
+        payload = await self._reader.readexactly(length)
+        if mask:
+            payload = _mask(payload, mask)
+        self._received = monotonic()
+        return first & 0x0F, bool(first & 0x80), payload
+
+    async def _ping(self):
+        """ Pings the server when nothing was received for `ping_interval`
+        seconds, and aborts the connection if the server doesn't answer
+        within `ping_timeout` seconds, so `recv` fails instead of waiting
+        forever on a dead connection. """
+        while not self.closed:
+            idle = monotonic() - self._received
+            if idle < self.ping_interval:
+                await asyncio.sleep(self.ping_interval - idle)
+                continue
+
+            sent = monotonic()
+            self._send(PING)
+            await asyncio.sleep(self.ping_timeout)
+            if self._received < sent:
+                self._error = 'No answer to ping within {0} seconds'.format(
+                    self.ping_timeout)
+                self._writer.transport.abort()
+                return
+
+    def _send(self, opcode, payload=b''):
+        if self._writer.transport.is_closing():
+            return
+        # Frames sent by clients must be masked
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        self._writer.write(header + mask + _mask(payload, mask))
+
+
+class AsyncScheduler(object):
+    """ Coalesces bursts of events into a single call to a coroutine, like
+    scheduler.EventScheduler, but on an event loop.
+
+    `schedule` must be called from the thread running the loop.
+
+    Args:
+        - callback: Coroutine function called with the list of coalesced
+            events.
+        - debounce: Seconds of quiet time to wait for before running a cycle.
+        - max_wait: Maximum number of seconds an event can be delayed.
+    """
+
+    def __init__(self, callback, debounce=0.5, max_wait=5.0):
+        self.callback = callback
+        self.debounce = debounce
+        self.max_wait = max(max_wait, debounce)
+        self._events = []
+        self._first = None
+        self._last = None
+        self._stopped = False
+        self._wakeup = None
+
+    def schedule(self, event=None):
+        now = monotonic()
+        if not self._events:
+            self._first = now
+        self._last = now
+        self._events.append(event)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stop(self):
+        """ Stops `run` once the pending events have been processed. """
+        self._stopped = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                events = await self._next_batch()
+                if events is None:
+                    return
+
+                logger.debug('Processing {0} coalesced event(s)'
+                             .format(len(events)))
+                try:
+                    await self.callback(events)
+                except Exception as e:
+                    logger.exception(e)
+        finally:
+            self._wakeup = None
+
+    async def _next_batch(self):
+        while not self._events:
+            if self._stopped:
+                return None
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+        while not self._stopped:
+            deadline = min(self._last + self.debounce,
+                           self._first + self.max_wait)
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        events, self._events = self._events, []
+        return events
+
+
+class AsyncNotifier(object):
+    """ Runs notify commands as subprocesses, at most `concurrency` at a
+    time, never running the same command concurrently.
+
+    Like scheduler.Notifier, identical commands requested together are only
+    run once, and a command requested while it is running gets a single
+    follow-up run.
+    """
+
+    def __init__(self, concurrency=4):
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._running = set()
+        self._pending = set()
+
+    async def notify(self, commands):
+        unique = []
+        for command in commands:
+            if command and command not in unique:
+                unique.append(command)
+
+        if unique:
+            await asyncio.gather(*[self._run(command)
+                                   for command in unique])
+
+    async def _run(self, command):
+        if command in self._running:
+            self._pending.add(command)
+            return
+        self._running.add(command)
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            while True:
+                async with self._semaphore:
+                    logger.info("Running '{0}'".format(command))
+                    with NOTIFY_DURATION.time(command=command):
+                        process = await \
+                            asyncio.create_subprocess_shell(command)
+                        await process.wait()
+
+                if command not in self._pending:
+                    return
+                self._pending.discard(command)
+        finally:
+            self._running.discard(command)
+            self._pending.discard(command)
+
+
+class AsyncRancherConnector(RancherConnector):
+    """ A RancherConnector whose websocket reader, API fetches, renders and
+    notify commands all run as coroutines on one event loop.
+
+    It takes the same arguments as RancherConnector, and:
+        - notify_concurrency: Maximum number of notify commands running at
+            once.
+
+    The API client runs on `pool_size` threads, so at most `pool_size`
+    requests are in flight. Renders run one at a time on their own thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        notify_concurrency = kwargs.pop('notify_concurrency', 4)
+        super(AsyncRancherConnector, self).__init__(*args, **kwargs)
+        self.notifier = AsyncNotifier(notify_concurrency)
+        self.scheduler = AsyncScheduler(self._handle_events,
+                                        self.scheduler.debounce,
+                                        self.scheduler.max_wait)
+        self.resync_interval = self.resync_ticker.interval
+        self._loop = None
+        self._wake = None
+        self._api_executor = None
+        self._render_executor = None
+
+    def __call__(self):
+        self._run_loop(self._main())
+
+    def start(self):
+        self._run_loop(self._watch())
+
+    def replay(self, frames):
+        return self._run_loop(self._replay(frames))
+
+    def stop(self):
+        """ Stops watching for events. Can be called from any thread. """
+        self._stopped.set()
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._interrupt)
+            except RuntimeError:  # pragma: no cover
+                # The loop was closed in the meantime
+                pass
+
+    def _interrupt(self):
+        if self._wake is not None:
+            self._wake.set()
+        if self.ws is not None:
+            self.ws.close()
+
+    def _run_loop(self, coroutine):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._wake = asyncio.Event()
+        self._api_executor = ThreadPoolExecutor(self.pool_size)
+        self._render_executor = ThreadPoolExecutor(1)
+        task = loop.create_task(coroutine)
+        try:
+            try:
+                return loop.run_until_complete(task)
+            except KeyboardInterrupt:
+                # Let the task clean up before leaving
+                self.stop()
+                return loop.run_until_complete(task)
+        finally:
+            self._loop = None
+            self._api_executor.shutdown()
+            self._render_executor.shutdown()
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    async def _call(self, executor, function, *args):
+        return (await self._loop.run_in_executor(
+            executor, functools.partial(function, *args)))
+
+    async def _main(self):
+        await self._prerender_async()
+        await self._watch()
+
+    # The steps of RancherConnector, with the API requests, renders and
+    # notify commands awaited.
+
+    async def _prerender_async(self):
+        if (await self._call(self._render_executor, self._load_snapshot)):
+            await self._render_and_notify_async(self._reset_fingerprints())
+            self.scheduler.schedule(RESYNC)
+            return
+
+        await self._resync_async()
+
+    async def _resync_async(self):
+        if not (await self._call(self._api_executor, self._load_instances)):
+            return
+
+        await self._render_and_notify_async(self._reset_fingerprints())
+        await self._call(self._render_executor, self._save_snapshot)
+
+    async def _render_and_notify_async(self, dests=None, received=None):
+        if self._fields_changed():
+            if not (await self._call(self._api_executor,
+                                     self._reload_fields)):
+                return
+            dests = None
+
+        jobs, commands = self._render_jobs(dests)
+        changed = await self._call(self._render_executor,
+                                   self.renderer.render_jobs, jobs)
+        await self.notifier.notify(
+            self._rendered(changed, commands, received))
+
+    async def _handle_events(self, events):
+        if self._needs_resync(events):
+            await self._resync_async()
+            return
+
+        changed, updated, received = self._apply_events(events)
+        if changed:
+            await self._render_and_notify_async(changed, received)
+        if updated:
+            await self._call(self._render_executor, self._save_snapshot)
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.resync_interval)
+            self.scheduler.schedule(RESYNC)
+
+    async def _wait_stopped(self, timeout):
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _watch(self):
+        if self.record:
+            self.recorder = Recorder(self.record)
+            logger.info("Recording rancher events to '{0}'"
+                        .format(self.record))
+        worker = self._loop.create_task(self.scheduler.run())
+        ticker = None
+        if self.resync_interval:
+            ticker = self._loop.create_task(self._tick())
+        logger.info('Watching for rancher events')
+        try:
+            while not self._stopped.is_set():
+                try:
+                    await self._read_websocket()
+                except (IOError, OSError, asyncio.TimeoutError,
+                        WebSocketError) as e:
+                    logger.error(e)
+                if self._stopped.is_set():
+                    break
+
+                delay = self.backoff.next()
+                RECONNECTS.inc()
+                logger.info('Reconnecting in {0:.1f} seconds'.format(delay))
+                await self._wait_stopped(delay)
+        finally:
+            if ticker is not None:
+                ticker.cancel()
+            self.scheduler.stop()
+            await worker
+            await self._close()
+
+    async def _read_websocket(self):
+        path = '/v1/projects/{0}/subscribe?eventNames=resource.change'\
+            '&include=services'.format(self.project_id)
+        header = {'Authorization': 'Basic {0}'.format(self.api_token)}
+        self.ws = await WebSocket.connect(
+            self.rancher_host, self.rancher_port, path, header, self.ssl,
+            self.api.timeout)
+        self._on_open(self.ws)
+        try:
+            while not self._stopped.is_set():
+                message = await self.ws.recv()
+                if message is None:
+                    break
+                # A message that can't be handled must not stop the engine,
+                # as with websocket-client, which logs callback errors
+                try:
+                    self._on_message(self.ws, message)
+                except Exception as e:
+                    logger.exception(e)
+        finally:
+            self.ws.close()
+            self.ws = None
+            self._on_close(None)
+
+    async def _replay(self, frames):
+        await self._prerender_async()
+        worker = self._loop.create_task(self.scheduler.run())
+        logger.info('Replaying rancher events')
+        count = 0
+        try:
+            for frame in frames:
+                self._on_message(None, frame)
+                count += 1
+                # Give the scheduler a chance to run
+                await asyncio.sleep(0)
+        finally:
+            # Pending events are handled before the scheduler stops
+            self.scheduler.stop()
+            await worker
+            await self._close()
+        return count
+
+    async def _close(self):
+        await self._call(self._render_executor, self.renderer.close)
+        await self._call(self._api_executor, self.api.close)
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+
+async def _read_response(reader):
+    """ Reads the status line and headers of an HTTP response. """
+    status = (await reader.readline()).decode('latin-1').strip()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+def _mask(payload, mask):
+    payload = bytearray(payload)
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return bytes(payload)
@@ -1,10 +1,19 @@
 from __future__ import absolute_import, print_function
 
 import logging
+import os
 import sys
+import time
 from argparse import ArgumentParser, Action
 
+from .config import ConfigWatcher, load_config
+from .exception import ConfigError
 from .handler import RancherConnector
+from .metrics import EVENTS_COALESCED, CounterMap, start_http_server
+from .multi import MultiConnector, Project
+from .poll import PollingConnector
+from .replay import StubAPI, paced, read_log
+from .store import read_snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +25,13 @@ LOG_LEVELS = {
     'CRITICAL': logging.CRITICAL
 }
 
+# The engines the connector can run on
+ENGINES = ('threads', 'asyncio')
+
+# How the connector learns about changes: from the websocket events, or by
+# polling the API
+MODES = ('websocket', 'poll')
+
 
 class SetLogLevel(Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -47,10 +63,102 @@ def validate_args(args):
         print ("error: Missing at least one template and destination parameter")
         return False
 
+    if len(args.project_id) > 1:
+        if args.selectors:
+            print ("error: --selector can't be used with several projects")
+            return False
+        if args.engine != 'threads':
+            print ("error: Several projects can only be watched with the "
+                   "threads engine")
+            return False
+        if args.mode != 'websocket':
+            print ("error: Several projects can only be watched with "
+                   "websockets")
+            return False
+
+    if args.mode == 'poll' and args.engine != 'threads':
+        print ("error: Polling is only supported by the threads engine")
+        return False
+
     return True
 
 
+def connector_class(engine, mode='websocket'):
+    """ Returns the RancherConnector class running the given engine and
+    mode. """
+    if mode == 'poll':
+        return PollingConnector
+    if engine == 'asyncio':
+        if sys.version_info < (3, 5):
+            raise ValueError("The asyncio engine requires Python 3.5 or "
+                             "later")
+        from .aio import AsyncRancherConnector
+        return AsyncRancherConnector
+    return RancherConnector
+
+
+def multi_connector(args, port, templates):
+    """ Returns a MultiConnector watching every --project-id, with the same
+    filters. Each project gets its own snapshot and record files, named
+    after the project id. """
+    projects = [Project(project_id, stack=args.stack, services=args.services,
+                        snapshot=project_path(args.snapshot, project_id),
+                        record=project_path(args.record, project_id))
+                for project_id in args.project_id]
+    return MultiConnector(args.host, port, args.access_key, args.secret_key,
+                          projects, templates, args.ssl, args.notify,
+                          args.debounce, args.max_wait, args.resync_interval,
+                          args.pool_size, args.timeout, args.page_size,
+                          args.cache_ttl, args.bytecode_cache, args.stream,
+                          args.render_processes, args.reconnect_delay,
+                          args.max_reconnect_delay, args.fields,
+                          args.projection)
+
+
+def project_path(path, project_id):
+    """ Prefixes the file name of `path` with the project id, e.g
+    /var/lib/1a5-snapshot.gz. """
+    if not path:
+        return path
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '{0}-{1}'.format(project_id, name))
+
+
+def watch_config(args):
+    """ Watches the projects of the config file, and reloads it when it
+    changes. The connection options given on the command line override the
+    ones of the file. """
+    try:
+        config = load_config(args.config)
+        for name in ('host', 'access_key', 'secret_key'):
+            if getattr(args, name):
+                setattr(config, name, getattr(args, name))
+        if args.port != -1:
+            config.port = args.port
+        handler = config.connector()
+    except ConfigError as e:
+        print("error: {0}".format(e))
+        return
+
+    watcher = ConfigWatcher(handler, config)
+    try:
+        if args.metrics_port is not None:
+            CounterMap('rancher_gen_events_total',
+                       'Websocket events, by the stage they were dropped at',
+                       'stage', handler.counters)
+            start_http_server(args.metrics_port, args.metrics_address)
+        watcher.start()
+        handler()
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        watcher.stop()
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        return replay(sys.argv[2:])
+
     parser = ArgumentParser('rancher-gen', add_help=False,
                             description="Generate files from rancher meta-data")
 
@@ -62,10 +170,16 @@ def main():
                             'is specified)')
     named_args.add_argument('--access-key', help='The Rancher access key')
     named_args.add_argument('--secret-key', help='The Rancher secret key')
-    named_args.add_argument('--project-id', help="Rancher's project id")
+    named_args.add_argument('--project-id', action="append",
+                            help="Rancher's project id. Can be repeated to "
+                            "watch several projects, whose containers are "
+                            "then all passed to the templates")
     named_args.add_argument('--template', action="append", dest="templates",
-                            help="From and To paths of template to render. "
-                            "(e.g '/tom/template:/to/file)")
+                            help="From and To paths of template to render, "
+                            "optionally followed by a command to run when "
+                            "the file changes. (e.g '/from/template:/to/file' "
+                            "or '/from/template:/to/file:service nginx "
+                            "reload')")
 
     optional_args = parser.add_argument_group('optional arguments')
     optional_args.add_argument("-h", "--help", action="help",
@@ -83,7 +197,107 @@ def main():
                                help='User secure connections')
     optional_args.add_argument('--notify',
                                help="Command to run after template is "\
-                               "generated (e.g restart some-service)")
+                               "generated (e.g restart some-service). Used "
+                               "for templates without their own command")
+    optional_args.add_argument('--debounce', type=float, default=0.5,
+                               metavar='SECONDS',
+                               help="Seconds to wait for more events before "
+                               "rendering the templates (defaults to 0.5)")
+    optional_args.add_argument('--max-wait', type=float, default=5.0,
+                               metavar='SECONDS',
+                               help="Maximum number of seconds to delay "
+                               "rendering during bursts of events (defaults "
+                               "to 5)")
+    optional_args.add_argument('--resync-interval', type=float, default=300,
+                               metavar='SECONDS',
+                               help="Seconds between full reloads of the "
+                               "instances from rancher. Use 0 to disable "
+                               "(defaults to 300)")
+    optional_args.add_argument('--pool-size', type=int, default=10,
+                               help="Maximum number of connections kept open "
+                               "to the rancher server (defaults to 10)")
+    optional_args.add_argument('--timeout', type=float, default=30,
+                               metavar='SECONDS',
+                               help="Timeout for requests to the rancher "
+                               "server (defaults to 30)")
+    optional_args.add_argument('--page-size', type=int, default=100,
+                               help="Number of items to request per page "
+                               "from the rancher API (defaults to 100)")
+    optional_args.add_argument('--cache-ttl', type=float, default=60,
+                               metavar='SECONDS',
+                               help="Seconds to cache stacks and services "
+                               "loaded from rancher (defaults to 60)")
+    optional_args.add_argument('--bytecode-cache', metavar='DIR',
+                               help="Directory to cache compiled templates "
+                               "in, so they aren't compiled again on restart")
+    optional_args.add_argument('--stream', action='store_true',
+                               default=False,
+                               help="Stream the output of the templates to "
+                               "disk instead of rendering it in memory")
+    optional_args.add_argument('--render-processes', type=int, default=0,
+                               metavar='PROCESSES',
+                               help="Number of processes used to render "
+                               "multiple templates in parallel (defaults to "
+                               "0, render in the main process)")
+    optional_args.add_argument('--selector', action="append",
+                               metavar="DEST:SELECTOR", dest="selectors",
+                               help="Only render the template generating "
+                               "DEST with the containers matching SELECTOR, "
+                               "and only when those containers change (e.g "
+                               "'/to/file:stack=web,service=nginx,"
+                               "label.tier=frontend')")
+    optional_args.add_argument('--reconnect-delay', type=float, default=1,
+                               metavar='SECONDS',
+                               help="Initial delay before reconnecting to "
+                               "rancher when the connection drops. It doubles "
+                               "after every failed attempt (defaults to 1)")
+    optional_args.add_argument('--max-reconnect-delay', type=float,
+                               default=60, metavar='SECONDS',
+                               help="Maximum delay between reconnection "
+                               "attempts (defaults to 60)")
+    optional_args.add_argument('--snapshot', metavar='FILE',
+                               help="File to save the containers to after "
+                               "every update. When the app starts, the "
+                               "templates are rendered from this file right "
+                               "away, and then reconciled with rancher")
+    optional_args.add_argument('--fields', metavar='FIELD[,FIELD...]',
+                               type=lambda value: value.split(','),
+                               help="Container fields to pass to templates "
+                               "whose fields can't be found automatically "
+                               "(e.g id,name,primaryIpAddress,labels). By "
+                               "default, those templates get every field")
+    optional_args.add_argument('--no-projection', action='store_false',
+                               dest='projection',
+                               help="Keep every container field, instead of "
+                               "only the fields used by the templates")
+    optional_args.add_argument('--metrics-port', type=int, metavar='PORT',
+                               help="Serve metrics in the Prometheus format "
+                               "on this port (disabled by default)")
+    optional_args.add_argument('--metrics-address', default='127.0.0.1',
+                               metavar='ADDRESS',
+                               help="Address to serve the metrics on "
+                               "(defaults to 127.0.0.1)")
+    optional_args.add_argument('--record', metavar='FILE',
+                               help="Append the events received from rancher "
+                               "to FILE, so they can be replayed with "
+                               "'rancher-gen replay' (gzipped if FILE ends "
+                               "with .gz)")
+    optional_args.add_argument('--engine', choices=ENGINES, default='threads',
+                               help="Run on threads, or on an asyncio event "
+                               "loop (Python 3.5+). Defaults to threads")
+    optional_args.add_argument('--mode', choices=MODES, default='websocket',
+                               help="Watch the websocket events, or poll the "
+                               "instances every --interval seconds where "
+                               "websockets can't stay open. Defaults to "
+                               "websocket")
+    optional_args.add_argument('--interval', type=float, default=10,
+                               metavar='SECONDS',
+                               help="Seconds between polls in poll mode "
+                               "(defaults to 10)")
+    optional_args.add_argument('--config', metavar='FILE',
+                               help="Read the projects, templates and "
+                               "settings from a JSON, YAML or TOML file, and "
+                               "apply its changes without restarting")
 
     parser.add_argument('template', nargs='?', default=None,
                         help="Path to template to generate. "\
@@ -93,6 +307,9 @@ def main():
                         "(Deprecated, use --template instead)")
 
     args = parser.parse_args()
+    if args.config:
+        return watch_config(args)
+
     if not validate_args(args):
         return
 
@@ -107,14 +324,118 @@ def main():
         port = args.port
         if args.port == -1:
             port = 443 if args.ssl else 80
-        handler = RancherConnector(args.host, port, args.project_id,
-                                   args.access_key, args.secret_key,
-                                   templates, args.ssl,
-                                   args.stack, args.services, args.notify)
+        if len(args.project_id) > 1:
+            handler = multi_connector(args, port, templates)
+        else:
+            options = {}
+            if args.mode == 'poll':
+                options['interval'] = args.interval
+            connector = connector_class(args.engine, args.mode)
+            handler = connector(args.host, port, args.project_id[0],
+                                args.access_key, args.secret_key, templates,
+                                args.ssl, args.stack, args.services,
+                                args.notify, args.debounce, args.max_wait,
+                                args.resync_interval, args.pool_size,
+                                args.timeout, args.page_size, args.cache_ttl,
+                                args.bytecode_cache, args.stream,
+                                args.render_processes, args.selectors,
+                                args.reconnect_delay,
+                                args.max_reconnect_delay, args.snapshot,
+                                args.fields, args.record,
+                                projection=args.projection, **options)
+        if args.metrics_port is not None:
+            CounterMap('rancher_gen_events_total',
+                       'Websocket events, by the stage they were dropped at',
+                       'stage', handler.counters)
+            start_http_server(args.metrics_port, args.metrics_address)
         handler()
     except Exception as e:
         logger.exception(e)
 
 
+def replay(argv):
+    """ Replays the events recorded with --record, without connecting to
+    rancher. """
+    parser = ArgumentParser('rancher-gen replay',
+                            description="Replay recorded rancher events")
+    parser.add_argument('log', help="File recorded with --record")
+    parser.add_argument('--template', action="append", dest="templates",
+                        required=True,
+                        help="From and To paths of template to render, "
+                        "optionally followed by a command to run when the "
+                        "file changes")
+    parser.add_argument('--instances', metavar='FILE',
+                        help="Snapshot file (see --snapshot) with the "
+                        "containers to start from. Defaults to no containers")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="How many times faster than recorded to replay "
+                        "the events. Use 0 to replay them as fast as "
+                        "possible (defaults to 1)")
+    parser.add_argument('--log-level', action=SetLogLevel, default='INFO',
+                        choices=LOG_LEVELS, help='Set the log level.')
+    parser.add_argument('--stack', help="The name of the rancher stack")
+    parser.add_argument('--service', action="append", metavar="SERVICE",
+                        dest="services",
+                        help="The name of the rancher service")
+    parser.add_argument('--notify',
+                        help="Command to run after template is generated")
+    parser.add_argument('--debounce', type=float, default=0.5,
+                        metavar='SECONDS',
+                        help="Seconds to wait for more events before "
+                        "rendering the templates (defaults to 0.5)")
+    parser.add_argument('--max-wait', type=float, default=5.0,
+                        metavar='SECONDS',
+                        help="Maximum number of seconds to delay rendering "
+                        "during bursts of events (defaults to 5)")
+    parser.add_argument('--selector', action="append",
+                        metavar="DEST:SELECTOR", dest="selectors",
+                        help="Only render the template generating DEST with "
+                        "the containers matching SELECTOR")
+    parser.add_argument('--fields', metavar='FIELD[,FIELD...]',
+                        type=lambda value: value.split(','),
+                        help="Container fields to pass to templates whose "
+                        "fields can't be found automatically")
+    parser.add_argument('--no-projection', action='store_false',
+                        dest='projection',
+                        help="Keep every container field, instead of only "
+                        "the fields used by the templates")
+    parser.add_argument('--engine', choices=ENGINES, default='threads',
+                        help="Run on threads, or on an asyncio event loop "
+                        "(Python 3.5+). Defaults to threads")
+    args = parser.parse_args(argv)
+
+    instances = []
+    if args.instances:
+        snapshot = read_snapshot(args.instances)
+        if snapshot is None:
+            print("error: Unable to read instances from '{0}'"
+                  .format(args.instances))
+            return
+        instances = snapshot['instances']
+
+    try:
+        connector = connector_class(args.engine)
+        handler = connector('replay', 0, 'replay', '', '', args.templates,
+                            stack=args.stack, services=args.services,
+                            notify=args.notify, debounce=args.debounce,
+                            max_wait=args.max_wait, resync_interval=0,
+                            selectors=args.selectors, fields=args.fields,
+                            projection=args.projection,
+                            api=StubAPI(instances))
+
+        start = time.time()
+        coalesced = EVENTS_COALESCED.get()
+        count = handler.replay(paced(read_log(args.log), args.speed))
+
+        stats = dict(handler.event_filter.counters)
+        stats['coalesced'] = EVENTS_COALESCED.get() - coalesced
+        logger.info('Replayed {0} events in {1:.2f} seconds ({2})'.format(
+            count, time.time() - start, ', '.join(
+                '{0}={1}'.format(key, value)
+                for key, value in sorted(stats.items()))))
+    except Exception as e:
+        logger.exception(e)
+
+
 if __name__ == "__main__":
     main()
@@ -2,16 +2,50 @@
 Compatibility layer and utilities.
 """
 import base64
+import os
 import sys
+import time
 
 PY3 = sys.version_info[0] >= 3
 
+if PY3:
+    string_types = (str,)
+else:
+    string_types = (basestring,)  # noqa
+
+# Python 2 does not have a monotonic clock, fall back to the wall clock
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Python 2 does not have os.replace, os.rename overwrites files on POSIX
+replace = getattr(os, 'replace', os.rename)
+
 # Python 3 does not have StringIO, we should use the io module instead
 try:
     from StringIO import StringIO  # noqa
 except ImportError:
     from io import StringIO  # noqa
 
+try:
+    from urllib.parse import urlparse  # noqa
+except ImportError:
+    from urlparse import urlparse  # noqa
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # noqa
+    from socketserver import ThreadingMixIn  # noqa
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # noqa
+    from SocketServer import ThreadingMixIn  # noqa
+
+# Use a faster JSON parser when one is installed
+try:
+    from orjson import loads as json_loads  # noqa
+except ImportError:
+    try:
+        from ujson import loads as json_loads  # noqa
+    except ImportError:
+        from json import loads as json_loads  # noqa
+
 
 def b64encode(bytes_or_str):
     input_bytes = bytes_or_str
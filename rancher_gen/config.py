@@ -0,0 +1,363 @@
+"""
+Loads the settings of the app from a JSON, YAML or TOML file, and reloads
+them when the file changes.
+"""
+from __future__ import absolute_import
+
+import io
+import json
+import logging
+import numbers
+import os
+from collections import OrderedDict
+
+from .compat import string_types
+from .exception import ConfigError
+from .multi import MultiConnector, Project
+from .renderer import Template, parse_template
+from .scheduler import Ticker
+from .selector import Selector
+
+logger = logging.getLogger(__name__)
+
+# YAML and TOML config files need optional dependencies
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    import tomllib as toml  # Python 3.11+
+except ImportError:
+    try:
+        import toml
+    except ImportError:
+        toml = None
+
+# The top level settings, with their type and default value. They are named
+# after the command line options.
+SETTINGS = OrderedDict([
+    ('host', ('string', None)),
+    ('port', ('integer', None)),
+    ('access_key', ('string', None)),
+    ('secret_key', ('string', None)),
+    ('ssl', ('boolean', False)),
+    ('notify', ('string', None)),
+    ('debounce', ('number', 0.5)),
+    ('max_wait', ('number', 5.0)),
+    ('resync_interval', ('number', 300)),
+    ('reload_interval', ('number', 5)),
+    ('pool_size', ('integer', 10)),
+    ('timeout', ('number', 30)),
+    ('page_size', ('integer', 100)),
+    ('cache_ttl', ('number', 60)),
+    ('bytecode_cache', ('path', None)),
+    ('stream', ('boolean', False)),
+    ('render_processes', ('integer', 0)),
+    ('reconnect_delay', ('number', 1)),
+    ('max_reconnect_delay', ('number', 60)),
+    ('fields', ('strings', None)),
+    ('projection', ('boolean', True)),
+])
+
+PROJECT_SETTINGS = OrderedDict([
+    ('id', ('string', None)),
+    ('name', ('string', None)),
+    ('stack', ('string', None)),
+    ('services', ('strings', None)),
+    ('snapshot', ('path', None)),
+    ('record', ('path', None)),
+])
+
+TEMPLATE_SETTINGS = OrderedDict([
+    ('source', ('path', None)),
+    ('dest', ('path', None)),
+    ('notify', ('string', None)),
+    ('selector', ('string', None)),
+])
+
+PARSERS = {
+    '.json': 'json',
+    '.yml': 'yaml',
+    '.yaml': 'yaml',
+    '.toml': 'toml',
+}
+
+
+class Config(object):
+    """ The validated settings of a config file.
+
+    Every setting of SETTINGS is an attribute, along with `projects`, the
+    list of multi.Project to watch, and `templates`, the list of
+    renderer.Template rendered with the containers of every project.
+
+    Args:
+        - settings: The content of the config file.
+        - path: The path of the config file. Relative paths in the file are
+            relative to its directory.
+    """
+
+    def __init__(self, settings, path=None):
+        self.path = path
+        base = os.path.dirname(os.path.abspath(path)) if path else ''
+        if not isinstance(settings, dict):
+            raise ConfigError('The config must be a table of settings')
+
+        keys = list(SETTINGS) + ['projects', 'templates']
+        _check_keys(settings, keys, None)
+        for name, value in _parse_settings(settings, SETTINGS, base, None):
+            setattr(self, name, value)
+
+        self.templates = []
+        for i, value in enumerate(_get_list(settings, 'templates', None)):
+            location = 'templates[{0}]'.format(i)
+            template, selector = _parse_template(value, base, location)
+            if selector is not None:
+                raise ConfigError('{0}: selectors can only be used by the '
+                                  'templates of a project'.format(location))
+            self.templates.append(template)
+
+        self.projects = []
+        projects = _get_list(settings, 'projects', None)
+        if not projects:
+            raise ConfigError("Missing setting: 'projects'")
+        for i, value in enumerate(projects):
+            self.projects.append(_parse_project(
+                value, base, 'projects[{0}]'.format(i)))
+
+        names = [project.name for project in self.projects]
+        for name in names:
+            if names.count(name) > 1:
+                raise ConfigError("projects: duplicate project name '{0}'"
+                                  .format(name))
+
+    def connector(self):
+        """ Returns a MultiConnector watching the projects of the config. """
+        for name in ('host', 'access_key', 'secret_key'):
+            if not getattr(self, name):
+                raise ConfigError("Missing setting: '{0}'".format(name))
+
+        port = self.port
+        if port is None:
+            port = 443 if self.ssl else 80
+        connector = MultiConnector(
+            self.host, port, self.access_key, self.secret_key, self.projects,
+            self.templates, self.ssl, self.notify, self.debounce,
+            self.max_wait, self.resync_interval, self.pool_size, self.timeout,
+            self.page_size, self.cache_ttl, self.bytecode_cache, self.stream,
+            self.render_processes, self.reconnect_delay,
+            self.max_reconnect_delay, self.fields, self.projection)
+        return connector
+
+
+def load_config(path):
+    """ Reads and validates a config file. The format of the file is picked
+    from its extension: .json, .yml, .yaml or .toml.
+
+    Raises ConfigError if the file can't be read or is invalid.
+    """
+    parser = PARSERS.get(os.path.splitext(path)[1].lower())
+    if parser is None:
+        raise ConfigError("Unknown config format: '{0}'. Must be one of {1}"
+                          .format(path, ', '.join(sorted(PARSERS))))
+    if parser == 'yaml' and yaml is None:
+        raise ConfigError('PyYAML must be installed to read YAML config '
+                          'files')
+    if parser == 'toml' and toml is None:
+        raise ConfigError('toml must be installed to read TOML config files')
+
+    try:
+        with io.open(path, encoding='utf-8') as fh:
+            content = fh.read()
+    except (IOError, OSError) as e:
+        raise ConfigError("Unable to read '{0}': {1}".format(path, e))
+
+    errors = (ValueError,)
+    if yaml is not None:
+        errors += (yaml.YAMLError,)
+    try:
+        if parser == 'json':
+            settings = json.loads(content)
+        elif parser == 'yaml':
+            settings = yaml.safe_load(content)
+        else:
+            settings = toml.loads(content)
+    except errors as e:
+        raise ConfigError("Unable to parse '{0}': {1}".format(path, e))
+    return Config(settings, path)
+
+
+class ConfigWatcher(object):
+    """ Applies the changes of a config file to a running MultiConnector.
+
+    The modification time of the file is checked every `reload_interval`
+    seconds. When it changes, the file is loaded again on the scheduler
+    thread of the connector, between two batches of events, so the
+    websockets stay open. If the new config is invalid, the error is logged
+    and the current config is kept.
+
+    Args:
+        - connector: The MultiConnector to configure.
+        - config: The Config the connector was created from.
+    """
+
+    def __init__(self, connector, config):
+        self.connector = connector
+        self.path = config.path
+        self.ticker = Ticker(config.reload_interval, self.check)
+        self._mtime = _mtime(self.path)
+
+    def start(self):
+        self.ticker.start()
+
+    def stop(self):
+        self.ticker.stop()
+
+    def check(self):
+        """ Schedules a reload if the config file changed. """
+        mtime = _mtime(self.path)
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self.connector.schedule_call(self.reload)
+
+    def reload(self):
+        """ Loads the config file, and applies it if it is valid. Returns
+        whether it was applied. """
+        try:
+            config = load_config(self.path)
+        except ConfigError as e:
+            logger.error("Keeping the current config, '{0}' is invalid: {1}"
+                         .format(self.path, e))
+            return False
+
+        logger.info("Reloading '{0}'".format(self.path))
+        self.connector.configure(config)
+        if self.ticker.interval != config.reload_interval:
+            self.ticker.stop()
+            self.ticker.interval = config.reload_interval
+            self.ticker.start()
+        return True
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _parse_project(value, base, location):
+    if not isinstance(value, dict):
+        raise ConfigError('{0}: must be a table'.format(location))
+    _check_keys(value, list(PROJECT_SETTINGS) + ['templates'], location)
+    settings = dict(_parse_settings(value, PROJECT_SETTINGS, base, location))
+    if not settings['id']:
+        raise ConfigError("{0}: missing setting 'id'".format(location))
+
+    templates = []
+    selectors = {}
+    for i, template in enumerate(_get_list(value, 'templates', location)):
+        template, selector = _parse_template(
+            template, base, '{0}.templates[{1}]'.format(location, i))
+        templates.append(template)
+        if selector is not None:
+            selectors[template.dest] = selector
+
+    return Project(settings['id'], templates, settings['stack'],
+                   settings['services'], selectors, settings['name'],
+                   settings['snapshot'], settings['record'])
+
+
+def _parse_template(value, base, location):
+    """ Returns the Template and the Selector (or None) of a template, which
+    is either a 'source:dest[:notify]' string or a table. """
+    if isinstance(value, string_types):
+        try:
+            template = parse_template(value)
+        except ValueError as e:
+            raise ConfigError('{0}: {1}'.format(location, e))
+        return Template(_path(template.source, base),
+                        _path(template.dest, base), template.command), None
+
+    if not isinstance(value, dict):
+        raise ConfigError('{0}: must be a string or a table'.format(location))
+    _check_keys(value, TEMPLATE_SETTINGS, location)
+    settings = dict(_parse_settings(value, TEMPLATE_SETTINGS, base,
+                                    location))
+    for name in ('source', 'dest'):
+        if not settings[name]:
+            raise ConfigError("{0}: missing setting '{1}'"
+                              .format(location, name))
+
+    selector = settings['selector']
+    if selector is not None:
+        try:
+            selector = Selector.parse(selector)
+        except ValueError as e:
+            raise ConfigError('{0}.selector: {1}'.format(location, e))
+    return Template(settings['source'], settings['dest'],
+                    settings['notify']), selector
+
+
+def _parse_settings(values, settings, base, location):
+    """ Yields the name and validated value of every setting, using the
+    default value of the settings that are missing. """
+    for name, (kind, default) in settings.items():
+        value = values.get(name)
+        if value is None:
+            yield name, default
+            continue
+
+        if not _is_kind(value, kind):
+            raise ConfigError('{0}: must be a{1} {2}'.format(
+                _join(location, name), 'n' if kind == 'integer' else '',
+                'list of strings' if kind == 'strings' else
+                'string' if kind == 'path' else kind))
+        if kind == 'path':
+            value = _path(value, base)
+        elif kind == 'strings':
+            value = list(value)
+        yield name, value
+
+
+def _is_kind(value, kind):
+    # bool is a subclass of int, but true is not a valid number of seconds
+    if kind in ('integer', 'number') and isinstance(value, bool):
+        return False
+    if kind == 'integer':
+        return isinstance(value, numbers.Integral)
+    if kind == 'number':
+        return isinstance(value, numbers.Real)
+    if kind == 'boolean':
+        return isinstance(value, bool)
+    if kind == 'strings':
+        return isinstance(value, list) and \
+            all(isinstance(item, string_types) for item in value)
+    return isinstance(value, string_types)
+
+
+def _check_keys(values, keys, location):
+    for key in values:
+        if key not in keys:
+            raise ConfigError("{0}: unknown setting".format(
+                _join(location, key)))
+
+
+def _get_list(values, name, location):
+    value = values.get(name)
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ConfigError('{0}: must be a list'.format(
+            _join(location, name)))
+    return value
+
+
+def _join(location, name):
+    if location is None:
+        return name
+    return '{0}.{1}'.format(location, name)
+
+
+def _path(path, base):
+    return os.path.join(base, os.path.expanduser(path))
@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+
+import logging
+import re
+from collections import Counter
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Resource types whose changes invalidate the stacks and services cached by
+# the api
+SERVICE_TYPES = ['environment', 'stack', 'service', 'loadBalancerService',
+                 'externalService', 'dnsService', 'kubernetesService']
+
+# Container states that can change the rendered templates
+CONTAINER_STATES = ['running', 'removed', 'stopped']
+
+RESOURCE_TYPE_RE = re.compile(r'"resourceType"\s*:\s*"([^"]*)"')
+SAFE_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+class EventFilter(object):
+    """ Rejects websocket frames that can't affect the templates before they
+    are decoded.
+
+    The checks only look for substrings in the raw frame, so they are much
+    cheaper than decoding it. They are conservative: a frame is only dropped
+    when it can't possibly be relevant, and every frame that gets through is
+    still checked by the MessageHandler once decoded.
+
+    The number of frames received, and dropped at each stage, are kept in
+    `counters`.
+
+    Args:
+        - stack: The name of the stack to watch.
+        - services: A list of service names to watch within the stack.
+    """
+
+    def __init__(self, stack=None, services=None):
+        self.counters = Counter()
+        self._lock = Lock()
+
+        # Names are only looked up in the raw frame if they can't have been
+        # escaped in the JSON encoded frame.
+        self._stack = None
+        self._services = None
+        if stack and SAFE_NAME_RE.match(stack):
+            self._stack = '"{0}"'.format(stack)
+            if services and all(SAFE_NAME_RE.match(s) for s in services):
+                self._services = ['"{0}/{1}"'.format(stack, service)
+                                  for service in services]
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def accept(self, message):
+        """ Returns True if the frame needs to be decoded and handled. """
+        self.count('received')
+        stage = self._reject_stage(message)
+        if stage is not None:
+            self.count('dropped_{0}'.format(stage))
+            return False
+
+        self.count('decoded')
+        return True
+
+    def _reject_stage(self, message):
+        if 'resource.change' not in message:
+            return 'name'
+
+        match = RESOURCE_TYPE_RE.search(message)
+        if match is None:
+            return None
+
+        resource_type = match.group(1)
+        if resource_type in SERVICE_TYPES:
+            return None
+        if resource_type != 'container':
+            return 'type'
+
+        if self._stack is not None and self._stack not in message:
+            return 'stack'
+
+        if self._services is not None and \
+                not any(service in message for service in self._services):
+            return 'service'
+
+        if not any('"{0}"'.format(state) in message
+                   for state in CONTAINER_STATES):
+            return 'state'
+
+        return None
@@ -1,2 +1,10 @@
 class RancherConnectionError(Exception):
-    """ A connection error to rancher occurred"""
\ No newline at end of file
+    """ A connection error to rancher occurred"""
+
+
+class ConfigError(Exception):
+    """ The config file is invalid"""
+
+
+class RancherAPIError(RancherConnectionError):
+    """ Rancher answered a request with an error"""
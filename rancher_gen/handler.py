@@ -1,84 +1,343 @@
 from __future__ import absolute_import
 
-import json
 import logging
-import os
 import requests
 import ssl
 import websocket
 
-from jinja2 import Environment, FileSystemLoader
 from subprocess import call
-from threading import Thread
+from threading import Event
 
-from .compat import b64encode
+from .compat import b64encode, json_loads, monotonic
+from .events import CONTAINER_STATES, SERVICE_TYPES, EventFilter
 from .exception import RancherConnectionError
+from .metrics import EVENT_LATENCY, EVENTS_COALESCED, RECONNECTS
 from .rancher import API
+from .projection import REQUIRED_FIELDS
+from .renderer import TemplateRenderer, parse_template
+from .replay import Recorder
+from .scheduler import Backoff, EventScheduler, Notifier, Ticker
+from .selector import Fingerprints, Selector
+from .store import ContainerStore
 
 logger = logging.getLogger(__name__)
 
 # Change the log level on the requests library
 logging.getLogger("requests").setLevel(logging.WARNING)
 
+# Renderer used when render_templates is called without one
+default_renderer = TemplateRenderer()
+
+# Event scheduled to reload all the instances from rancher
+RESYNC = 'resync'
+
+# Key of the messages holding the time they were received at
+RECEIVED = '_received'
+
 
 class RancherConnector(object):
 
     def __init__(self, host, port, project_id, access_key, secret_key,
                  templates, ssl=False, stack=None, services=None,
-                 notify=None):
+                 notify=None, debounce=0.5, max_wait=5.0,
+                 resync_interval=300, pool_size=10, timeout=30,
+                 page_size=100, cache_ttl=60, bytecode_cache_dir=None,
+                 stream=False, render_processes=0, selectors=None,
+                 reconnect_delay=1, max_reconnect_delay=60, snapshot=None,
+                 fields=None, record=None, session=None, api=None,
+                 projection=True):
         self.rancher_host = host
         self.rancher_port = port
         self.project_id = project_id
         self.api_token = b64encode("{0}:{1}".format(access_key, secret_key))
-        self.templates = templates
+        self.templates = [parse_template(template) for template in templates]
         self.ssl = ssl
         self.stack = stack
         self.services = services
         self.notify = notify
+        self.pool_size = pool_size
+        self.snapshot = snapshot
+        self.record = record
+        self.recorder = None
+        self.notifier = Notifier()
+        self.selectors = parse_selectors(selectors)
+        self.fingerprints = Fingerprints()
+        self.event_filter = EventFilter(stack, services)
+        self.backoff = Backoff(reconnect_delay, max_reconnect_delay)
+        self.ws = None
+        self._connected = False
+        self._stopped = Event()
+        # An api can be given to stand in for rancher, e.g when replaying
+        if api is None:
+            api = API(host, port, project_id, self.api_token, ssl, pool_size,
+                      timeout, page_size, cache_ttl, session)
+        self.api = api
+        self.fields = fields
+        self.projection = projection
+        self.renderer = TemplateRenderer(bytecode_cache_dir, stream,
+                                         render_processes)
+        self.store = ContainerStore(self._container_fields())
+        self.scheduler = EventScheduler(self._on_events, debounce, max_wait)
+        self.resync_ticker = Ticker(resync_interval,
+                                    lambda: self.scheduler.schedule(RESYNC))
 
     def __call__(self):
         self._prerender()
         self.start()
 
     def _prerender(self):
-        instances = None
-        api = API(self.rancher_host, self.rancher_port, self.project_id,
-                  self.api_token, self.ssl)
+        # Render the containers from the last run right away, and reconcile
+        # them with rancher once the scheduler is started.
+        if self._load_snapshot():
+            self._render_and_notify(self._reset_fingerprints())
+            self.scheduler.schedule(RESYNC)
+            return
+
+        self._resync()
+
+    def configure(self, templates, selectors=None, notify=None):
+        """ Replaces the templates, selectors and notify command, and renders
+        the templates again. Only the files whose output changed are written
+        and notified.
+
+        It must be called from the scheduler thread, or before the app is
+        started.
+        """
+        self.templates = [parse_template(template) for template in templates]
+        self.selectors = parse_selectors(selectors)
+        self.notify = notify
+        if self.store.seeded:
+            self._reset_fingerprints()
+            self._render_and_notify()
+
+    def _snapshot_key(self):
+        fields = self.store.fields
+        if fields is not None:
+            fields = sorted(fields)
+        return [self.project_id, self.stack, self.services, fields]
+
+    def _container_fields(self, templates=None):
+        """ Returns the container fields used by the templates, or None if
+        they may use any field. """
+        if not self.projection:
+            return None
+        if templates is None:
+            templates = self.templates
+        fields = set()
+        for template in templates:
+            template_fields = self.renderer.find_fields(template.source)
+            if template_fields is None:
+                # Fall back to the configured fields
+                if self.fields is None:
+                    return None
+                template_fields = REQUIRED_FIELDS.union(self.fields)
+            fields |= template_fields
+        return fields
+
+    def _fields_changed(self):
+        """ Returns whether the templates now use other fields than the ones
+        kept by the store. """
+        return self._container_fields() != self.store.fields
+
+    def _reload_fields(self):
+        """ Reloads the containers with the fields used by the templates, so
+        that they are never rendered with containers missing a field.
+
+        If rancher can't be reached, the store keeps the previous fields, so
+        the containers are reloaded again on the next render. Returns
+        whether they were reloaded.
+        """
+        logger.info('The fields used by the templates changed')
+        previous = self.store.fields
+        self.store.fields = self._container_fields()
+        if not self._load_instances():
+            self.store.fields = previous
+            return False
+        self._reset_fingerprints()
+        return True
+
+    def counters(self):
+        """ Returns the number of websocket events, by the stage they were
+        dropped at. """
+        return self.event_filter.counters
+
+    def _load_snapshot(self):
+        if not self.snapshot:
+            return False
+        return self.store.load(self.snapshot, self._snapshot_key())
+
+    def _save_snapshot(self):
+        if not self.snapshot:
+            return
+        try:
+            self.store.save(self.snapshot, self._snapshot_key())
+        except (IOError, OSError) as e:
+            logger.warning("Unable to save snapshot '{0}': {1}"
+                           .format(self.snapshot, e))
+
+    def _resync(self):
+        """ Reloads all the instances from rancher into the store, renders the
+        templates and runs the notify command. """
+        if not self._load_instances():
+            return
+
+        self._render_and_notify(self._reset_fingerprints())
+        self._save_snapshot()
+
+    def _reset_fingerprints(self):
+        """ Fingerprints the containers of the store after they were
+        reloaded. Returns the destinations whose containers changed. """
+        return self.fingerprints.reset(self._template_selectors(),
+                                       self.store.instances())
 
+    def _load_instances(self):
+        """ Reloads all the instances from rancher into the store.
+
+        Returns False if rancher could not be reached.
+        """
         try:
-            # If we're not filtering by stack and services, then load all instances
-            # in the environment
-            if self.stack is None and self.services is None:
-                instances = api.get_instances()
-
-            # If we're only filterting by stack, then load the instances for that
-            # stack
-            elif self.stack and self.services is None:
-                instances = api.get_instances(stack_name=self.stack)
-
-            # If we're filtering by stack and service, then load the instances for
-            # that service
-            elif self.stack and self.services and len(self.services) > 0:
-                api = API(self.rancher_host, self.rancher_port, self.project_id,
-                        self.api_token, self.ssl)
-                services = api.get_services(self.stack, self.services)
-
-                instances = []
-                if len(services) > 0:
-                    for service in services:
-                        instances += api.get_instances(service)
+            # The instances are streamed page by page into the store
+            self.store.reset(self._iter_instances())
         except RancherConnectionError:
             # If we made it here, it means we couldn't connect to rancher,
             # so simply return
+            return False
+        return True
+
+    def _render_and_notify(self, dests=None, received=None):
+        """ Renders the templates, or only the ones in `dests` if specified,
+        and runs the notify commands of the files that changed.
+
+        Args:
+            - dests: The destinations of the templates to render.
+            - received: When the oldest event that led to this render was
+                received, to measure how long files take to be updated.
+        """
+        if self._fields_changed():
+            if not self._reload_fields():
+                return
+            # Every template is rendered with the reloaded containers
+            dests = None
+
+        jobs, commands = self._render_jobs(dests)
+        changed = self.renderer.render_jobs(jobs)
+        self.notifier.notify(self._rendered(changed, commands, received))
+
+    def _render_jobs(self, dests=None):
+        """ Returns the (instances, template) jobs to render, and the notify
+        command of each destination. """
+        instances = self.store.instances()
+        jobs = []
+        commands = {}
+        for template in self.templates:
+            commands[template.dest] = template.command or self.notify
+            if dests is not None and template.dest not in dests:
+                continue
+
+            selector = self.selectors.get(template.dest)
+            if selector is not None:
+                jobs.append((selector.filter(instances), template))
+            else:
+                # The index of the store is kept up to date as events arrive
+                jobs.append((self.store.index, template))
+        return jobs, commands
+
+    def _rendered(self, changed, commands, received=None):
+        """ Returns the notify commands to run for the files that changed. """
+        if received is not None:
+            for dest in changed:
+                EVENT_LATENCY.observe(monotonic() - received)
+
+        # Run the notify commands of the templates that changed, falling back
+        # to the global notify command.
+        return [commands[dest] for dest in changed]
+
+    def _template_selectors(self):
+        selectors = {}
+        for template in self.templates:
+            selectors[template.dest] = self.selectors.get(template.dest)
+        return selectors
+
+    def _iter_instances(self):
+        # If we're not filtering by stack and services, then load all instances
+        # in the environment
+        if self.stack is None and self.services is None:
+            return self.api.iter_instances()
+
+        # If we're only filterting by stack, then load the instances for that
+        # stack
+        elif self.stack and self.services is None:
+            return self.api.iter_instances(stack_name=self.stack)
+
+        # If we're filtering by stack and service, then load the instances for
+        # that service
+        elif self.stack and self.services and len(self.services) > 0:
+            services = self.api.get_services(self.stack, self.services)
+            return self.api.iter_services_instances(services)
+
+        return []
+
+    def _on_events(self, events):
+        if self._needs_resync(events):
+            self._resync()
             return
 
-        # If we found any instances, then render the templates
-        if instances is None:
-            instances = []
-        render_templates(instances, self.templates)
-        notify(self.notify)
+        changed, updated, received = self._apply_events(events)
+        if changed:
+            self._render_and_notify(changed, received)
+        if updated:
+            self._save_snapshot()
+
+    def _needs_resync(self, events):
+        """ Counts a batch of events, and returns whether every instance must
+        be reloaded instead of applying the events: if a resync was
+        requested, or if the store could not be seeded when the app started.
+        """
+        EVENTS_COALESCED.inc(len(events) - 1)
+        if RESYNC in events or not self.store.seeded:
+            logger.debug('Resyncing instances from rancher')
+            return True
+        return False
+
+    def _apply_events(self, events):
+        """ Applies the events to the store.
+
+        Returns the destinations whose containers changed, whether the store
+        was updated, and when the oldest event was received.
+        """
+        # Only render the templates whose containers changed
+        selectors = self._template_selectors()
+        updated = False
+        changed = set()
+        received = None
+        for event in events:
+            if event and event.get('data'):
+                if RECEIVED in event:
+                    received = min(received or event[RECEIVED],
+                                   event[RECEIVED])
+                resource = event['data']['resource']
+                if self.store.apply(resource):
+                    updated = True
+                    changed |= self.fingerprints.update(
+                        selectors, resource['id'],
+                        self.store.get(resource['id']))
+        return changed, updated, received
 
     def start(self):
+        self.scheduler.start()
+        self.resync_ticker.start()
+        logger.info('Watching for rancher events')
+        try:
+            self._watch()
+        finally:
+            self.resync_ticker.stop()
+            self.scheduler.stop()
+            self.renderer.close()
+            self.api.close()
+
+    def _watch(self):
+        """ Reads events from the websocket until stopped, reconnecting
+        whenever the connection drops. """
         header = {
             'Authorization': 'Basic {0}'.format(self.api_token)
         }
@@ -87,56 +346,140 @@ class RancherConnector(object):
             'resource.change&include=services'\
             .format(protocol, self.rancher_host, self.rancher_port,
                     self.project_id)
-        self.ws = websocket.WebSocketApp(url, header=header,
-                                         on_message=self._on_message,
-                                         on_open=self._on_open,
-                                         on_error=self._on_error,
-                                         on_close=self._on_close)
 
-        logger.info('Watching for rancher events')
-        self.ws.run_forever()
-
-    def _on_open(self, ws):  # pragma: no cover
+        if self.record:
+            self.recorder = Recorder(self.record)
+            logger.info("Recording rancher events to '{0}'"
+                        .format(self.record))
+        try:
+            while not self._stopped.is_set():
+                self.ws = websocket.WebSocketApp(url, header=header,
+                                                 on_message=self._on_message,
+                                                 on_open=self._on_open,
+                                                 on_error=self._on_error,
+                                                 on_close=self._on_close)
+                self.ws.run_forever()
+                if self._stopped.is_set():
+                    break
+
+                delay = self.backoff.next()
+                RECONNECTS.inc()
+                logger.info('Reconnecting in {0:.1f} seconds'.format(delay))
+                self._stopped.wait(delay)
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+
+    def replay(self, frames):
+        """ Feeds recorded websocket frames through the app, as if they were
+        received from rancher.
+
+        Args:
+            - frames: The raw frames, e.g from replay.paced.
+
+        Returns the number of frames replayed.
+        """
+        self._prerender()
+        self.scheduler.start()
+        logger.info('Replaying rancher events')
+        count = 0
+        try:
+            for frame in frames:
+                self._on_message(None, frame)
+                count += 1
+        finally:
+            # Pending events are handled before the scheduler stops
+            self.scheduler.stop()
+            self.renderer.close()
+            self.api.close()
+        return count
+
+    def stop(self):
+        """ Stops watching for events. """
+        self._stopped.set()
+        if self.ws is not None:
+            self.ws.close()
+
+    def _on_open(self, ws):
         logger.info("Websocket connection open")
+        self.backoff.reset()
+
+        # Events may have been missed while disconnected, so reload the
+        # instances. Only the templates whose containers changed are
+        # rendered again.
+        if self._connected:
+            self.scheduler.schedule(RESYNC)
+        self._connected = True
 
-    def _on_close(self, ws):  # pragma: no cover
+    def _on_close(self, ws, *args):  # pragma: no cover
         logger.info('Websocket connection closed')
 
     def _on_error(self, ws, error):  # pragma: no cover
+        # Older versions of websocket-client report interruptions as errors
+        if isinstance(error, (KeyboardInterrupt, SystemExit)):
+            self._stopped.set()
+            return
         logger.error(error)
 
     def _on_message(self, ws, message):
-        msg = json.loads(message)
-        if msg['name'] == 'resource.change' and msg['data']:
-            handler = MessageHandler(msg, self.rancher_host, self.rancher_port,
-                                     self.project_id, self.api_token,
-                                     self.templates, self.ssl,
-                                     self.stack, self.services, self.notify)
-            handler.start()
-
+        received = monotonic()
+        if self.recorder is not None:
+            self.recorder.record(message)
+        if not self.event_filter.accept(message):
+            return
 
-class MessageHandler(Thread):
-    def __init__(self, message, host, port, project_id, api_token, templates,
-                 ssl, stack=None, services=None, notify=None):
-        Thread.__init__(self)
+        msg = json_loads(message)
+        msg[RECEIVED] = received
+        if msg['name'] == 'resource.change' and msg['data']:
+            handler = MessageHandler(msg, self.scheduler, self.stack,
+                                     self.services, self.api)
+            if handler.run():
+                self.event_filter.count('scheduled')
+                return
+
+        self.event_filter.count('dropped_handler')
+
+
+def parse_selectors(values):
+    """ Returns the Selector of each template destination, from a list of
+    'DEST:SELECTOR' strings. Selectors that are already parsed, as a dict of
+    Selector by destination, are returned as is. """
+    if isinstance(values, dict):
+        return dict(values)
+    selectors = {}
+    for value in values or []:
+        dest, selector = value.split(':', 1)
+        selectors[dest] = Selector.parse(selector)
+    return selectors
+
+
+class MessageHandler(object):
+    """ Decides whether a websocket message affects the rendered templates.
+
+    Messages are inspected on the websocket thread. Relevant messages are
+    handed to the scheduler, which coalesces them and refreshes the templates
+    on its own worker thread.
+    """
+
+    def __init__(self, message, scheduler, stack=None, services=None,
+                 api=None):
         self.message = message
-        self.rancher_host = host
-        self.rancher_port = port
-        self.project_id = project_id
-        self.api_token = api_token
-        self.templates = templates
-        self.ssl = ssl
+        self.scheduler = scheduler
         self.stack = stack
         self.services = services
-        self.notify = notify
+        self.api = api
 
     def run(self):
+        """ Returns True if the message was handed to the scheduler. """
         resource = self.message['data']['resource']
-        if resource['type'] == 'container' and \
-                resource['state'] in ['running', 'removed', 'stopped']:
+        if resource['type'] in SERVICE_TYPES:
+            if self.api is not None:
+                self.api.invalidate_cache()
+            return False
 
-            api = API(self.rancher_host, self.rancher_port, self.project_id,
-                      self.api_token, self.ssl)
+        if resource['type'] == 'container' and \
+                resource['state'] in CONTAINER_STATES:
 
             # Filter by stack and/or service name if specified
             if self.stack:
@@ -145,14 +488,14 @@ class MessageHandler(Thread):
                 # message has to do with one of those instances, then we
                 # need to ignore it.
                 if resource['labels'] is None:
-                    return
+                    return False
 
                 # For some reason, when a new host is added to rancher, and
                 # when containers are being deployed to it, some of these
                 # containers don't have the io.rancher.stack.name label. So,
                 # check here to ensure they have it. Otherwise, return.
                 if 'io.rancher.stack.name' not in resource['labels']:
-                    return
+                    return False
 
                 stack_name = resource['labels']['io.rancher.stack.name']
                 service_name =\
@@ -161,49 +504,23 @@ class MessageHandler(Thread):
 
                 # if the stacks don't match, then simply return
                 if stack_name != self.stack:
-                    return
+                    return False
 
-                # If we're filtering by service, then load the instances for
-                # this sevice
+                # If we're filtering by service, ignore other services
                 if self.services and len(self.services) > 0:
                     if service_name not in self.services:
-                        return
-
-                    services = api.get_services(self.stack, self.services)
-                    instances = []
-                    if len(services) > 0:
-                        for service in services:
-                            instances += api.get_instances(service)
-                        self._render_and_notify(instances)
-                        return
-
-                instances = api.get_instances(stack_name=self.stack)
-                self._render_and_notify(instances)
-            else:
-                instances = api.get_instances()
-                self._render_and_notify(instances)
-
-    def _render_and_notify(self, instances):
-        if instances is None:
-            render_templates([], self.templates)
-        else:
-            render_templates(instances, self.templates)
-        notify(self.notify)
-
-
-def render_templates(instances, templates):
-    for template in templates:
-        source, dest = template.split(':')
-
-        template_dir = os.path.dirname(source)
-        template_filename = os.path.basename(source)
-        env = Environment(loader=FileSystemLoader(template_dir))
-        template = env.get_template(template_filename)
-        result = template.render(containers=instances)
-
-        with open(dest, 'w') as fh:
-            fh.write(result)
-        logger.info("Generated '{0}'".format(dest))
+                        return False
+
+            self.scheduler.schedule(self.message)
+            return True
+
+        return False
+
+
+def render_templates(instances, templates, renderer=None):
+    if renderer is None:
+        renderer = default_renderer
+    return renderer.render(instances, templates)
 
 
 def notify(notify):
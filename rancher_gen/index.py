@@ -0,0 +1,259 @@
+"""
+Lookup indexes over the containers, which are passed to the templates along
+with the list of containers.
+"""
+from __future__ import absolute_import
+
+import logging
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import RLock
+
+logger = logging.getLogger(__name__)
+
+# Health states of running containers that are considered healthy. Containers
+# without a health check have no health state.
+HEALTHY_STATES = (None, 'healthy')
+
+# The indexes, and how many keys deep they are
+INDEXES = OrderedDict([
+    ('by_service', 1),
+    ('by_stack', 1),
+    ('by_host', 1),
+    ('by_label', 2),
+])
+
+# The lists of containers, besides the indexes
+LISTS = ('containers', 'running', 'healthy')
+
+# The variables of each project, passed to the templates rendered with the
+# containers of several projects
+PROJECTS = 'projects'
+
+# Container fields, other than the labels and state, the lists and indexes are
+# built from
+INDEX_FIELDS = {
+    'healthy': ('healthState',),
+    'by_host': ('hostId',),
+}
+
+
+class ContainerIndex(object):
+    """ Groups containers by service, stack, host and label.
+
+    The index is kept up to date one container at a time. The variables
+    passed to the templates are updated in place, only for the groups the
+    container is in, and `version` is incremented whenever they change.
+
+    The templates get the following variables:
+        - containers: Every container.
+        - running: The running containers.
+        - healthy: The running containers that pass their health check, or
+            don't have one.
+        - by_service: The containers by 'stack/service' name.
+        - by_stack: The containers by stack name.
+        - by_host: The containers by host id.
+        - by_label: The containers by label name, and then label value.
+
+    Containers keep the order they were added in, in every list.
+
+    Args:
+        - containers: The initial list of containers.
+    """
+
+    def __init__(self, containers=None):
+        self._lock = RLock()
+        self.version = 0
+        self.reset(containers or [])
+
+    def __len__(self):
+        return len(self._groups.get(('containers',), ()))
+
+    def reset(self, containers):
+        """ Rebuilds the index from a full list of containers. """
+        with self._lock:
+            self._groups = {}
+            self._keys = {}
+            # The order each container was added in, and the orders of the
+            # containers of each group
+            self._order = {}
+            self._orders = {}
+            self._next = 0
+            self._context = dict((name, []) for name in LISTS)
+            for name in INDEXES:
+                self._context[name] = {}
+            self.version += 1
+            for container in containers:
+                self._add(container['id'], container)
+
+    def update(self, container):
+        """ Adds a container, or replaces the one with the same id. """
+        with self._lock:
+            self._add(container['id'], container)
+
+    def remove(self, container_id):
+        with self._lock:
+            for key in self._keys.pop(container_id, ()):
+                self._discard(key, container_id)
+            self._order.pop(container_id, None)
+
+    def instances(self):
+        """ Returns the list of every container. """
+        return list(self.context()['containers'])
+
+    def context(self):
+        """ Returns the variables passed to the templates. The same dict is
+        returned until the index is reset, and is updated in place as
+        containers change. """
+        with self._lock:
+            return self._context
+
+    def _add(self, container_id, container):
+        keys = _group_keys(container)
+        for key in set(self._keys.get(container_id, ())) - set(keys):
+            self._discard(key, container_id)
+
+        # Every list is sorted by the order the containers were added in, so
+        # the position of a container in a group is found by bisecting the
+        # orders of the group
+        order = self._order.get(container_id)
+        if order is None:
+            order = self._order[container_id] = self._next
+            self._next += 1
+
+        for key in keys:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = []
+                self._orders[key] = []
+                self._insert(key, group)
+            orders = self._orders[key]
+            position = bisect_left(orders, order)
+            if position < len(orders) and orders[position] == order:
+                group[position] = container
+            else:
+                orders.insert(position, order)
+                group.insert(position, container)
+        self._keys[container_id] = keys
+        self.version += 1
+
+    def _discard(self, key, container_id):
+        orders = self._orders.get(key)
+        order = self._order.get(container_id)
+        if orders is None or order is None:
+            return
+        position = bisect_left(orders, order)
+        if position == len(orders) or orders[position] != order:
+            return
+        group = self._groups[key]
+        del orders[position]
+        del group[position]
+        if not group:
+            del self._groups[key]
+            del self._orders[key]
+            self._delete(key)
+        self.version += 1
+
+    def _insert(self, key, group):
+        """ Adds the list of a new group to the context. """
+        if len(key) == 1:
+            self._context[key[0]] = group
+            return
+        target = self._context[key[0]]
+        for part in key[1:-1]:
+            target = target.setdefault(part, {})
+        target[key[-1]] = group
+
+    def _delete(self, key):
+        """ Removes the list of an empty group from the context, along with
+        the tables it leaves empty, e.g the values of a label. """
+        if len(key) == 1:
+            self._context[key[0]] = []
+            return
+        tables = [self._context[key[0]]]
+        for part in key[1:-1]:
+            tables.append(tables[-1][part])
+        del tables[-1][key[-1]]
+        for table, part in reversed(list(zip(tables, key[1:-1]))):
+            if table[part]:
+                break
+            del table[part]
+
+
+def _group_keys(container):
+    labels = container.get('labels') or {}
+
+    keys = [('containers',)]
+    if container.get('state') == 'running':
+        keys.append(('running',))
+        if container.get('healthState') in HEALTHY_STATES:
+            keys.append(('healthy',))
+
+    service = labels.get('io.rancher.stack_service.name')
+    if service:
+        keys.append(('by_service', service))
+    stack = labels.get('io.rancher.stack.name')
+    if stack:
+        keys.append(('by_stack', stack))
+    host = container.get('hostId')
+    if host:
+        keys.append(('by_host', host))
+    for name, value in labels.items():
+        keys.append(('by_label', name, value))
+
+    return keys
+
+
+class AggregateIndex(ContainerIndex):
+    """ Merges the indexes of several projects.
+
+    The templates get the lists and indexes of every project merged together,
+    in the order the projects were given, and `projects` with the variables
+    of each project by name.
+
+    Args:
+        - indexes: An OrderedDict of the ContainerIndex of each project, by
+            project name.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self._versions = None
+        super(AggregateIndex, self).__init__()
+
+    def __len__(self):
+        return len(self.context()['containers'])
+
+    def context(self):
+        with self._lock:
+            # The projects are only merged again when one of them changed
+            versions = [index.version for index in self.indexes.values()]
+            if versions != self._versions:
+                sources = [index.context() for index in self.indexes.values()]
+                self._context = _merge(sources)
+                self._context[PROJECTS] = OrderedDict(
+                    zip(self.indexes.keys(), sources))
+                self._versions = versions
+                self.version += 1
+            return self._context
+
+
+def _merge(contexts):
+    merged = dict((name, []) for name in LISTS)
+    for name in INDEXES:
+        merged[name] = {}
+
+    for context in contexts:
+        for name in LISTS:
+            merged[name].extend(context[name])
+        for name, depth in INDEXES.items():
+            _merge_index(merged[name], context[name], depth)
+    return merged
+
+
+def _merge_index(target, source, depth):
+    for key, value in source.items():
+        if depth == 1:
+            target.setdefault(key, []).extend(value)
+        else:
+            _merge_index(target.setdefault(key, {}), value, depth - 1)
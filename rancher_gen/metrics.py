@@ -0,0 +1,284 @@
+"""
+Metrics about the event -> render -> notify pipeline, exposed over HTTP in
+the Prometheus text format.
+"""
+from __future__ import absolute_import
+
+import logging
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+from .compat import (BaseHTTPRequestHandler, HTTPServer, ThreadingMixIn,
+                     monotonic)
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+                   1.0, 2.5, 5.0, 7.5, 10.0, float('inf'))
+
+
+class Registry(object):
+    """ A collection of metrics that are exposed together. """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def unregister(self, metric):
+        with self._lock:
+            if metric in self._metrics:
+                self._metrics.remove(metric)
+
+    def expose(self):
+        """ Returns the metrics in the Prometheus text format. """
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(
+                metric.name, metric.help.replace('\\', r'\\')
+                .replace('\n', r'\n')))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+# Every metric of the app is registered here
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """ Base class of the metrics, which can be split by labels.
+
+    Args:
+        - name: The name of the metric.
+        - help: A description of the metric.
+        - labelnames: The names of the labels the metric is split by.
+        - registry: The registry to add the metric to.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Expected labels {0}, got {1}"
+                             .format(self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format(self, name, key, value, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        labels = ''
+        if pairs:
+            labels = '{' + ','.join(
+                '{0}="{1}"'.format(label, _escape(val))
+                for label, val in pairs) + '}'
+        return '{0}{1} {2}'.format(name, labels, _format_value(value))
+
+
+class Counter(Metric):
+    """ A value that only goes up. """
+
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [self._format(self.name, key, value) for key, value in values]
+
+
+class CounterMap(Metric):
+    """ Exposes a `collections.Counter` kept by another object as a counter,
+    with one sample per key.
+
+    Args:
+        - name: The name of the metric.
+        - help: A description of the metric.
+        - labelname: The name of the label the keys are exposed as.
+        - counters: The Counter to expose, or a function returning it.
+        - registry: The registry to add the metric to.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelname, counters, registry=REGISTRY):
+        self.counters = counters
+        super(CounterMap, self).__init__(name, help, (labelname,), registry)
+
+    def samples(self):
+        counters = self.counters
+        if callable(counters):
+            counters = counters()
+        values = sorted(dict(counters).items())
+        return [self._format(self.name, (key,), value)
+                for key, value in values]
+
+
+class Histogram(Metric):
+    """ Counts observations (e.g durations) in buckets.
+
+    Args:
+        - name: The name of the metric.
+        - help: A description of the metric.
+        - labelnames: The names of the labels the metric is split by.
+        - buckets: The upper bounds of the buckets, in increasing order.
+        - registry: The registry to add the metric to.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        buckets = tuple(float(bound) for bound in buckets)
+        if buckets[-1] != float('inf'):
+            buckets += (float('inf'),)
+        self.buckets = buckets
+        super(Histogram, self).__init__(name, help, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observes how long the block takes to run. """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def count(self, **labels):
+        counts, total = self._values.get(self._key(labels), ([], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(self._format(
+                    self.name + '_bucket', key, cumulative,
+                    [('le', _format_value(bound))]))
+            samples.append(self._format(self.name + '_sum', key, total))
+            samples.append(self._format(self.name + '_count', key,
+                                        cumulative))
+        return samples
+
+
+EVENT_LATENCY = Histogram(
+    'rancher_gen_event_to_file_seconds',
+    'Seconds from receiving a websocket event to writing the files it '
+    'changed')
+API_LATENCY = Histogram(
+    'rancher_gen_api_request_seconds',
+    'Seconds taken by requests to the rancher API', ['endpoint'])
+API_ERRORS = Counter(
+    'rancher_gen_api_errors_total',
+    'Requests to the rancher API that failed', ['endpoint'])
+RENDER_TIME = Histogram(
+    'rancher_gen_render_seconds',
+    'Seconds taken to render a template', ['template'])
+SKIPPED_WRITES = Counter(
+    'rancher_gen_skipped_writes_total',
+    'Renders whose output was unchanged, so the file was not written',
+    ['template'])
+NOTIFY_DURATION = Histogram(
+    'rancher_gen_notify_seconds',
+    'Seconds taken by notify commands', ['command'])
+EVENTS_COALESCED = Counter(
+    'rancher_gen_events_coalesced_total',
+    'Events that were handled together with an earlier event')
+RECONNECTS = Counter(
+    'rancher_gen_reconnects_total',
+    'Reconnections to the rancher websocket')
+POLLS = Counter(
+    'rancher_gen_polls_total',
+    'Polls of the rancher API, by whether the instances changed',
+    ['result'])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        content = self.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, address='127.0.0.1', registry=REGISTRY):
+    """ Serves the metrics on a daemon thread.
+
+    Returns the server, which can be stopped with `shutdown`.
+    """
+    handler = type('MetricsHandler', (MetricsHandler,),
+                   {'registry': registry})
+    server = MetricsServer((address, port), handler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on http://{0}:{1}/metrics'
+                .format(address, server.server_port))
+    return server
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,371 @@
+"""
+Watches several rancher projects from a single process.
+"""
+from __future__ import absolute_import
+
+import logging
+from collections import Counter, OrderedDict
+from threading import Event, Thread
+
+from .compat import b64encode
+from .handler import RESYNC, RancherConnector
+from .index import AggregateIndex
+from .metrics import EVENTS_COALESCED
+from .rancher import create_session
+from .renderer import TemplateRenderer, parse_template
+from .scheduler import EventScheduler, Notifier, Ticker
+
+logger = logging.getLogger(__name__)
+
+
+class Project(object):
+    """ A project watched by a MultiConnector.
+
+    Args:
+        - project_id: The Rancher project (environment) id.
+        - templates: Templates rendered with the containers of this project
+            only.
+        - stack: The name of the stack to watch.
+        - services: A list of service names to watch within the stack.
+        - selectors: 'DEST:SELECTOR' strings, like the --selector option,
+            or a dict of Selector by destination.
+        - name: The name of the project in the `projects` variable of the
+            templates. Defaults to the project id.
+        - snapshot: The snapshot file of the project.
+        - record: The file to record the events of the project to.
+    """
+
+    def __init__(self, project_id, templates=None, stack=None,
+                 services=None, selectors=None, name=None, snapshot=None,
+                 record=None):
+        self.project_id = project_id
+        self.templates = [parse_template(template)
+                          for template in templates or []]
+        self.stack = stack
+        self.services = services
+        self.selectors = selectors
+        self.name = name or project_id
+        self.snapshot = snapshot
+        self.record = record
+
+
+class MultiConnector(object):
+    """ Watches several projects of a Rancher server.
+
+    Each project has its own websocket, filters and templates, but the
+    projects share the connection pool to the server, the scheduler that
+    coalesces their events, the renderer and its template cache, and the
+    notify commands, which run once per batch of events no matter how many
+    projects changed.
+
+    `templates` are rendered with the containers of every project. They get
+    the lists and indexes of all the projects merged together, and
+    `projects` with the variables of each project by name.
+
+    Args:
+        - host: The Rancher host.
+        - port: The Rancher port.
+        - access_key: The Rancher access key.
+        - secret_key: The Rancher secret key.
+        - projects: The list of Project to watch.
+        - templates: Templates rendered with the containers of every project.
+
+    The other arguments are the same as RancherConnector's.
+    """
+
+    def __init__(self, host, port, access_key, secret_key, projects,
+                 templates=None, ssl=False, notify=None, debounce=0.5,
+                 max_wait=5.0, resync_interval=300, pool_size=10, timeout=30,
+                 page_size=100, cache_ttl=60, bytecode_cache_dir=None,
+                 stream=False, render_processes=0, reconnect_delay=1,
+                 max_reconnect_delay=60, fields=None, projection=True):
+        names = [project.name for project in projects]
+        if len(set(names)) != len(names):
+            raise ValueError('Project names must be unique: {0}'
+                             .format(', '.join(names)))
+
+        self.rancher_host = host
+        self.rancher_port = port
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.templates = [parse_template(template)
+                          for template in templates or []]
+        self.ssl = ssl
+        self.notify = notify
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.page_size = page_size
+        self.cache_ttl = cache_ttl
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.fields = fields
+        self.projection = projection
+        self.session = create_session(
+            b64encode("{0}:{1}".format(access_key, secret_key)), pool_size)
+        self.renderer = TemplateRenderer(bytecode_cache_dir, stream,
+                                         render_processes)
+        self.notifier = Notifier()
+        self.commands = _Commands()
+        self.scheduler = EventScheduler(self._on_events, debounce, max_wait)
+        self.resync_ticker = Ticker(
+            resync_interval,
+            lambda: self.scheduler.schedule((None, RESYNC)))
+        self.connectors = [ProjectConnector(self, project)
+                           for project in projects]
+        self.index = AggregateIndex(OrderedDict(
+            (connector.project.name, connector.store.index)
+            for connector in self.connectors))
+        self._versions = None
+        self._stopped = Event()
+        self._watching = False
+
+    def __call__(self):
+        self._prerender()
+        self.start()
+
+    def counters(self):
+        """ Returns the number of websocket events of every project, by the
+        stage they were dropped at. """
+        counters = Counter()
+        for connector in self.connectors:
+            counters.update(connector.counters())
+        return counters
+
+    def start(self):
+        self.scheduler.start()
+        self.resync_ticker.start()
+        logger.info('Watching for rancher events of {0} projects'
+                    .format(len(self.connectors)))
+        self._watching = True
+        try:
+            for connector in self.connectors:
+                self._start_watching(connector)
+
+            # Wait with a timeout, so that KeyboardInterrupt is raised
+            while not self._stopped.wait(1):
+                pass
+        finally:
+            self._watching = False
+            self.stop()
+            self.resync_ticker.stop()
+            self.scheduler.stop()
+            self.renderer.close()
+            self.session.close()
+
+    def stop(self):
+        """ Stops watching for events. """
+        self._stopped.set()
+        for connector in list(self.connectors):
+            connector.stop()
+
+    def schedule_call(self, function):
+        """ Runs `function` on the scheduler thread, before the next batch of
+        events is handled. """
+        self.scheduler.schedule((None, function))
+
+    def configure(self, config):
+        """ Applies the settings of a new config.Config, e.g after the config
+        file changed.
+
+        The websockets of the projects whose id and filters are unchanged are
+        kept open, and only the files whose output changed are written. The
+        settings of the connections to rancher (host, keys, ssl, pool_size)
+        and of the renderer (bytecode_cache, stream, render_processes) only
+        change on restart.
+
+        It must be called from the scheduler thread, e.g with
+        `schedule_call`, or before the app is started.
+        """
+        self.notify = config.notify
+        self.fields = config.fields
+        self.projection = config.projection
+        self.timeout = config.timeout
+        self.page_size = config.page_size
+        self.cache_ttl = config.cache_ttl
+        self.reconnect_delay = config.reconnect_delay
+        self.max_reconnect_delay = config.max_reconnect_delay
+        self.scheduler.debounce = config.debounce
+        self.scheduler.max_wait = max(config.max_wait, config.debounce)
+        if self.resync_ticker.interval != config.resync_interval:
+            self.resync_ticker.stop()
+            self.resync_ticker.interval = config.resync_interval
+            if self._watching:
+                self.resync_ticker.start()
+
+        current = dict((connector.project.name, connector)
+                       for connector in self.connectors)
+        connectors = []
+        for project in config.projects:
+            connector = current.pop(project.name, None)
+            if connector is not None and \
+                    _watch_key(connector.project) == _watch_key(project):
+                connector.project = project
+                connector.fields = self.fields
+                connector.projection = self.projection
+                connector.api.timeout = self.timeout
+                connector.api.page_size = self.page_size
+                connector.api.cache_ttl = self.cache_ttl
+                connector.backoff.base = self.reconnect_delay
+                connector.backoff.maximum = self.max_reconnect_delay
+                connector.configure(project.templates, project.selectors,
+                                    self.notify)
+            else:
+                if connector is not None:
+                    logger.info("Restarting project '{0}'"
+                                .format(project.name))
+                    connector.stop()
+                else:
+                    logger.info("Adding project '{0}'".format(project.name))
+                connector = ProjectConnector(self, project)
+                connector._prerender()
+                if self._watching:
+                    self._start_watching(connector)
+            connectors.append(connector)
+
+        for name, connector in current.items():
+            logger.info("Removing project '{0}'".format(name))
+            connector.stop()
+
+        self.connectors = connectors
+        self.templates = list(config.templates)
+        self.index = AggregateIndex(OrderedDict(
+            (connector.project.name, connector.store.index)
+            for connector in self.connectors))
+        self._versions = None
+        self._render_and_notify()
+
+    def _start_watching(self, connector):
+        thread = Thread(target=connector._watch,
+                        name='rancher-gen-{0}'.format(connector.project.name))
+        thread.daemon = True
+        thread.start()
+
+    def _prerender(self):
+        for connector in self.connectors:
+            connector._prerender()
+        self._render_and_notify()
+
+    def _on_events(self, events):
+        for connector, event in events:
+            if callable(event):
+                try:
+                    event()
+                except Exception as e:
+                    logger.exception(e)
+        events = [(connector, event) for connector, event in events
+                  if not callable(event)]
+        if not events:
+            return
+
+        # Resyncs requested by the ticker apply to every project
+        groups = OrderedDict()
+        for connector, event in events:
+            targets = self.connectors if connector is None else [connector]
+            for target in targets:
+                groups.setdefault(target, []).append(event)
+
+        # Each project counts the events it coalesced, so only count the
+        # events coalesced across projects.
+        handled = sum(len(group) for group in groups.values())
+        EVENTS_COALESCED.inc(len(events) - 1 - (handled - len(groups)))
+
+        for connector, group in groups.items():
+            try:
+                connector._on_events(group)
+            except Exception as e:
+                logger.exception(e)
+        self._render_and_notify()
+
+    def _render_and_notify(self):
+        """ Renders the templates of every project if the containers of a
+        project changed, and runs the notify commands requested by the
+        projects. """
+        try:
+            if self.templates:
+                self._render()
+        finally:
+            self.notifier.notify(self.commands.flush())
+
+    def _render(self):
+        # Containers missing fields used by the templates are never rendered
+        for connector in self.connectors:
+            if connector._fields_changed() and \
+                    not connector._reload_fields():
+                return
+
+        # The version of the index of a project changes with its containers
+        versions = [connector.store.index.version
+                    for connector in self.connectors]
+        if versions == self._versions:
+            return
+        self._versions = versions
+
+        commands = dict((template.dest, template.command or self.notify)
+                        for template in self.templates)
+        changed = self.renderer.render_jobs([(self.index, template)
+                                             for template in self.templates])
+        self.commands.notify([commands[dest] for dest in changed])
+
+
+class ProjectConnector(RancherConnector):
+    """ The connector of one project of a MultiConnector, which hands its
+    events, renders and notify commands to the shared ones. """
+
+    def __init__(self, multi, project):
+        self.multi = multi
+        self.project = project
+        super(ProjectConnector, self).__init__(
+            multi.rancher_host, multi.rancher_port, project.project_id,
+            multi.access_key, multi.secret_key, project.templates, multi.ssl,
+            project.stack, project.services, multi.notify,
+            resync_interval=0, pool_size=multi.pool_size,
+            timeout=multi.timeout, page_size=multi.page_size,
+            cache_ttl=multi.cache_ttl, selectors=project.selectors,
+            reconnect_delay=multi.reconnect_delay,
+            max_reconnect_delay=multi.max_reconnect_delay,
+            snapshot=project.snapshot, fields=multi.fields,
+            record=project.record, session=multi.session,
+            projection=multi.projection)
+        self.renderer = multi.renderer
+        self.notifier = multi.commands
+        self.scheduler = _ProjectScheduler(multi.scheduler, self)
+
+    def _container_fields(self, templates=None):
+        # The containers are also rendered by the templates of every project
+        if templates is None:
+            templates = self.templates + self.multi.templates
+        return super(ProjectConnector, self)._container_fields(templates)
+
+
+def _watch_key(project):
+    """ Returns the settings of a project that need a new websocket when they
+    change. """
+    return (project.project_id, project.stack, project.services,
+            project.snapshot, project.record)
+
+
+class _ProjectScheduler(object):
+    """ Hands the events of a project to the scheduler shared by every
+    project. """
+
+    def __init__(self, scheduler, connector):
+        self.scheduler = scheduler
+        self.connector = connector
+
+    def schedule(self, event=None):
+        self.scheduler.schedule((self.connector, event))
+
+
+class _Commands(object):
+    """ Collects the notify commands requested while handling a batch of
+    events, so that each one only runs once per batch. """
+
+    def __init__(self):
+        self.commands = []
+
+    def notify(self, commands):
+        self.commands.extend(commands)
+
+    def flush(self):
+        commands, self.commands = self.commands, []
+        return commands
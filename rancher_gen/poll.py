@@ -0,0 +1,100 @@
+"""
+Polls the instances of a project from the rancher API, for networks where
+the websocket can't be kept open.
+"""
+from __future__ import absolute_import
+
+import logging
+
+from .exception import RancherConnectionError
+from .handler import RESYNC, RancherConnector
+from .metrics import POLLS
+
+logger = logging.getLogger(__name__)
+
+# Event scheduled to poll the instances from rancher
+POLL = 'poll'
+
+
+class PollingConnector(RancherConnector):
+    """ A RancherConnector that polls the instances of the project every
+    `interval` seconds, instead of reading events from the websocket.
+
+    The pages of the instances are requested with the ETag of their last
+    copy, so when nothing changed the server answers each of them with an
+    empty 304 response and nothing is rendered. When a page changed, the
+    instances are diffed against the store and only the templates whose
+    containers changed are rendered again, as they would be for websocket
+    events.
+
+    It takes the same arguments as RancherConnector, and:
+        - interval: Seconds between polls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.interval = kwargs.pop('interval', 10)
+        super(PollingConnector, self).__init__(*args, **kwargs)
+        self.api.conditional = True
+
+    def _watch(self):
+        """ Schedules a poll every `interval` seconds until stopped. Polls
+        run on the scheduler thread, like the websocket events. """
+        logger.info('Polling rancher every {0} seconds'.format(self.interval))
+        while not self._stopped.wait(self.interval):
+            self.scheduler.schedule(POLL)
+
+    def _on_events(self, events):
+        # Resyncs reload every instance anyway
+        if POLL in events and RESYNC not in events and self.store.seeded:
+            self._poll()
+            return
+        super(PollingConnector, self)._on_events(events)
+
+    def _poll(self):
+        """ Loads the instances, and applies the ones that changed since the
+        last poll to the store.
+
+        Returns whether the store was updated.
+        """
+        downloaded = self.api.pages_downloaded
+        try:
+            instances = list(self._iter_instances())
+        except RancherConnectionError:
+            POLLS.inc(result='failed')
+            return False
+        finally:
+            self.api.forget_unused_pages()
+
+        if self.api.pages_downloaded == downloaded:
+            POLLS.inc(result='unchanged')
+            logger.debug('No changes since the last poll')
+            return False
+
+        changed, updated, _ = self._apply_events(
+            diff_events(self.store, instances))
+        POLLS.inc(result='changed' if updated else 'unchanged')
+        if changed:
+            self._render_and_notify(changed)
+        if updated:
+            self._save_snapshot()
+        return updated
+
+
+def diff_events(store, instances):
+    """ Returns the change events turning the containers of a
+    ContainerStore into `instances`.
+
+    Every instance is returned, as the store ignores the ones that didn't
+    change, along with a 'removed' event for each container that is gone.
+    """
+    seen = set()
+    events = []
+    for instance in instances:
+        seen.add(instance['id'])
+        events.append({'data': {'resource': instance}})
+
+    for container in store.instances():
+        if container['id'] not in seen:
+            events.append({'data': {'resource': {
+                'id': container['id'], 'state': 'removed'}}})
+    return events
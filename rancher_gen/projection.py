@@ -0,0 +1,239 @@
+"""
+Finds the container fields used by templates, so the containers can be
+projected to only those fields.
+"""
+from __future__ import absolute_import
+
+import logging
+
+from jinja2 import meta, nodes
+from jinja2.exceptions import TemplateError
+
+from .compat import string_types
+from .index import INDEX_FIELDS, INDEXES, LISTS, PROJECTS
+
+logger = logging.getLogger(__name__)
+
+# Fields that are always kept, since they're used to track the containers
+REQUIRED_FIELDS = frozenset(['id', 'state', 'labels'])
+
+# Filters that return a subset of the containers they're applied to
+LIST_FILTERS = ('selectattr', 'rejectattr', 'sort', 'unique', 'reverse',
+                'list')
+
+# Filters that only count the containers they're applied to
+COUNT_FILTERS = ('length', 'count')
+
+# Methods of the containers, which Jinja2 looks up before their fields, e.g
+# `container.get('name')` or `container.items()`
+CONTAINER_METHODS = frozenset(name for name in dir(dict)
+                              if not name.startswith('_'))
+
+# Attributes of the loop variable that are the containers of other
+# iterations
+LOOP_ITEMS = ('previtem', 'nextitem')
+
+
+class UnsafeTemplate(Exception):
+    """ The template may use fields that can't be found statically. """
+
+
+def project(container, fields):
+    """ Returns a copy of the container with only the specified fields. """
+    if fields is None:
+        return container
+    return dict((key, value) for key, value in container.items()
+                if key in fields)
+
+
+def find_fields(env, name):
+    """ Finds the container fields used by a template.
+
+    Containers are expected to be accessed by looping over `containers`, or
+    one of the lists and indexes of a ContainerIndex (optionally through
+    filters like selectattr or sort), and then looking up fields with
+    constant names, e.g `container.primaryIpAddress` or
+    `container['labels']`. Included templates are analysed too.
+
+    Returns a tuple with the set of field names, or None if the template may
+    use any field (e.g it outputs whole containers), and the list of files
+    the result depends on.
+    """
+    fields = set(REQUIRED_FIELDS)
+    files = []
+    try:
+        _analyse(env, name, set(), fields, files, set())
+    except UnsafeTemplate as e:
+        logger.debug("Can't project the containers of '{0}': {1}"
+                     .format(name, e))
+        return None, files
+    except TemplateError as e:
+        logger.debug("Unable to analyse '{0}': {1}".format(name, e))
+        return None, files
+    return fields, files
+
+
+def _analyse(env, name, record_names, fields, files, seen):
+    if name in seen:
+        return
+    seen.add(name)
+
+    source, filename, uptodate = env.loader.get_source(env, name)
+    files.append(filename)
+    ast = env.parse(source)
+
+    parents = {}
+    for node, parent in _walk(ast, None):
+        parents[id(node)] = parent
+
+    for node in ast.find_all(nodes.Name):
+        if node.name == PROJECTS:
+            raise UnsafeTemplate('containers are used per project')
+        if node.name == 'loop' and _is_loop_item(node, parents[id(node)]):
+            raise UnsafeTemplate('containers are used through the loop '
+                                 'variable')
+        for field in INDEX_FIELDS.get(node.name, ()):
+            fields.add(field)
+
+    # Find the names bound to containers by loops over lists of containers,
+    # and the names bound to lists of containers by loops over the indexes.
+    record_names = set(record_names)
+    list_names = set(LISTS)
+    loops = list(ast.find_all(nodes.For))
+    found = True
+    while found:
+        found = False
+        for loop in loops:
+            if _is_container_list(loop.iter, list_names, fields):
+                if not isinstance(loop.target, nodes.Name):
+                    raise UnsafeTemplate('containers are unpacked in a loop')
+                found |= loop.target.name not in record_names
+                record_names.add(loop.target.name)
+            elif _is_group_loop(loop):
+                group_name = loop.target.items[1].name
+                found |= group_name not in list_names
+                list_names.add(group_name)
+
+    for node in ast.find_all(nodes.Name):
+        if node.ctx != 'load':
+            continue
+        parent = parents[id(node)]
+        if node.name in record_names:
+            fields.add(_field_name(node, parent))
+        elif node.name in list_names or node.name in INDEXES:
+            _check_list_use(node, parents)
+
+    for referenced in meta.find_referenced_templates(ast):
+        if referenced is None:
+            raise UnsafeTemplate('templates are included dynamically')
+        _analyse(env, referenced, record_names, fields, files, seen)
+
+
+def _walk(node, parent):
+    stack = [(node, parent)]
+    while stack:
+        node, parent = stack.pop()
+        yield node, parent
+        for child in node.iter_child_nodes():
+            stack.append((child, node))
+
+
+def _index_depth(node):
+    """ Returns the number of keys still needed to get a list of containers
+    out of an index, or None if the node is not an index. """
+    if isinstance(node, nodes.Name):
+        return INDEXES.get(node.name)
+    if isinstance(node, nodes.Getitem):
+        depth = _index_depth(node.node)
+        if depth:
+            return depth - 1
+    return None
+
+
+def _is_container_list(node, list_names, fields):
+    """ Returns True if node evaluates to a list of containers. """
+    while isinstance(node, nodes.Filter) and node.name in LIST_FILTERS:
+        _add_filter_fields(node, fields)
+        node = node.node
+    if isinstance(node, nodes.Name) and node.name in list_names:
+        return True
+    return _index_depth(node) == 0
+
+
+def _is_index_items(node):
+    """ Returns True if node evaluates to the (key, containers) pairs of an
+    index, e.g `by_service.items()` or `by_stack | dictsort`. """
+    if isinstance(node, nodes.Filter) and node.name == 'dictsort':
+        return _index_depth(node.node) == 1
+    if isinstance(node, nodes.Call) and not node.args and \
+            isinstance(node.node, nodes.Getattr) and \
+            node.node.attr == 'items':
+        return _index_depth(node.node.node) == 1
+    return False
+
+
+def _is_group_loop(node):
+    """ Returns True if node is a loop like
+    `for key, containers in by_service.items()`. """
+    return isinstance(node, nodes.For) and _is_index_items(node.iter) and \
+        isinstance(node.target, nodes.Tuple) and \
+        len(node.target.items) == 2 and \
+        isinstance(node.target.items[1], nodes.Name)
+
+
+def _add_filter_fields(node, fields):
+    # The attributes used by filters like selectattr('state') or
+    # sort(attribute='labels.tier')
+    args = list(node.args) + [kwarg.value for kwarg in node.kwargs]
+    for arg in args:
+        if isinstance(arg, nodes.Const) and \
+                isinstance(arg.value, string_types):
+            fields.add(arg.value.split('.')[0])
+
+
+def _is_loop_item(node, parent):
+    return isinstance(parent, nodes.Getattr) and parent.node is node and \
+        parent.attr in LOOP_ITEMS
+
+
+def _field_name(node, parent):
+    if isinstance(parent, nodes.Getattr) and parent.node is node:
+        if parent.attr in CONTAINER_METHODS:
+            raise UnsafeTemplate("'{0}.{1}' is a method of the containers"
+                                 .format(node.name, parent.attr))
+        return parent.attr
+    if isinstance(parent, nodes.Getitem) and parent.node is node and \
+            isinstance(parent.arg, nodes.Const) and \
+            isinstance(parent.arg.value, string_types):
+        return parent.arg.value
+    raise UnsafeTemplate("'{0}' is used as a whole".format(node.name))
+
+
+def _check_list_use(node, parents):
+    name = node.name
+
+    # Walk up the keys looked up in an index
+    parent = parents[id(node)]
+    while isinstance(parent, nodes.Getitem) and parent.node is node and \
+            _index_depth(parent) is not None:
+        node = parent
+        parent = parents[id(node)]
+
+    # Loops over the (key, containers) pairs of an index
+    if isinstance(parent, nodes.Getattr) and parent.attr == 'items':
+        parent = parents[id(parent)]
+    if _is_index_items(parent) and _is_group_loop(parents[id(parent)]):
+        return
+
+    # Walk up the filters applied to the containers
+    while isinstance(parent, nodes.Filter) and parent.node is node:
+        if parent.name in COUNT_FILTERS:
+            return
+        if parent.name not in LIST_FILTERS:
+            break
+        node = parent
+        parent = parents[id(node)]
+
+    if isinstance(parent, nodes.For) and parent.iter is node:
+        return
+    raise UnsafeTemplate("'{0}' is used as a whole".format(name))
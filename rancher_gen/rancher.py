@@ -1,32 +1,122 @@
 from __future__ import absolute_import
 import logging
+import re
 import requests
-from requests.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import ConnectionError, Timeout
+from threading import Lock
 
-from .exception import RancherConnectionError
+from .compat import monotonic, urlparse
+from .exception import RancherAPIError, RancherConnectionError
+from .metrics import API_ERRORS, API_LATENCY
 
 logger = logging.getLogger(__name__)
 
+# Ids of rancher resources, e.g 1a5 or 1s134
+RESOURCE_ID_RE = re.compile(r'^[0-9]+[a-z]+[0-9]+$')
+
 
 class API(object):
+    """ Client for the Rancher v1 API.
+
+    Requests are sent through a single `requests.Session`, so connections
+    (and TLS sessions) to the Rancher server are kept alive and reused. An
+    instance is meant to be long-lived and shared by everything that talks to
+    the same project.
 
-    def __init__(self, host, port, project_id, api_token, ssl):
+    Args:
+        - host: The Rancher host
+        - port: The Rancher port
+        - project_id: The Rancher project (environment) id
+        - api_token: The base64 encoded access and secret keys
+        - ssl: Whether to use https
+        - pool_size: Maximum number of connections kept open to the server
+        - timeout: Seconds to wait to connect to, and read from, the server
+        - page_size: Number of items requested per page of a collection
+        - cache_ttl: Seconds stacks and services are cached for
+        - session: A session from `create_session` to share with other
+            clients of the same server, instead of opening a new one
+        - conditional: Whether to keep the pages of the collections along
+            with their ETag, and only download them again if they changed
+    """
+
+    def __init__(self, host, port, project_id, api_token, ssl, pool_size=10,
+                 timeout=30, page_size=100, cache_ttl=60, session=None,
+                 conditional=False):
         self.host = host
         self.port = port
         self.project_id = project_id
         self.api_token = api_token
         self.ssl = ssl
-        self._headers = {
-            'Authorization': 'Basic {0}'.format(api_token)
-        }
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.page_size = page_size
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._cache_lock = Lock()
         self._protocol = 'https' if ssl else 'http'
 
+        # Pages of the collections by url and parameters, with their ETag
+        self.conditional = conditional
+        self.pages_downloaded = 0
+        self._pages = {}
+        self._pages_used = set()
+        self._pages_lock = Lock()
+
+        # A shared session is closed by whoever created it
+        self._owns_session = session is None
+        if session is None:
+            session = create_session(api_token, pool_size)
+        self.session = session
+
+    def close(self):
+        if self._owns_session:
+            self.session.close()
+
+    def invalidate_cache(self):
+        """ Drops the cached stacks and services. """
+        with self._cache_lock:
+            self._cache.clear()
+
+    def forget_unused_pages(self):
+        """ Drops the pages of the collections that were not requested since
+        the last call, e.g pages whose pagination marker changed. """
+        with self._pages_lock:
+            for key in list(self._pages):
+                if key not in self._pages_used:
+                    del self._pages[key]
+            self._pages_used = set()
+
     def get_services(self, stack, services):
-        _services = []
+        """ Gets a list of services from a stack.
+
+        All the services are resolved with at most one request for the stack
+        and one request for its services. The results are cached for
+        `cache_ttl` seconds. Services that can't be found are returned as
+        None.
+
+        Args:
+            - stack: The name of the stack
+            - services: A list of service names
+        """
+        found = {}
         for service in services:
-            _services.append(self._get_service_from_stack(stack, service))
+            cached = self._cache_get(('service', stack, service))
+            if cached is not None:
+                found[service] = cached
+
+        if len(found) < len(set(services)):
+            service_stack = self._get_stack(stack)
+            if service_stack:
+                url = service_stack['links']['services']
+                for service in self._iter_collection(url):
+                    self._cache_set(('service', stack, service['name']),
+                                    service)
+                    if service['name'] in services:
+                        found[service['name']] = service
 
-        return _services
+        return [found.get(service) for service in services]
 
     def get_service(self, resource=None, stack=None, service=None):
         """ Get a service from a rancher resource or by stack and name.
@@ -58,28 +148,87 @@ class API(object):
             - service: The Rancher object representation of a service
             - stack_name: A stack name
         """
-        if service is None:
-            url = '{0}://{1}:{2}/v1/projects/{3}/instances'\
-                .format(self._protocol, self.host, self.port, self.project_id)
-        else:
-            url = service['links']['instances']
-        res = self._get(url)       
-        res_data = res.json()
-        if res_data['data']:
-            if stack_name is None:
-                return res_data['data']
-
-            instances = []
-            for resource in res_data['data']:
-                labels = resource['labels']
-                if labels and 'io.rancher.stack.name' in labels and \
-                        labels['io.rancher.stack.name'] == stack_name:
-                    instances.append(resource)
-            if len(instances) > 0:
-                return instances
+        instances = list(self.iter_instances(service, stack_name))
+        if len(instances) > 0:
+            return instances
 
         return None
 
+    def iter_instances(self, service=None, stack_name=None):
+        """ Generator version of get_instances.
+
+        Every page of the instances collection is loaded, following the
+        pagination links returned by Rancher, and its instances are yielded
+        one by one. Only one page is held in memory at a time.
+
+        When only stack_name is given, the instances are loaded through the
+        services of that stack, so that instances from other stacks are never
+        downloaded. If the stack can't be resolved that way, all instances in
+        the environment are loaded and filtered by their stack label.
+
+        Args:
+            - service: The Rancher object representation of a service
+            - stack_name: A stack name
+        """
+        if service is not None:
+            url = service['links']['instances']
+            for resource in self._iter_collection(url):
+                if stack_name is None or self._in_stack(resource, stack_name):
+                    yield resource
+            return
+
+        if stack_name is not None:
+            stack = self._get_stack(stack_name)
+            if stack is not None and 'services' in stack.get('links', {}):
+                for resource in self._iter_stack_instances(stack):
+                    yield resource
+                return
+
+        url = '{0}://{1}:{2}/v1/projects/{3}/instances'\
+            .format(self._protocol, self.host, self.port, self.project_id)
+        for resource in self._iter_collection(url):
+            if stack_name is None or self._in_stack(resource, stack_name):
+                yield resource
+
+    def iter_services_instances(self, services):
+        """ Yields the instances of several services.
+
+        The instances of the services are loaded concurrently, using up to
+        `pool_size` threads that share the connection pool, and are yielded
+        in the same order as `services`. Instances that belong to more than
+        one service (e.g sidekicks) are only yielded once.
+
+        Args:
+            - services: A list of Rancher service objects
+        """
+        services = [service for service in services if service is not None]
+        if not services:
+            return
+
+        # Sidekick containers can be listed under more than one service
+        seen = set()
+        pool = ThreadPool(max(1, min(len(services), self.pool_size)))
+        try:
+            for instances in pool.imap(self._load_instances, services):
+                for resource in instances:
+                    if resource['id'] not in seen:
+                        seen.add(resource['id'])
+                        yield resource
+        finally:
+            pool.terminate()
+
+    def _load_instances(self, service):
+        return list(self.iter_instances(service))
+
+    def _iter_stack_instances(self, stack):
+        services = list(self._iter_collection(stack['links']['services']))
+        return self.iter_services_instances(services)
+
+    def _in_stack(self, resource, stack_name):
+        labels = resource['labels']
+        return labels and 'io.rancher.stack.name' in labels and \
+            labels['io.rancher.stack.name'] == stack_name
+
     def _get_service_from_resource(self, resource):
         # If the state is running or stopped, then the list of services is
         # already part of the resource, so simply return the first service.
@@ -94,36 +243,149 @@ class API(object):
             return self._get_service_from_stack(stack_name, service_name)
         return None
 
-    def _get_service_from_stack(self, stack_name, service_name):
-        # First get the stack
+    def _get_stack(self, stack_name):
+        stack = self._cache_get(('stack', stack_name))
+        if stack is not None:
+            return stack
+
+        # The name filter is applied by Rancher, but the names are still
+        # compared here in case the filter is not supported.
         url = '{0}://{1}:{2}/v1/projects/{3}/environments'\
             .format(self._protocol, self.host, self.port, self.project_id)
-        res = self._get(url)
-        res_data = res.json()
-        service_stack = None
-        if res_data['data'] and len(res_data['data']) > 0:
-            for stack in res_data['data']:
-                if stack['name'] == stack_name:
-                    service_stack = stack
-                    break
-
-        if not service_stack:
-            return None
-
-        url = service_stack['links']['services']
-        res = self._get(url)
-        res_data = res.json()
-        if res_data['data'] and len(res_data['data']) > 0:
-            for service in res_data['data']:
-                if service['name'] == service_name:
-                    return service
+        for stack in self._iter_collection(url, {'name': stack_name}):
+            if stack['name'] == stack_name:
+                self._cache_set(('stack', stack_name), stack)
+                return stack
 
         return None
 
+    def _get_service_from_stack(self, stack_name, service_name):
+        return self.get_services(stack_name, [service_name])[0]
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= monotonic():
+                del self._cache[key]
+                return None
+            return value
+
+    def _cache_set(self, key, value):
+        if self.cache_ttl <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = (monotonic() + self.cache_ttl, value)
+
+    def _iter_collection(self, url, params=None):
+        """ Yields the items of a collection, following its pagination links.
+        """
+        params = dict(params or {}, limit=self.page_size)
+        while url:
+            res_data = self._get_page(url, params)
+            for item in res_data.get('data') or []:
+                yield item
+
+            # The next link already includes the query parameters
+            pagination = res_data.get('pagination') or {}
+            url = pagination.get('next')
+            params = None
 
-    def _get(self, url):
+    def _get_page(self, url, params=None):
+        """ Returns the content of a page of a collection.
+
+        Raises RancherAPIError if rancher answered with an error, or with
+        something that isn't a collection, so that it is never mistaken for
+        an empty collection.
+
+        With conditional requests, the ETag of the last copy of the page is
+        sent, and the copy is reused if the server answers that the page is
+        not modified. `pages_downloaded` counts the pages that were not.
+        """
+        if not self.conditional:
+            return _page_data(self._get(url, params), url)
+
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._pages_lock:
+            self._pages_used.add(key)
+            cached = self._pages.get(key)
+
+        headers = None
+        if cached is not None:
+            headers = {'If-None-Match': cached[0]}
+        res = self._get(url, params, headers)
+        if res.status_code == 304:
+            if cached is None:
+                raise RancherAPIError("Unexpected 304 response from '{0}'"
+                                      .format(url))
+            return cached[1]
+
+        data = _page_data(res, url)
+        etag = res.headers.get('ETag')
+        with self._pages_lock:
+            self.pages_downloaded += 1
+            if etag:
+                self._pages[key] = (etag, data)
+            else:
+                self._pages.pop(key, None)
+        return data
+
+    def _get(self, url, params=None, headers=None):
+        endpoint = _endpoint(url)
+        kwargs = {'params': params, 'timeout': self.timeout}
+        if headers:
+            kwargs['headers'] = headers
+        start = monotonic()
         try:
-            return requests.get(url, headers=self._headers)
-        except ConnectionError as e:
-            logger.error('Error connecting to rancher server. %s' % e.message)
-            raise RancherConnectionError()
\ No newline at end of file
+            res = self.session.get(url, **kwargs)
+        except (ConnectionError, Timeout) as e:
+            API_ERRORS.inc(endpoint=endpoint)
+            logger.error('Error connecting to rancher server. %s' % e)
+            raise RancherConnectionError()
+        finally:
+            API_LATENCY.observe(monotonic() - start, endpoint=endpoint)
+
+        if not res.ok:
+            API_ERRORS.inc(endpoint=endpoint)
+            logger.error("Rancher answered {0} to '{1}'"
+                         .format(res.status_code, url))
+            raise RancherAPIError("Rancher answered {0} to '{1}'"
+                                  .format(res.status_code, url))
+        return res
+
+
+def _page_data(res, url):
+    """ Returns the content of a response holding a page of a collection.
+    """
+    try:
+        data = res.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'data' not in data:
+        raise RancherAPIError("Invalid collection from '{0}'".format(url))
+    return data
+
+
+def _endpoint(url):
+    """ Returns the path of an API url, without the resource ids, e.g
+    'projects/{id}/services/{id}/instances'. """
+    parts = [part for part in urlparse(url).path.split('/') if part]
+    if parts and parts[0] == 'v1':
+        parts = parts[1:]
+    return '/'.join('{id}' if RESOURCE_ID_RE.match(part) else part
+                    for part in parts)
+
+
+def create_session(api_token, pool_size=10):
+    """ Returns a `requests.Session` authenticated with the api token, which
+    keeps up to `pool_size` connections open. """
+    session = requests.Session()
+    session.headers.update({
+        'Authorization': 'Basic {0}'.format(api_token)
+    })
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
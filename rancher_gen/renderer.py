@@ -0,0 +1,344 @@
+from __future__ import absolute_import
+
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import stat
+import tempfile
+from collections import namedtuple
+from multiprocessing import Pool
+from threading import Lock
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from .compat import monotonic, replace
+from .index import ContainerIndex
+from .metrics import RENDER_TIME, SKIPPED_WRITES
+from .projection import find_fields
+
+logger = logging.getLogger(__name__)
+
+# A template to render into a destination file, and the command to run when
+# the file changes (None to run the default one)
+Template = namedtuple('Template', ['source', 'dest', 'command'])
+
+# Renderer and template contexts used by the worker processes
+_worker_renderer = None
+_worker_contexts = (None, None)
+
+
+class TemplateRenderer(object):
+    """ Renders templates, reusing the compiled templates across renders.
+
+    A Jinja2 environment is kept for each template directory, so templates
+    (and the macros and includes they use) are only compiled the first time
+    they are rendered, and again whenever their modification time changes.
+    If `bytecode_cache_dir` is specified, the compiled templates are also
+    stored on disk, so they don't need to be compiled again when the app
+    restarts.
+
+    A digest of the content of each destination file is kept in memory, so
+    files are only written when the rendered output changes. Files are
+    written to a temporary file in the same directory and renamed into
+    place, so readers never see a partially written file. In streaming mode,
+    the output is written chunk by chunk as the template generates it,
+    instead of being rendered in memory first.
+
+    If `processes` is greater than one, multiple templates are rendered in
+    parallel by a pool of worker processes. The instances are serialized once
+    per render and the rendered output is written to disk by the workers, so
+    only file names and digests are sent back.
+
+    Templates get the list of `containers`, along with the lists and indexes
+    of a ContainerIndex (e.g `by_service` or `running`).
+
+    Args:
+        - bytecode_cache_dir: Directory to store the compiled templates in.
+        - stream: Whether to stream the output of the templates to disk.
+        - processes: Number of worker processes used to render templates.
+    """
+
+    def __init__(self, bytecode_cache_dir=None, stream=False, processes=0):
+        self.stream = stream
+        self.bytecode_cache = None
+        if bytecode_cache_dir:
+            if not os.path.isdir(bytecode_cache_dir):
+                os.makedirs(bytecode_cache_dir)
+            self.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+        self._environments = {}
+        self._digests = {}
+        self._fields = {}
+        self._lock = Lock()
+        self._cycle = 0
+        self._pool = None
+        if processes > 1:
+            self._pool = Pool(processes, _init_worker,
+                              (bytecode_cache_dir, stream))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def get_template(self, source):
+        env = self._get_environment(os.path.dirname(source))
+        return env.get_template(os.path.basename(source))
+
+    def find_fields(self, source):
+        """ Finds the container fields used by a template.
+
+        Returns None if the template may use any field. The result is cached
+        until the template, or one of the templates it includes, changes.
+        """
+        cached = self._fields.get(source)
+        if cached is not None:
+            fields, mtimes = cached
+            files = [filename for filename, mtime in mtimes]
+            if mtimes == self._mtimes(files):
+                return fields
+
+        env = self._get_environment(os.path.dirname(source))
+        fields, files = find_fields(env, os.path.basename(source))
+        self._fields[source] = (fields, self._mtimes(files))
+        return fields
+
+    def _mtimes(self, files):
+        mtimes = []
+        for filename in files:
+            try:
+                mtimes.append((filename, os.path.getmtime(filename)))
+            except OSError:
+                mtimes.append((filename, None))
+        return mtimes
+
+    def _get_environment(self, template_dir):
+        with self._lock:
+            env = self._environments.get(template_dir)
+            if env is None:
+                env = Environment(loader=FileSystemLoader(template_dir),
+                                  bytecode_cache=self.bytecode_cache,
+                                  auto_reload=True)
+                self._environments[template_dir] = env
+        return env
+
+    def render(self, instances, templates):
+        """ Renders the templates with the list of instances.
+
+        Returns the list of destination files that changed.
+        """
+        return self.render_jobs([(instances, template)
+                                 for template in templates])
+
+    def render_jobs(self, jobs):
+        """ Renders templates, each one with its own list of instances.
+
+        Args:
+            - jobs: A list of (instances, template) tuples. The instances are
+                a list of containers, or a ContainerIndex.
+
+        Returns the list of destination files that changed.
+        """
+        # Only index each list of instances once, no matter how many
+        # templates are rendered with it.
+        indexes = {}
+        for instances, template in jobs:
+            key = id(instances)
+            if key not in indexes:
+                if not isinstance(instances, ContainerIndex):
+                    instances = ContainerIndex(instances)
+                indexes[key] = instances
+
+        jobs = [(indexes[id(instances)].context(),) +
+                parse_template(template)[:2]
+                for instances, template in jobs]
+        if self._pool is not None and len(jobs) > 1:
+            outputs = self._render_in_pool(jobs)
+        else:
+            outputs = (self._render_timed(source, dest, context,
+                                          self._current_digest(dest))
+                       for context, source, dest in jobs)
+
+        changed = []
+        error = None
+        for (context, source, dest), output in zip(jobs, outputs):
+            if isinstance(output, Exception):
+                error = error or output
+                continue
+
+            tmp, digest, seconds = output
+            RENDER_TIME.observe(seconds, template=source)
+            if tmp is None:
+                SKIPPED_WRITES.inc(template=source)
+                logger.debug("'{0}' is up to date".format(dest))
+                continue
+
+            self._commit(tmp, dest)
+            self._digests[dest] = digest
+            changed.append(dest)
+            logger.info("Generated '{0}'".format(dest))
+
+        if error is not None:
+            raise error
+        return changed
+
+    def _render_in_pool(self, jobs):
+        # Each context is only serialized once, no matter how many templates
+        # are rendered with it.
+        self._cycle += 1
+        payloads = {}
+        results = []
+        for context, source, dest in jobs:
+            key = id(context)
+            if key not in payloads:
+                payloads[key] = pickle.dumps(context,
+                                             pickle.HIGHEST_PROTOCOL)
+            results.append(self._pool.apply_async(_render_in_worker, ((
+                self._cycle, key, payloads[key], source, dest,
+                self._current_digest(dest)),)))
+
+        outputs = []
+        for result in results:
+            try:
+                outputs.append(result.get())
+            except Exception as e:
+                outputs.append(e)
+        return outputs
+
+    def _render_timed(self, source, dest, context, current_digest):
+        """ Renders a template like _render_to_temp, and also returns how
+        many seconds it took. """
+        start = monotonic()
+        tmp, digest = self._render_to_temp(source, dest, context,
+                                           current_digest)
+        return tmp, digest, monotonic() - start
+
+    def _render_to_temp(self, source, dest, context, current_digest):
+        """ Renders a template with the context into a temporary file next to
+        dest.
+
+        Returns the path of the temporary file and the digest of the output.
+        The path is None if the output matches `current_digest`.
+        """
+        template = self.get_template(source)
+
+        if self.stream:
+            tmp, digest = self._write_temp(
+                dest, template.generate(context))
+            if digest == current_digest:
+                os.remove(tmp)
+                return None, digest
+            return tmp, digest
+
+        result = template.render(context)
+        result = result.encode('utf-8')
+        digest = hashlib.sha1(result).hexdigest()
+        if digest == current_digest:
+            return None, digest
+        return self._write_temp(dest, [result])
+
+    def _current_digest(self, dest):
+        if not os.path.exists(dest):
+            return None
+        return self._get_digest(dest)
+
+    def _write_temp(self, dest, chunks):
+        """ Writes chunks to a temporary file next to dest.
+
+        Returns the path of the temporary file and the digest of its content.
+        """
+        prefix = '.{0}.'.format(os.path.basename(dest))
+        try:
+            fd, tmp = tempfile.mkstemp(
+                prefix=prefix, dir=os.path.dirname(os.path.abspath(dest)))
+        except OSError as e:
+            # Without write access to the directory (e.g a file bind mounted
+            # in a read-only directory), write to the system temp directory
+            # instead. The file then can't be renamed over dest, and is
+            # copied in place by _commit.
+            logger.warning("Unable to create a temporary file next to "
+                           "'{0}': {1}".format(dest, e))
+            fd, tmp = tempfile.mkstemp(prefix=prefix)
+        digest = hashlib.sha1()
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode('utf-8')
+                    digest.update(chunk)
+                    fh.write(chunk)
+                fh.flush()
+                os.fsync(fh.fileno())
+        except Exception:
+            os.remove(tmp)
+            raise
+
+        return tmp, digest.hexdigest()
+
+    def _commit(self, tmp, dest):
+        # Keep the permissions of the file being replaced
+        mode = 0o644
+        if os.path.exists(dest):
+            mode = stat.S_IMODE(os.stat(dest).st_mode)
+        os.chmod(tmp, mode)
+
+        try:
+            replace(tmp, dest)
+        except OSError as e:
+            # Files that are bind mounted (e.g docker volumes) can't be
+            # replaced, so copy the content over instead.
+            logger.warning("Unable to replace '{0}' atomically: {1}"
+                           .format(dest, e))
+            shutil.copyfile(tmp, dest)
+            os.remove(tmp)
+
+    def _get_digest(self, dest):
+        # Seed the digest from the file generated by a previous run
+        if dest not in self._digests:
+            digest = None
+            if os.path.exists(dest):
+                with open(dest, 'rb') as fh:
+                    digest = hashlib.sha1(fh.read()).hexdigest()
+            self._digests[dest] = digest
+        return self._digests[dest]
+
+
+def parse_template(template):
+    """ Parses a template argument in the form source:dest[:notify].
+
+    Returns a Template with the source, the destination and the notify
+    command, which is None if not specified. Templates that are already
+    parsed are returned as is.
+    """
+    if isinstance(template, Template):
+        return template
+    parts = template.split(':', 2)
+    if len(parts) < 2:
+        raise ValueError("Invalid template: '{0}'. Must be in the form "
+                         "source:dest[:notify]".format(template))
+    notify = parts[2] if len(parts) == 3 and parts[2] else None
+    return Template(parts[0], parts[1], notify)
+
+
+def _init_worker(bytecode_cache_dir, stream):
+    global _worker_renderer
+    _worker_renderer = TemplateRenderer(bytecode_cache_dir, stream)
+
+
+def _render_in_worker(args):
+    global _worker_contexts
+    cycle, key, payload, source, dest, current_digest = args
+
+    # Only load each context once per render, even if this worker renders
+    # more than one template with it.
+    if _worker_contexts[0] != cycle:
+        _worker_contexts = (cycle, {})
+    context = _worker_contexts[1].get(key)
+    if context is None:
+        context = pickle.loads(payload)
+        _worker_contexts[1][key] = context
+
+    return _worker_renderer._render_timed(source, dest, context,
+                                          current_digest)
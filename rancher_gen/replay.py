@@ -0,0 +1,156 @@
+"""
+Records the frames received from the Rancher websocket, and replays them
+offline.
+"""
+from __future__ import absolute_import
+
+import gzip
+import io
+import json
+import logging
+import time
+import zlib
+from threading import Lock
+
+from .compat import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Errors of a gzipped log that was cut short. BadGzipFile is new in Python
+# 3.8, earlier versions raise IOError when the cut is in a gzip header
+TRUNCATED_ERRORS = (EOFError, zlib.error,
+                    getattr(gzip, 'BadGzipFile', IOError))
+
+
+class Recorder(object):
+    """ Appends raw websocket frames, with the time they arrived at, to a log
+    file.
+
+    Each line of the log is a JSON array with the timestamp and the frame.
+    The log is gzipped if the path ends with '.gz'. Lines are flushed to disk
+    at most once per `flush_interval` seconds, and when the recorder is
+    closed.
+
+    Args:
+        - path: The path of the log file.
+        - flush_interval: Seconds between flushes of the log file.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._last_flush = monotonic()
+        if path.endswith('.gz'):
+            self._fh = gzip.open(path, 'ab')
+        else:
+            self._fh = io.open(path, 'ab')
+
+    def record(self, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8')
+        line = json.dumps([timestamp, frame], separators=(',', ':'))
+
+        with self._lock:
+            self._fh.write(line.encode('utf-8') + b'\n')
+            now = monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._fh.flush()
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+def read_log(path):
+    """ Yields the (timestamp, frame) tuples of a log written by Recorder.
+    """
+    opener = gzip.open if path.endswith('.gz') else io.open
+    with opener(path, 'rb') as fh:
+        for line in _read_lines(fh, path):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                timestamp, frame = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # The last line may be incomplete if the app was killed
+                logger.warning("Skipping invalid line in '{0}'".format(path))
+                continue
+            yield timestamp, frame
+
+
+def _read_lines(fh, path):
+    """ Yields the lines of a log file. A gzipped log is cut short if the
+    app was killed while writing it, so it is read up to its last complete
+    line. """
+    try:
+        for line in fh:
+            yield line
+    except TRUNCATED_ERRORS as e:
+        logger.warning("Stopping at the end of the truncated log '{0}': {1}"
+                       .format(path, e))
+
+
+def paced(entries, speed=1.0, sleep=time.sleep):
+    """ Yields the frames of a log at the pace they were recorded.
+
+    Args:
+        - entries: (timestamp, frame) tuples, e.g from read_log.
+        - speed: How many times faster than real time to go, or 0 to go as
+            fast as possible.
+        - sleep: The function used to wait.
+    """
+    start = None
+    first = None
+    for timestamp, frame in entries:
+        if speed:
+            if start is None:
+                start, first = monotonic(), timestamp
+            delay = start + (timestamp - first) / speed - monotonic()
+            if delay > 0:
+                sleep(delay)
+        yield frame
+
+
+class StubAPI(object):
+    """ Stands in for the rancher API when replaying a log, serving a fixed
+    list of instances.
+
+    Args:
+        - instances: The instances to serve, e.g from a snapshot file.
+    """
+
+    def __init__(self, instances=None):
+        self.instances = instances or []
+        self.calls = 0
+
+    def close(self):
+        pass
+
+    def invalidate_cache(self):
+        pass
+
+    def get_services(self, stack, services):
+        self.calls += 1
+        return [{'stack': stack, 'name': service} for service in services]
+
+    def iter_instances(self, service=None, stack_name=None):
+        self.calls += 1
+        return [instance for instance in self.instances
+                if stack_name is None or
+                _label(instance, 'io.rancher.stack.name') == stack_name]
+
+    def iter_services_instances(self, services):
+        self.calls += 1
+        names = set('{0}/{1}'.format(service['stack'], service['name'])
+                    for service in services if service is not None)
+        return [instance for instance in self.instances
+                if _label(instance, 'io.rancher.stack_service.name') in names]
+
+
+def _label(instance, name):
+    return (instance.get('labels') or {}).get(name)
@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+
+import logging
+import random
+from subprocess import call
+from threading import Condition, Event, Lock, Thread
+
+from .compat import monotonic
+from .metrics import NOTIFY_DURATION
+
+logger = logging.getLogger(__name__)
+
+
+class EventScheduler(object):
+    """ Coalesces bursts of events into a single call to a callback.
+
+    Events are processed by a single worker thread. Once an event arrives, the
+    worker waits until no new events have been received for `debounce`
+    seconds, but never longer than `max_wait` seconds after the first pending
+    event, and then calls `callback` once with every event collected so far.
+    Events that arrive while the callback is running are collected for the
+    next cycle.
+
+    Args:
+        - callback: Function called with the list of coalesced events.
+        - debounce: Seconds of quiet time to wait for before running a cycle.
+        - max_wait: Maximum number of seconds an event can be delayed.
+    """
+
+    def __init__(self, callback, debounce=0.5, max_wait=5.0):
+        self.callback = callback
+        self.debounce = debounce
+        self.max_wait = max(max_wait, debounce)
+        self._cond = Condition()
+        self._events = []
+        self._first = None
+        self._last = None
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = Thread(target=self._run, name='rancher-gen-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the worker once the pending events have been processed. """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def schedule(self, event=None):
+        with self._cond:
+            now = monotonic()
+            if not self._events:
+                self._first = now
+            self._last = now
+            self._events.append(event)
+            self._cond.notify()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._events:
+                if self._stopped:
+                    return None
+                self._cond.wait()
+
+            while not self._stopped:
+                deadline = min(self._last + self.debounce,
+                               self._first + self.max_wait)
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            events, self._events = self._events, []
+            return events
+
+    def _run(self):
+        while True:
+            events = self._next_batch()
+            if events is None:
+                return
+
+            logger.debug('Processing {0} coalesced event(s)'
+                         .format(len(events)))
+            try:
+                self.callback(events)
+            except Exception as e:
+                logger.exception(e)
+
+
+class Ticker(object):
+    """ Calls a function every `interval` seconds on a daemon thread. """
+
+    def __init__(self, interval, function):
+        self.interval = interval
+        self.function = function
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        # Each thread gets its own event, so a thread that is still running
+        # the function when the ticker is restarted stops too.
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, args=(self._stopped,),
+                              name='rancher-gen-ticker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread = None
+
+    def _run(self, stopped):
+        while not stopped.wait(self.interval):
+            try:
+                self.function()
+            except Exception as e:
+                logger.exception(e)
+
+
+class Notifier(object):
+    """ Runs notify commands, never running the same command concurrently.
+
+    Identical commands requested together are only run once. If a command is
+    requested while it is already running, a single follow-up run is
+    performed once the current one finishes, no matter how many times it was
+    requested in the meantime.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._running = set()
+        self._pending = set()
+
+    def notify(self, commands):
+        unique = []
+        for command in commands:
+            if command and command not in unique:
+                unique.append(command)
+
+        for command in unique:
+            self._run(command)
+
+    def _run(self, command):
+        with self._lock:
+            if command in self._running:
+                self._pending.add(command)
+                return
+            self._running.add(command)
+
+        try:
+            while True:
+                logger.info("Running '{0}'".format(command))
+                with NOTIFY_DURATION.time(command=command):
+                    call(command, shell=True)
+
+                with self._lock:
+                    if command not in self._pending:
+                        self._running.discard(command)
+                        return
+                    self._pending.discard(command)
+        except Exception:
+            with self._lock:
+                self._running.discard(command)
+                self._pending.discard(command)
+            raise
+
+
+class Backoff(object):
+    """ Computes jittered, exponentially growing delays between retries.
+
+    Each delay is picked at random between half and all of
+    `base * 2 ** attempt`, capped at `maximum` seconds.
+    """
+
+    def __init__(self, base=1.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.maximum, self.base * (2 ** self.attempt))
+        self.attempt += 1
+        return delay / 2 + random.uniform(0, delay / 2)
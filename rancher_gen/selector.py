@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Selector(object):
+    """ Selects the containers a template is rendered with.
+
+    Args:
+        - stack: The name of the stack the containers belong to.
+        - services: A list of service names the containers belong to.
+        - labels: A dict of labels the containers must have.
+    """
+
+    def __init__(self, stack=None, services=None, labels=None):
+        self.stack = stack
+        self.services = services or []
+        self.labels = labels or {}
+
+    @classmethod
+    def parse(cls, value):
+        """ Creates a selector from a string like
+        'stack=web,service=nginx,label.tier=frontend'. """
+        stack = None
+        services = []
+        labels = {}
+        for item in value.split(','):
+            if not item.strip():
+                continue
+            if '=' not in item:
+                raise ValueError("Invalid selector: '{0}'".format(value))
+            key, val = [part.strip() for part in item.split('=', 1)]
+            if key == 'stack':
+                stack = val
+            elif key == 'service':
+                services.append(val)
+            elif key.startswith('label.'):
+                labels[key[len('label.'):]] = val
+            else:
+                raise ValueError("Invalid selector key '{0}'. Must be one of "
+                                 "stack, service or label.<name>".format(key))
+        return cls(stack, services, labels)
+
+    def matches(self, container):
+        labels = container.get('labels') or {}
+        if self.stack is not None and \
+                labels.get('io.rancher.stack.name') != self.stack:
+            return False
+
+        if self.services:
+            service_name = labels.get('io.rancher.stack_service.name', '')
+            if service_name.split('/')[-1] not in self.services:
+                return False
+
+        for key, value in self.labels.items():
+            if labels.get(key) != value:
+                return False
+
+        return True
+
+    def filter(self, containers):
+        return [container for container in containers
+                if self.matches(container)]
+
+
+def container_digest(container):
+    data = json.dumps(container, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class Fingerprints(object):
+    """ Tracks the containers each template is rendered with.
+
+    For every template destination, a digest of each selected container is
+    kept, so it's possible to tell which templates are affected by a change
+    without looking at the containers of the other templates. Templates
+    without a selector are affected by every container.
+    """
+
+    def __init__(self):
+        self._fingerprints = {}
+
+    def reset(self, selectors, containers):
+        """ Recomputes the fingerprints from the full list of containers.
+
+        Args:
+            - selectors: A dict of template destinations to Selector objects,
+                or None for templates that use every container.
+            - containers: The list of containers.
+
+        Returns the set of destinations whose fingerprint changed, including
+        the ones that were not tracked before.
+        """
+        digests = [(container['id'], container, container_digest(container))
+                   for container in containers]
+
+        changed = set()
+        fingerprints = {}
+        for dest, selector in selectors.items():
+            fingerprint = dict(
+                (container_id, digest)
+                for container_id, container, digest in digests
+                if selector is None or selector.matches(container))
+            if self._fingerprints.get(dest) != fingerprint:
+                changed.add(dest)
+            fingerprints[dest] = fingerprint
+
+        self._fingerprints = fingerprints
+        return changed
+
+    def update(self, selectors, container_id, container):
+        """ Updates the fingerprints after a container changed.
+
+        Args:
+            - selectors: A dict of template destinations to Selector objects.
+            - container_id: The id of the container that changed.
+            - container: The new container, or None if it was removed.
+
+        Returns the set of destinations whose fingerprint changed.
+        """
+        digest = None
+        changed = set()
+        for dest, selector in selectors.items():
+            fingerprint = self._fingerprints.setdefault(dest, {})
+            if container is not None and \
+                    (selector is None or selector.matches(container)):
+                if digest is None:
+                    digest = container_digest(container)
+                if fingerprint.get(container_id) != digest:
+                    fingerprint[container_id] = digest
+                    changed.add(dest)
+            elif container_id in fingerprint:
+                del fingerprint[container_id]
+                changed.add(dest)
+
+        return changed
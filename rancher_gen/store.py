@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+
+import gzip
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from threading import RLock
+
+from .compat import replace
+from .index import ContainerIndex
+from .projection import project
+
+logger = logging.getLogger(__name__)
+
+
+class ContainerStore(object):
+    """ In-memory view of the containers that are passed to the templates.
+
+    The store is seeded with the full list of instances loaded from the
+    Rancher API, and then kept up to date with the container resources that
+    are sent by the web socket. Running containers are inserted or updated,
+    while stopped and removed containers are dropped from the store.
+
+    If `fields` is specified, only those fields of the containers are kept.
+
+    The containers are also kept in a ContainerIndex, which is updated along
+    with the store.
+
+    Args:
+        - fields: A set of field names, or None to keep every field.
+    """
+
+    SNAPSHOT_VERSION = 1
+
+    ACTIVE_STATES = ('running',)
+    INACTIVE_STATES = ('stopped', 'removed', 'purged')
+
+    def __init__(self, fields=None):
+        self.fields = fields
+        self._containers = OrderedDict()
+        self.index = ContainerIndex()
+        self._lock = RLock()
+        self.seeded = False
+
+    def __len__(self):
+        return len(self._containers)
+
+    def __contains__(self, container_id):
+        return container_id in self._containers
+
+    def get(self, container_id):
+        return self._containers.get(container_id)
+
+    def reset(self, instances):
+        """ Replaces the content of the store with a full list of instances.
+        """
+        containers = OrderedDict()
+        for instance in instances or []:
+            if instance.get('state') not in self.INACTIVE_STATES:
+                containers[instance['id']] = project(instance, self.fields)
+
+        with self._lock:
+            self._containers = containers
+            self.index.reset(containers.values())
+            self.seeded = True
+
+    def apply(self, resource):
+        """ Applies a container resource received from the web socket.
+
+        Returns True if the content of the store changed.
+        """
+        container_id = resource.get('id')
+        state = resource.get('state')
+        if container_id is None:
+            return False
+
+        with self._lock:
+            if state in self.INACTIVE_STATES:
+                if container_id in self._containers:
+                    del self._containers[container_id]
+                    self.index.remove(container_id)
+                    logger.debug("Removed container '{0}'"
+                                 .format(container_id))
+                    return True
+                return False
+
+            if state in self.ACTIVE_STATES:
+                resource = project(resource, self.fields)
+                if self._containers.get(container_id) == resource:
+                    return False
+                self._containers[container_id] = resource
+                self.index.update(resource)
+                logger.debug("Updated container '{0}'".format(container_id))
+                return True
+
+        return False
+
+    def instances(self):
+        """ Returns the list of containers currently in the store. """
+        with self._lock:
+            return list(self._containers.values())
+
+    def save(self, path, key=None):
+        """ Saves the containers to a gzipped JSON snapshot file.
+
+        The file is written to a temporary file and renamed into place, so a
+        crash never leaves a partially written snapshot behind.
+
+        Args:
+            - path: The path of the snapshot file.
+            - key: Identifies what was loaded into the store (e.g the project
+                and filters). A snapshot is only loaded with the same key.
+        """
+        data = {
+            'version': self.SNAPSHOT_VERSION,
+            'key': key,
+            'instances': self.instances()
+        }
+        content = json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+        fd, tmp = tempfile.mkstemp(
+            prefix='.{0}.'.format(os.path.basename(path)),
+            dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                with gzip.GzipFile(fileobj=fh, mode='wb') as gz:
+                    gz.write(content)
+                fh.flush()
+                os.fsync(fh.fileno())
+            replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def load(self, path, key=None):
+        """ Loads the containers from a snapshot file created by save.
+
+        Returns True if the snapshot was loaded.
+        """
+        data = read_snapshot(path)
+        if data is None:
+            return False
+
+        if data.get('version') != self.SNAPSHOT_VERSION or \
+                data.get('key') != key:
+            logger.info("Ignoring snapshot '{0}', it was created with "
+                        "different settings".format(path))
+            return False
+
+        self.reset(data['instances'])
+        logger.info("Loaded {0} containers from snapshot '{1}'"
+                    .format(len(self), path))
+        return True
+
+
+def read_snapshot(path):
+    """ Returns the content of a snapshot file created by
+    ContainerStore.save, or None if it can't be read. """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with gzip.open(path, 'rb') as gz:
+            return json.loads(gz.read().decode('utf-8'))
+    except (IOError, OSError, ValueError) as e:
+        logger.warning("Unable to load snapshot '{0}': {1}".format(path, e))
+        return None
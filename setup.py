@@ -78,7 +78,11 @@ setup(
         'requests==2.11.1',
         'websocket-client==0.37.0'
     ],
-    extras_require={},
+    extras_require={
+        'fastjson': ['ujson'],
+        'yaml': ['PyYAML'],
+        'toml': ['toml']
+    },
     tests_require=[
         'tox==2.3.1'
     ],
@@ -1 +1,7 @@
+import sys
+
 from .fixtures.rancher_fixtures import *
+
+# The asyncio engine needs async/await
+if sys.version_info < (3, 5):
+    collect_ignore = ['test_aio.py']
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import pytest
+from mock import Mock
+
+from rancher_gen.aio import AsyncNotifier, AsyncRancherConnector, \
+    AsyncScheduler, WebSocket, WebSocketError
+from rancher_gen.replay import StubAPI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_rancher import Environment, FakeRancher, _frame  # noqa
+
+TEMPLATE = """\
+{% for container in containers %}{{ container.primaryIpAddress }}
+{% endfor %}"""
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_scheduler_coalesces_events():
+    batches = []
+
+    async def callback(events):
+        batches.append(events)
+
+    async def main():
+        scheduler = AsyncScheduler(callback, debounce=0.05, max_wait=1)
+        worker = asyncio.ensure_future(scheduler.run())
+        for event in range(3):
+            scheduler.schedule(event)
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        scheduler.schedule(3)
+        scheduler.stop()
+        await worker
+
+    run(main())
+    assert batches == [[0, 1, 2], [3]]
+
+
+def test_notifier_runs_each_command_once():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        out = os.path.join(tmp_dir, 'out.txt')
+        first = 'echo a >> {0}'.format(out)
+        second = 'echo b >> {0}'.format(out)
+        notifier = AsyncNotifier(concurrency=1)
+        run(notifier.notify([first, None, first, second]))
+        with open(out) as fh:
+            assert sorted(fh.read().split()) == ['a', 'b']
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_websocket_rejects_invalid_utf8():
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(_frame(b'\xff\xfe'))
+        websocket = WebSocket(reader, Mock())
+        try:
+            await websocket.recv()
+        except WebSocketError:
+            return True
+        return False
+
+    assert run(main())
+
+
+def serve_websocket(handler):
+    """ Runs a websocket server of the websockets library, and returns the
+    messages received by a WebSocket connected to it. """
+    websockets = pytest.importorskip('websockets')
+
+    async def main():
+        server = await websockets.serve(handler, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        websocket = await WebSocket.connect('127.0.0.1', port, '/', timeout=5,
+                                            max_size=100000,
+                                            ping_interval=0.05)
+        messages = []
+        try:
+            while True:
+                message = await websocket.recv()
+                if message is None:
+                    return messages
+                messages.append(message)
+        finally:
+            websocket.close()
+            server.close()
+            await server.wait_closed()
+
+    return run(main())
+
+
+def test_websocket_reads_messages_of_a_real_server():
+    async def handler(websocket, path=None):
+        await websocket.send('{"name":"ping"}')
+        await websocket.send('x' * 70000)
+        await websocket.send(['frag', 'mented'])
+        # Pinged by the client while idle, which keeps the connection open
+        await asyncio.sleep(0.3)
+        await websocket.send('still open')
+
+    assert serve_websocket(handler) == [
+        '{"name":"ping"}', 'x' * 70000, 'fragmented', 'still open']
+
+
+def test_websocket_rejects_messages_over_max_size():
+    async def frame(websocket, path=None):
+        await websocket.send('x' * 100001)
+
+    async def fragments(websocket, path=None):
+        await websocket.send(['x' * 60000, 'x' * 60000])
+
+    for handler in (frame, fragments):
+        with pytest.raises(WebSocketError):
+            serve_websocket(handler)
+
+
+def test_websocket_drops_connections_not_answering_pings():
+    async def main():
+        # A server that accepts the connection and then never answers
+        server = await asyncio.start_server(
+            lambda reader, writer: None, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        websocket = WebSocket(reader, writer, ping_interval=0.05,
+                              ping_timeout=0.05)
+        try:
+            await asyncio.wait_for(websocket.recv(), 5)
+        except WebSocketError:
+            return True
+        finally:
+            server.close()
+        return False
+
+    assert run(main())
+
+
+class TestAsyncRancherConnector:
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'in.j2')
+        self.dest = os.path.join(self.tmp_dir, 'out.txt')
+        with open(self.source, 'w') as fh:
+            fh.write(TEMPLATE)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        if not os.path.exists(self.dest):
+            return None
+        with open(self.dest) as fh:
+            return fh.read().split()
+
+    def test_watches_rancher(self):
+        environment = Environment(3)
+        server = FakeRancher(environment)
+        server.start()
+        try:
+            handler = AsyncRancherConnector(
+                '127.0.0.1', server.port, environment.project_id, 'access',
+                'secret', ['{0}:{1}'.format(self.source, self.dest)],
+                debounce=0.01, max_wait=0.1, resync_interval=0)
+            thread = Thread(target=handler)
+            thread.start()
+
+            wait_for(lambda: server.subscribers)
+            assert self.read() == ['10.42.0.1', '10.42.0.2', '10.42.0.3']
+
+            server.broadcast(environment.event(0, 1))
+            wait_for(lambda: self.read() == ['10.42.0.1', '10.42.0.4',
+                                             '10.42.0.3'])
+
+            handler.stop()
+            thread.join(10)
+            assert not thread.is_alive()
+        finally:
+            server.stop()
+
+    def test_survives_messages_that_fail(self):
+        environment = Environment(3)
+        server = FakeRancher(environment)
+        server.start()
+        try:
+            handler = AsyncRancherConnector(
+                '127.0.0.1', server.port, environment.project_id, 'access',
+                'secret', ['{0}:{1}'.format(self.source, self.dest)],
+                stack='stack0', debounce=0.01, max_wait=0.1,
+                resync_interval=0)
+            thread = Thread(target=handler)
+            thread.start()
+            wait_for(lambda: server.subscribers)
+
+            # The container has a stack label, but no service label
+            event = environment.event(0, 1)
+            del event['data']['resource']['labels'][
+                'io.rancher.stack_service.name']
+            server.broadcast(event)
+            server.broadcast(environment.event(1, 2))
+            wait_for(lambda: self.read() == ['10.42.0.1', '10.42.0.2',
+                                             '10.42.0.5'])
+            assert thread.is_alive()
+            assert server.requests['subscribe'] == 1
+
+            handler.stop()
+            thread.join(10)
+            assert not thread.is_alive()
+        finally:
+            server.stop()
+
+    def test_replays_frames(self):
+        environment = Environment(2)
+        frame = json.dumps(environment.event(0, 0))
+        handler = AsyncRancherConnector(
+            'replay', 0, 'replay', '', '',
+            ['{0}:{1}'.format(self.source, self.dest)], debounce=0,
+            resync_interval=0, api=StubAPI(environment.containers[1:]))
+
+        assert handler.replay([frame]) == 1
+        assert self.read() == ['10.42.0.2', '10.42.0.3']
+        assert handler.api.calls == 1
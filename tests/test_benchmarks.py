@@ -0,0 +1,40 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_rancher import Environment  # noqa
+from run import run_scenario  # noqa
+
+
+class Options(object):
+    events = 20
+    rate = 0
+    debounce = 0.01
+    max_wait = 0.1
+    page_size = 10
+    stack = None
+    timeout = 30
+    seed = 0
+
+
+def test_environment():
+    environment = Environment(25, services_per_stack=2,
+                              containers_per_service=5)
+    assert len(environment.containers) == 25
+    assert len(environment.services) == 5
+    assert len(environment.stacks) == 3
+    assert len(environment.service_instances('1s1')) == 5
+
+
+def test_runs_scenario_against_fake_server():
+    for stack in (None, 'stack0'):
+        Options.stack = stack
+        result = run_scenario(Options, 150)
+        assert result['complete']
+        assert result['rendered_events'] == 20
+        assert result['api_calls_per_event'] == 0
+        assert result['api_calls_startup'] > 0
+        assert result['latency_p99_seconds'] >= \
+            result['latency_p50_seconds']
@@ -3,6 +3,7 @@ from mock import patch
 from rancher_gen.cli import main
 from rancher_gen.handler import RancherConnector
 from rancher_gen.compat import StringIO
+from rancher_gen.replay import StubAPI
 
 
 class TestCLI:
@@ -104,3 +105,111 @@ class TestCLI:
                 main()
 
         assert mock.called
+
+    def test_watches_several_projects(self):
+        from rancher_gen.multi import MultiConnector
+
+        mock_args = ['/tmp/rancher-gen/bin/rancher-gen',
+                     '--host', '192.168.0.15',
+                     '--access-key', '1234567890',
+                     '--secret-k', '1234567890abcd',
+                     '--project-id', '1a5',
+                     '--project-id', '1a7',
+                     '--snapshot', '/tmp/snapshot.gz',
+                     '--template', '/tmp/in.j2:/tmp/out.txt']
+        with patch.object(sys, 'argv', mock_args):
+            with patch.object(MultiConnector, '__call__',
+                              autospec=True) as mock:
+                main()
+
+        assert mock.called
+        multi = mock.call_args[0][0]
+        assert [c.project_id for c in multi.connectors] == ['1a5', '1a7']
+        assert multi.connectors[1].snapshot == '/tmp/1a7-snapshot.gz'
+
+    def test_reads_config_file(self):
+        import json
+        import os
+        import tempfile
+        from rancher_gen.multi import MultiConnector
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'host': 'rancher', 'access_key': '1234567890',
+                       'projects': [{'id': '1a5',
+                                     'templates': ['in.j2:out.txt']}]}, fh)
+        mock_args = ['/tmp/rancher-gen/bin/rancher-gen',
+                     '--config', path,
+                     '--secret-k', '1234567890abcd']
+        try:
+            with patch.object(sys, 'argv', mock_args):
+                with patch.object(MultiConnector, '__call__',
+                                  autospec=True) as mock:
+                    main()
+        finally:
+            os.remove(path)
+
+        multi = mock.call_args[0][0]
+        assert multi.secret_key == '1234567890abcd'
+        assert multi.connectors[0].templates[0].dest == \
+            os.path.join(os.path.dirname(path), 'out.txt')
+
+    def test_fails_with_invalid_config_file(self):
+        mock_args = ['/tmp/rancher-gen/bin/rancher-gen',
+                     '--config', '/tmp/missing-rancher-gen.json']
+        with patch.object(sys, 'argv', mock_args):
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                main()
+
+        assert mock_stdout.getvalue().startswith(
+            "error: Unable to read '/tmp/missing-rancher-gen.json'")
+
+    def test_selects_asyncio_engine(self):
+        from rancher_gen.aio import AsyncRancherConnector
+
+        mock_args = ['/tmp/rancher-gen/bin/rancher-gen',
+                     '--host', '192.168.0.15',
+                     '--access-key', '1234567890',
+                     '--secret-k', '1234567890abcd',
+                     '--project-id', '1a5',
+                     '--engine', 'asyncio',
+                     '--template', '/tmp/in.j2:/tmp/out.txt']
+        with patch.object(sys, 'argv', mock_args):
+            with patch.object(AsyncRancherConnector, '__call__') as mock:
+                main()
+
+        assert mock.called
+
+    def test_selects_poll_mode(self):
+        from rancher_gen.poll import PollingConnector
+
+        mock_args = ['/tmp/rancher-gen/bin/rancher-gen',
+                     '--host', '192.168.0.15',
+                     '--access-key', '1234567890',
+                     '--secret-k', '1234567890abcd',
+                     '--project-id', '1a5',
+                     '--mode', 'poll',
+                     '--interval', '30',
+                     '--template', '/tmp/in.j2:/tmp/out.txt']
+        with patch.object(sys, 'argv', mock_args):
+            with patch.object(PollingConnector, '__call__',
+                              autospec=True) as mock:
+                main()
+
+        handler = mock.call_args[0][0]
+        assert handler.interval == 30
+        assert handler.api.conditional
+
+    def test_replays_recorded_events(self):
+        mock_args = ['/tmp/rancher-gen/bin/rancher-gen', 'replay',
+                     '/tmp/events.log', '--speed', '0',
+                     '--template', '/tmp/in.j2:/tmp/out.txt']
+        with patch.object(sys, 'argv', mock_args):
+            with patch('rancher_gen.cli.read_log', return_value=[]):
+                with patch.object(RancherConnector, 'replay',
+                                  autospec=True, return_value=0) as mock:
+                    main()
+
+        # The API is stubbed without connecting to rancher
+        handler = mock.call_args[0][0]
+        assert isinstance(handler.api, StubAPI)
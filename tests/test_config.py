@@ -0,0 +1,232 @@
+import json
+import os
+import pytest
+import shutil
+import tempfile
+from mock import patch
+from rancher_gen.config import Config, ConfigWatcher, load_config
+from rancher_gen.exception import ConfigError
+from rancher_gen.renderer import Template
+from rancher_gen.replay import StubAPI
+
+
+
+def container(container_id, ip):
+    return {
+        'id': container_id,
+        'type': 'container',
+        'state': 'running',
+        'primaryIpAddress': ip,
+        'hostname': 'host-{0}'.format(container_id),
+        'labels': {'io.rancher.stack.name': 'web'},
+    }
+
+
+def event(resource):
+    return json.dumps({'name': 'resource.change',
+                       'resourceType': 'container',
+                       'data': {'resource': resource}})
+
+
+YAML = """\
+host: rancher
+access_key: access
+secret_key: secret
+debounce: 0
+projects:
+  - id: 1a5
+    name: prod
+    templates:
+      - source: ips.j2
+        dest: prod.txt
+        notify: reload
+        selector: stack=web
+"""
+
+TOML = """\
+host = "rancher"
+access_key = "access"
+secret_key = "secret"
+debounce = 0
+
+[[projects]]
+id = "1a5"
+name = "prod"
+
+[[projects.templates]]
+source = "ips.j2"
+dest = "prod.txt"
+notify = "reload"
+selector = "stack=web"
+"""
+
+
+class TestConfig:
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.write('ips.j2', "{% for c in containers %}"
+                             "{{ c.primaryIpAddress }} {% endfor %}")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'w') as fh:
+            fh.write(content)
+
+    def read(self, name):
+        with open(self.path(name)) as fh:
+            return fh.read().strip()
+
+    def settings(self, **kwargs):
+        settings = {
+            'host': 'rancher',
+            'access_key': 'access',
+            'secret_key': 'secret',
+            'debounce': 0,
+            'resync_interval': 0,
+            'projects': [{'id': '1a5', 'name': 'prod',
+                          'templates': ['ips.j2:prod.txt:reload']}],
+        }
+        settings.update(kwargs)
+        return settings
+
+    def test_defaults(self):
+        config = Config({'projects': [{'id': '1a5'}]})
+        assert config.debounce == 0.5
+        assert config.pool_size == 10
+        assert config.port is None
+        assert config.templates == []
+        assert config.projects[0].name == '1a5'
+
+    @pytest.mark.parametrize('settings, error', [
+        ({}, "Missing setting: 'projects'"),
+        ({'projects': [{'id': '1a5'}], 'debug': True},
+         'debug: unknown setting'),
+        ({'projects': [{'id': '1a5'}], 'timeout': 'never'},
+         'timeout: must be a number'),
+        ({'projects': [{'id': '1a5'}], 'pool_size': True},
+         'pool_size: must be an integer'),
+        ({'projects': [{'id': '1a5'}], 'fields': 'id'},
+         'fields: must be a list of strings'),
+        ({'projects': [{'name': 'prod'}]},
+         "projects[0]: missing setting 'id'"),
+        ({'projects': [{'id': '1a5'}, {'id': '1a7', 'name': '1a5'}]},
+         "projects: duplicate project name '1a5'"),
+        ({'projects': [{'id': '1a5', 'templates': [{'source': 'in.j2'}]}]},
+         "projects[0].templates[0]: missing setting 'dest'"),
+        ({'projects': [{'id': '1a5', 'templates': ['in.j2']}]},
+         "projects[0].templates[0]: Invalid template: 'in.j2'"),
+        ({'projects': [{'id': '1a5', 'templates': [
+            {'source': 'in.j2', 'dest': 'out', 'selector': 'web'}]}]},
+         "projects[0].templates[0].selector: Invalid selector: 'web'"),
+        ({'projects': [{'id': '1a5'}], 'templates': [
+            {'source': 'in.j2', 'dest': 'out', 'selector': 'stack=web'}]},
+         'templates[0]: selectors can only be used by the templates of a '
+         'project'),
+    ])
+    def test_validates_settings(self, settings, error):
+        with pytest.raises(ConfigError) as e:
+            Config(settings)
+        assert str(e.value).startswith(error)
+
+    def test_resolves_relative_paths(self):
+        self.write('config.json', json.dumps(self.settings(
+            templates=[{'source': '/abs/in.j2', 'dest': 'all.txt'}])))
+        config = load_config(self.path('config.json'))
+
+        assert config.templates == [
+            Template('/abs/in.j2', self.path('all.txt'), None)]
+        assert config.projects[0].templates == [
+            Template(self.path('ips.j2'), self.path('prod.txt'), 'reload')]
+
+    @pytest.mark.parametrize('name, content', [
+        ('config.yml', YAML),
+        ('config.toml', TOML),
+    ])
+    def test_loads_yaml_and_toml(self, name, content):
+        self.write(name, content)
+        config = load_config(self.path(name))
+
+        project = config.projects[0]
+        assert (config.host, config.debounce) == ('rancher', 0)
+        assert (project.project_id, project.name) == ('1a5', 'prod')
+        assert project.templates == [
+            Template(self.path('ips.j2'), self.path('prod.txt'), 'reload')]
+        assert project.selectors[self.path('prod.txt')].stack == 'web'
+
+    def test_fails_with_unknown_format(self):
+        with pytest.raises(ConfigError):
+            load_config(self.path('config.ini'))
+
+    def test_reloads_changed_config(self):
+        self.write('config.json', json.dumps(self.settings()))
+        config = load_config(self.path('config.json'))
+        multi = config.connector()
+        prod = multi.connectors[0]
+        prod.api = StubAPI([container('1i1', '10.0.0.1')])
+        with patch.object(multi.notifier, '_run'):
+            multi._prerender()
+        watcher = ConfigWatcher(multi, config)
+        assert self.read('prod.txt') == '10.0.0.1'
+
+        # The new template is rendered by the connector of the project,
+        # without reconnecting to rancher. The containers are reloaded with
+        # the field it uses before it is rendered.
+        self.write('ips.j2', "{% for c in containers %}"
+                             "{{ c.hostname }} {% endfor %}")
+        os.utime(self.path('ips.j2'), (0, 0))
+        self.write('config.json', json.dumps(self.settings(
+            notify='restart',
+            projects=[{'id': '1a5', 'name': 'prod',
+                       'templates': ['ips.j2:prod.txt',
+                                     'ips.j2:copy.txt']}])))
+        with patch.object(multi.notifier, '_run') as run:
+            with patch.object(prod, 'stop') as stop:
+                assert watcher.reload()
+
+        assert multi.connectors == [prod]
+        assert not stop.called
+        assert self.read('prod.txt') == self.read('copy.txt') == 'host-1i1'
+        run.assert_called_once_with('restart')
+
+        # Later events are rendered with the new config
+        multi.scheduler.start()
+        with patch.object(multi.notifier, '_run'):
+            prod._on_message(None, event(container('1i2', '10.0.0.2')))
+            multi.scheduler.stop()
+        assert self.read('copy.txt') == 'host-1i1 host-1i2'
+
+    def test_keeps_config_when_invalid(self):
+        self.write('config.json', json.dumps(self.settings()))
+        config = load_config(self.path('config.json'))
+        multi = config.connector()
+        watcher = ConfigWatcher(multi, config)
+
+        self.write('config.json', '{"projects": ')
+        with patch.object(multi, 'configure') as configure:
+            assert not watcher.reload()
+        assert not configure.called
+
+    def test_restarts_projects_whose_filters_changed(self):
+        config = Config(self.settings())
+        multi = config.connector()
+        prod = multi.connectors[0]
+        prod.api = StubAPI([container('1i1', '10.0.0.1')])
+
+        config = Config(self.settings(projects=[
+            {'id': '1a5', 'name': 'prod', 'stack': 'web'},
+            {'id': '1a7'}]))
+        with patch('rancher_gen.multi.ProjectConnector._prerender'):
+            with patch.object(prod, 'stop') as stop:
+                multi.configure(config)
+
+        assert stop.called
+        assert [c.project_id for c in multi.connectors] == ['1a5', '1a7']
+        assert multi.connectors[0] is not prod
+        assert multi.connectors[0].stack == 'web'
+        assert list(multi.index.indexes) == ['prod', '1a7']
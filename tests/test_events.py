@@ -0,0 +1,61 @@
+import json
+import os
+from rancher_gen.events import EventFilter
+
+
+def frame(resource_type='container', state='running', stack='teststack',
+          service='hello1'):
+    return json.dumps({
+        'name': 'resource.change',
+        'resourceType': resource_type,
+        'data': {'resource': {
+            'type': resource_type,
+            'state': state,
+            'labels': {
+                'io.rancher.stack.name': stack,
+                'io.rancher.stack_service.name': '{0}/{1}'.format(stack,
+                                                                  service)
+            }
+        }}
+    })
+
+
+class TestEventFilter:
+
+    def test_accepts_real_message(self):
+        with open(os.path.join(os.path.dirname(__file__), 'fixtures',
+                               'mock_msg.json')) as fh:
+            message = fh.read()
+        assert EventFilter('teststack', ['hello1']).accept(message)
+
+    def test_drops_frames_at_each_stage(self):
+        event_filter = EventFilter('teststack', ['hello1', 'hello2'])
+
+        assert not event_filter.accept(json.dumps({'name': 'ping'}))
+        assert not event_filter.accept(frame(resource_type='host'))
+        assert not event_filter.accept(frame(stack='other'))
+        assert not event_filter.accept(frame(service='other'))
+        assert not event_filter.accept(frame(state='starting'))
+        assert event_filter.accept(frame(service='hello2'))
+
+        # Service changes are needed to invalidate the api cache
+        assert event_filter.accept(frame(resource_type='service',
+                                         stack='other', state='active'))
+
+        assert event_filter.counters == {
+            'received': 7,
+            'dropped_name': 1,
+            'dropped_type': 1,
+            'dropped_stack': 1,
+            'dropped_service': 1,
+            'dropped_state': 1,
+            'decoded': 2
+        }
+
+    def test_does_not_filter_names_that_could_be_escaped(self):
+        event_filter = EventFilter('st\xe4ck', ['hello1'])
+        assert event_filter.accept(frame(stack='other'))
+
+        # Without a stack, the services are not filtered
+        event_filter = EventFilter(None, ['hello1'])
+        assert event_filter.accept(frame(service='other'))
@@ -1,11 +1,25 @@
-import base64
 import json
 import os
-import time
-from mock import patch
-from threading import Thread
-from rancher_gen.handler import RancherConnector, MessageHandler
-from rancher_gen.compat import b64encode
+from mock import Mock, patch
+from rancher_gen.compat import monotonic
+from rancher_gen.handler import (RancherConnector, MessageHandler, RECEIVED,
+                                 RESYNC)
+from rancher_gen.metrics import EVENT_LATENCY, EVENTS_COALESCED
+from rancher_gen.projection import project
+from rancher_gen.replay import Recorder, StubAPI, read_log
+
+
+def rendered_jobs(render):
+    """ Returns the jobs passed to a mocked render_jobs, with the indexes
+    replaced by their list of containers. """
+    return [(getattr(instances, 'instances', lambda: instances)(), template)
+            for instances, template in render.call_args[0][0]]
+
+
+def load_mock_message():
+    with open(os.path.join(os.path.dirname(__file__), 'fixtures',
+                           'mock_msg.json')) as fh:
+        return json.loads(fh.read())
 
 
 class TestRancherConnector:
@@ -99,6 +113,344 @@ class TestRancherConnector:
             handler._on_message(None, json.dumps(mock_msg))
         assert mock.called
 
+    def test_on_message_counts_dropped_frames(self):
+        handler = RancherConnector(**self.config)
+        mock_message = load_mock_message()
+
+        labels = mock_message['data']['resource']['labels']
+
+        with patch.object(handler.scheduler, 'schedule') as schedule:
+            handler._on_message(None, json.dumps({'name': 'ping'}))
+            handler._on_message(None, json.dumps(mock_message))
+
+            # Other labels still mention the service, so the frame is only
+            # dropped once decoded.
+            labels['io.rancher.stack_service.name'] = 'teststack/other'
+            handler._on_message(None, json.dumps(mock_message))
+
+            labels['io.rancher.project_service.name'] = 'teststack/other'
+            handler._on_message(None, json.dumps(mock_message))
+
+        assert schedule.call_count == 1
+        counters = handler.event_filter.counters
+        assert counters['received'] == 4
+        assert counters['dropped_name'] == 1
+        assert counters['dropped_service'] == 1
+        assert counters['decoded'] == 2
+        assert counters['dropped_handler'] == 1
+        assert counters['scheduled'] == 1
+
+    def test_reconnects_and_resyncs(self):
+        handler = RancherConnector(**dict(self.config, reconnect_delay=0.01))
+        connections = []
+
+        class FakeWebSocketApp(object):
+            def __init__(self, url, **kwargs):
+                self.kwargs = kwargs
+
+            def run_forever(self):
+                connections.append(self)
+                if len(connections) == 2:
+                    # The second attempt fails to connect
+                    return
+                self.kwargs['on_open'](self)
+                if len(connections) == 3:
+                    handler.stop()
+
+            def close(self):
+                pass
+
+        with patch('rancher_gen.handler.websocket.WebSocketApp',
+                   FakeWebSocketApp):
+            with patch.object(handler.scheduler, 'schedule') as schedule:
+                handler.start()
+
+        assert len(connections) == 3
+        schedule.assert_called_once_with(RESYNC)
+        assert handler.backoff.attempt == 0
+
+    def test_on_events_updates_store_without_api_calls(self):
+        handler = RancherConnector(**self.config)
+        handler.store.reset([])
+        mock_message = load_mock_message()
+        resource = mock_message['data']['resource']
+        # Only the fields used by the template are kept
+        container = project(resource, handler.store.fields)
+        assert set(container) == set(['id', 'state', 'labels',
+                                      'primaryIpAddress'])
+
+        template = handler.templates[0]
+
+        with patch.object(handler, 'api') as api:
+            with patch.object(handler.renderer, 'render_jobs',
+                              return_value=[]) as render:
+                handler._on_events([mock_message])
+                assert rendered_jobs(render) == [([container], template)]
+
+                # Nothing changed, so nothing is rendered
+                render.reset_mock()
+                handler._on_events([mock_message])
+                assert not render.called
+
+                resource['state'] = 'stopped'
+                handler._on_events([mock_message])
+                assert rendered_jobs(render) == [([], template)]
+        assert not api.method_calls
+
+    def test_reloads_containers_when_template_fields_change(self):
+        template = '/tmp/rancher-gen-fields.j2'
+        out_file = '/tmp/rancher-gen-fields.txt'
+        with open(template, 'w') as fh:
+            fh.write('{% for c in containers %}{{ c.primaryIpAddress }}'
+                     '{% endfor %}')
+        resource = {'id': '1i1', 'type': 'container', 'state': 'running',
+                    'labels': {}, 'hostname': 'web1',
+                    'primaryIpAddress': '10.0.0.1'}
+
+        try:
+            config = dict(self.config, stack=None, services=None,
+                          notify='reload',
+                          templates=['{0}:{1}'.format(template, out_file)])
+            handler = RancherConnector(**config)
+            handler.api = StubAPI([resource])
+            handler._resync()
+            assert handler.store.get('1i1') == {
+                'id': '1i1', 'state': 'running', 'labels': {},
+                'primaryIpAddress': '10.0.0.1'}
+
+            with open(template, 'w') as fh:
+                fh.write('{% for c in containers %}{{ c.hostname }} '
+                         '{{ c.primaryIpAddress }}{% endfor %}')
+            # Make sure the modification time changes
+            os.utime(template, (0, 0))
+
+            # Rancher is not reachable, so nothing is rendered with the
+            # containers missing the new field
+            fields = handler.store.fields
+            with patch.object(handler, '_load_instances',
+                              return_value=False):
+                with patch.object(handler.notifier, '_run') as run:
+                    handler._render_and_notify(set())
+            assert not run.called
+            assert handler.store.fields == fields
+            with open(out_file) as fh:
+                assert fh.read() == '10.0.0.1'
+
+            # The containers are reloaded before every template is rendered
+            with patch.object(handler.notifier, '_run') as run:
+                handler._render_and_notify(set())
+            run.assert_called_once_with('reload')
+            assert handler.store.fields == set(['id', 'state', 'labels',
+                                                'hostname',
+                                                'primaryIpAddress'])
+            with open(out_file) as fh:
+                assert fh.read() == 'web1 10.0.0.1'
+        finally:
+            os.remove(template)
+            if os.path.exists(out_file):
+                os.remove(out_file)
+
+    def test_falls_back_to_configured_fields(self):
+        template = '/tmp/rancher-gen-fields.j2'
+        with open(template, 'w') as fh:
+            fh.write('{{ containers }}')
+
+        try:
+            config = dict(self.config,
+                          templates=['{0}:/tmp/out.txt'.format(template)])
+            handler = RancherConnector(**config)
+            assert handler.store.fields is None
+
+            config['fields'] = ['name']
+            handler = RancherConnector(**config)
+            assert handler.store.fields == set(['id', 'state', 'labels',
+                                                'name'])
+        finally:
+            os.remove(template)
+
+    def test_projection_can_be_turned_off(self):
+        template = '/tmp/rancher-gen-fields.j2'
+        with open(template, 'w') as fh:
+            fh.write('{% for c in containers %}{{ c.name }}{% endfor %}')
+
+        try:
+            config = dict(self.config,
+                          templates=['{0}:/tmp/out.txt'.format(template)])
+            handler = RancherConnector(**config)
+            assert handler.store.fields == set(['id', 'state', 'labels',
+                                                'name'])
+
+            handler = RancherConnector(projection=False, **config)
+            assert handler.store.fields is None
+        finally:
+            os.remove(template)
+
+    def test_records_event_to_file_latency(self):
+        handler = RancherConnector(**self.config)
+        handler.store.reset([])
+        mock_message = load_mock_message()
+        mock_message[RECEIVED] = monotonic()
+        latency = EVENT_LATENCY.count()
+        coalesced = EVENTS_COALESCED.get()
+
+        with patch.object(handler.renderer, 'render_jobs',
+                          return_value=['/tmp/out.txt']):
+            handler._on_events([mock_message, mock_message])
+
+        assert EVENT_LATENCY.count() == latency + 1
+        assert EVENTS_COALESCED.get() == coalesced + 1
+
+    def test_records_and_replays_frames(self):
+        log = '/tmp/rancher-gen-events.log'
+        frame = json.dumps(load_mock_message())
+        config = dict(self.config, record=log, debounce=0)
+
+        try:
+            handler = RancherConnector(**config)
+            handler.recorder = Recorder(log)
+            handler._on_message(None, frame)
+            handler.recorder.close()
+            assert [f for t, f in read_log(log)] == [frame]
+
+            handler = RancherConnector(api=StubAPI([]), **config)
+            assert handler.replay([f for t, f in read_log(log)]) == 1
+            with open(self.out_file) as fh:
+                assert fh.read().strip() == '10.42.247.7;'
+            # Only the initial load of the services and their instances
+            assert handler.api.calls == 2
+        finally:
+            os.remove(log)
+
+    def test_replays_truncated_gzip_logs(self):
+        log = '/tmp/rancher-gen-events.log.gz'
+        frame = json.dumps(load_mock_message())
+
+        try:
+            recorder = Recorder(log)
+            recorder.record(frame, 1.0)
+            recorder.close()
+            # The app was killed while recording the next frame
+            recorder = Recorder(log)
+            recorder.record(frame, 2.0)
+            recorder.close()
+            with open(log, 'rb') as fh:
+                content = fh.read()
+            with open(log, 'wb') as fh:
+                fh.write(content[:-10])
+
+            handler = RancherConnector(api=StubAPI([]), **self.config)
+            assert handler.replay([f for t, f in read_log(log)]) == 1
+            with open(self.out_file) as fh:
+                assert fh.read().strip() == '10.42.247.7;'
+        finally:
+            os.remove(log)
+
+    def test_notifies_only_when_output_changed(self):
+        config = self.config.copy()
+        config['notify'] = 'reload'
+        config['templates'] = ['/tmp/a.j2:/tmp/a.txt',
+                               '/tmp/b.j2:/tmp/b.txt:reload b',
+                               '/tmp/c.j2:/tmp/c.txt:reload b']
+        handler = RancherConnector(**config)
+
+        with patch.object(handler.renderer, 'render_jobs',
+                          return_value=[]):
+            with patch.object(handler.notifier, '_run') as mock:
+                handler._render_and_notify()
+        assert not mock.called
+
+        with patch.object(handler.renderer, 'render_jobs',
+                          return_value=['/tmp/a.txt']):
+            with patch.object(handler.notifier, '_run') as mock:
+                handler._render_and_notify()
+        mock.assert_called_once_with('reload')
+
+        # Identical commands only run once
+        with patch.object(handler.renderer, 'render_jobs',
+                          return_value=['/tmp/b.txt', '/tmp/c.txt']):
+            with patch.object(handler.notifier, '_run') as mock:
+                handler._render_and_notify()
+        mock.assert_called_once_with('reload b')
+
+    def test_only_renders_templates_whose_containers_changed(self):
+        config = self.config.copy()
+        config['templates'] = ['/tmp/a.j2:/tmp/a.txt', '/tmp/b.j2:/tmp/b.txt',
+                               '/tmp/c.j2:/tmp/c.txt']
+        config['selectors'] = ['/tmp/a.txt:service=hello1',
+                               '/tmp/b.txt:service=hello2']
+        handler = RancherConnector(**config)
+        mock_message = load_mock_message()
+        resource = mock_message['data']['resource']
+
+        with patch.object(handler, '_iter_instances', return_value=[]):
+            with patch.object(handler.renderer, 'render_jobs',
+                              return_value=[]) as render:
+                handler._resync()
+        assert len(render.call_args[0][0]) == 3
+
+        # The message is for hello1, so the template for hello2 is skipped
+        with patch.object(handler.renderer, 'render_jobs',
+                          return_value=[]) as render:
+            handler._on_events([mock_message])
+        assert render.call_count == 1
+        assert rendered_jobs(render) == [
+            ([resource], handler.templates[0]),
+            ([resource], handler.templates[2])]
+
+    def test_prerenders_from_snapshot(self):
+        snapshot = '/tmp/rancher-gen-snapshot.gz'
+        config = dict(self.config, snapshot=snapshot)
+        mock_message = load_mock_message()
+        resource = mock_message['data']['resource']
+
+        try:
+            handler = RancherConnector(**config)
+            handler.store.reset([])
+            with patch.object(handler.renderer, 'render_jobs',
+                              return_value=[]):
+                handler._on_events([mock_message])
+
+            # Rancher is not reachable, but the snapshot is rendered
+            handler = RancherConnector(**config)
+            with patch.object(handler, '_resync') as resync:
+                with patch.object(handler.renderer, 'render_jobs',
+                                  return_value=[]) as render:
+                    with patch.object(handler.scheduler,
+                                      'schedule') as schedule:
+                        handler._prerender()
+            assert not resync.called
+            assert render.call_count == 1
+            assert rendered_jobs(render) == [
+                ([project(resource, handler.store.fields)],
+                 handler.templates[0])]
+            schedule.assert_called_once_with(RESYNC)
+        finally:
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+
+    def test_keeps_store_when_rancher_fails(self):
+        handler = RancherConnector(**dict(self.config, stack=None,
+                                          services=None))
+        handler.store.reset([load_mock_message()['data']['resource']])
+        response = Mock(ok=False, status_code=503)
+        response.json.return_value = {'type': 'error', 'status': 503}
+
+        with patch.object(handler.api.session, 'get', return_value=response):
+            with patch.object(handler.renderer, 'render_jobs') as render:
+                with patch.object(handler, '_save_snapshot') as save:
+                    handler._resync()
+        assert not render.called
+        assert not save.called
+        assert len(handler.store) == 1
+
+    def test_on_events_resyncs_when_requested(self):
+        handler = RancherConnector(**self.config)
+        handler.store.reset([])
+
+        with patch.object(RancherConnector, '_resync') as resync:
+            handler._on_events([load_mock_message(), RESYNC])
+        assert resync.called
+
 
 class TestMessageHandler:
 
@@ -112,17 +464,14 @@ class TestMessageHandler:
     def test_renders_template(self, stack_service, mock_message):
         stack, services = stack_service
 
-        access_key = os.getenv('RANCHER_ACCESS_KEY')
-        secret_key = os.getenv('RANCHER_SECRET_KEY')
-        api_token = b64encode("{0}:{1}".format(access_key, secret_key))
         template = os.path.join(os.path.dirname(__file__), 'fixtures',
                                 'template.j2')
         config = {
-            'message': mock_message,
             'host': os.getenv('RANCHER_HOST'),
             'port': int(os.getenv('RANCHER_PORT', 80)),
             'project_id': stack['accountId'],
-            'api_token': api_token,
+            'access_key': os.getenv('RANCHER_ACCESS_KEY'),
+            'secret_key': os.getenv('RANCHER_SECRET_KEY'),
             'templates': ['{0}:{1}'.format(template, self.out_file)],
             'ssl': False,
             'stack': 'teststack',
@@ -131,11 +480,12 @@ class TestMessageHandler:
         }
 
         # Test with stack and service filter
-        handler = MessageHandler(**config)
-        handler.run()
-
-        while not os.path.exists(self.out_file):
-            time.sleep(1)
+        connector = RancherConnector(**config)
+        with patch.object(connector.scheduler, 'schedule') as mock:
+            MessageHandler(mock_message, connector.scheduler,
+                           config['stack'], config['services']).run()
+        assert mock.called
+        connector._on_events([mock_message])
 
         with open(self.out_file) as fh:
             output = fh.read().replace('\n', '').strip()
@@ -144,13 +494,9 @@ class TestMessageHandler:
         assert '10.42.232.34' in output
 
         # Test with stack only filter
-        config['project_id'] = stack['accountId']
         config['services'] = None
-        handler = MessageHandler(**config)
-        handler.run()
-
-        while not os.path.exists(self.out_file):
-            time.sleep(1)
+        connector = RancherConnector(**config)
+        connector._on_events([mock_message])
 
         with open(self.out_file) as fh:
             output = fh.read().replace('\n', '').strip()
@@ -160,108 +506,72 @@ class TestMessageHandler:
 
         # Test without filter
         config['stack'] = None
-        handler = MessageHandler(**config)
-        handler.run()
-
-        while not os.path.exists(self.out_file):
-            time.sleep(1)
+        connector = RancherConnector(**config)
+        connector._on_events([mock_message])
 
         with open(self.out_file) as fh:
             output = fh.read().replace('\n', '').strip()
 
         assert '10.42.232.33' in output
 
-    def test_does_not_render_with_missing_labels_in_message(
-            self, stack_service, mock_message):
-        stack, service = stack_service
+    def test_does_not_schedule_with_missing_labels_in_message(self):
+        mock_message = load_mock_message()
         mock_message['data']['resource']['labels'] = None
+        scheduler = Mock()
 
-        access_key = os.getenv('RANCHER_ACCESS_KEY')
-        secret_key = os.getenv('RANCHER_SECRET_KEY')
-        api_token = b64encode("{0}:{1}".format(access_key, secret_key))
-        template = os.path.join(os.path.dirname(__file__), 'fixtures',
-                                'template.j2')
-        config = {
-            'message': mock_message,
-            'host': os.getenv('RANCHER_HOST'),
-            'port': int(os.getenv('RANCHER_PORT', 80)),
-            'project_id': stack['accountId'],
-            'api_token': api_token,
-            'templates': ['{0}:{1}'.format(template, self.out_file)],
-            'ssl': False,
-            'stack': 'teststack',
-            'services': ['badservice'],
-            'notify': None
-        }
-
-        handler = MessageHandler(**config)
+        handler = MessageHandler(mock_message, scheduler, 'teststack',
+                                 ['badservice'])
         handler.run()
-        time.sleep(1)
-        assert not os.path.exists(self.out_file)
+        assert not scheduler.schedule.called
 
-    def test_does_not_render_with_missing_stack_name_in_message(
-            self, stack_service, mock_message):
-        stack, service = stack_service
+    def test_does_not_schedule_with_missing_stack_name_in_message(self):
+        mock_message = load_mock_message()
         del mock_message['data']['resource']['labels']['io.rancher.stack.name']
+        scheduler = Mock()
 
-        access_key = os.getenv('RANCHER_ACCESS_KEY')
-        secret_key = os.getenv('RANCHER_SECRET_KEY')
-        api_token = b64encode("{0}:{1}".format(access_key, secret_key))
-        template = os.path.join(os.path.dirname(__file__), 'fixtures',
-                                'template.j2')
-        config = {
-            'message': mock_message,
-            'host': os.getenv('RANCHER_HOST'),
-            'port': int(os.getenv('RANCHER_PORT', 80)),
-            'project_id': stack['accountId'],
-            'api_token': api_token,
-            'templates': ['{0}:{1}'.format(template, self.out_file)],
-            'ssl': False,
-            'stack': 'teststack',
-            'services': ['badservice'],
-            'notify': None
-        }
-
-        handler = MessageHandler(**config)
+        handler = MessageHandler(mock_message, scheduler, 'teststack',
+                                 ['badservice'])
         handler.run()
-        time.sleep(1)
-        assert not os.path.exists(self.out_file)
-        
+        assert not scheduler.schedule.called
 
-    def test_does_not_render_with_invalid_filter(
-            self, stack_service, mock_message):
-        stack, service = stack_service
-
-        access_key = os.getenv('RANCHER_ACCESS_KEY')
-        secret_key = os.getenv('RANCHER_SECRET_KEY')
-        api_token = b64encode("{0}:{1}".format(access_key, secret_key))
-        template = os.path.join(os.path.dirname(__file__), 'fixtures',
-                                'template.j2')
-        config = {
-            'message': mock_message,
-            'host': os.getenv('RANCHER_HOST'),
-            'port': int(os.getenv('RANCHER_PORT', 80)),
-            'project_id': stack['accountId'],
-            'api_token': api_token,
-            'templates': ['{0}:{1}'.format(template, self.out_file)],
-            'ssl': False,
-            'ssl': False,
-            'stack': 'teststack',
-            'services': ['badservice'],
-            'notify': None
-        }
+    def test_does_not_schedule_with_invalid_filter(self):
+        mock_message = load_mock_message()
+        scheduler = Mock()
 
         # Test with bad service name
-        handler1 = MessageHandler(**config)
-        handler1.start()
-        time.sleep(1)
-        assert not os.path.exists(self.out_file)
+        handler = MessageHandler(mock_message, scheduler, 'teststack',
+                                 ['badservice'])
+        handler.run()
+        assert not scheduler.schedule.called
 
-        # test with back stack name
-        config['stack'] = 'bad'
-        config['services'] = None
+        # test with bad stack name
+        handler = MessageHandler(mock_message, scheduler, 'bad')
+        handler.run()
+        assert not scheduler.schedule.called
 
-        handler2 = MessageHandler(**config)
-        handler2.start()
-        time.sleep(1)
-        assert not os.path.exists(self.out_file)
+    def test_invalidates_api_cache_on_service_changes(self):
+        mock_message = load_mock_message()
+        mock_message['data']['resource'] = {'type': 'service',
+                                            'state': 'active'}
+        scheduler = Mock()
+        api = Mock()
+
+        handler = MessageHandler(mock_message, scheduler, 'teststack',
+                                 None, api)
+        handler.run()
+        assert api.invalidate_cache.called
+        assert not scheduler.schedule.called
+
+    def test_schedules_matching_message(self):
+        mock_message = load_mock_message()
+        scheduler = Mock()
+
+        handler = MessageHandler(mock_message, scheduler, 'teststack',
+                                 ['hello1'])
+        assert handler.run()
+        scheduler.schedule.assert_called_once_with(mock_message)
+
+        # Messages are always relevant when not filtering
+        scheduler = Mock()
+        MessageHandler(mock_message, scheduler).run()
+        assert scheduler.schedule.called
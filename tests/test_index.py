@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from rancher_gen.index import AggregateIndex, ContainerIndex
+
+
+def container(container_id, service='web/nginx', host='1h1', state='running',
+              **kwargs):
+    stack = service.split('/')[0]
+    resource = {
+        'id': container_id,
+        'state': state,
+        'hostId': host,
+        'labels': {
+            'io.rancher.stack.name': stack,
+            'io.rancher.stack_service.name': service,
+        }
+    }
+    resource.update(kwargs)
+    return resource
+
+
+class TestContainerIndex:
+
+    def test_groups_containers(self):
+        index = ContainerIndex([
+            container('1i1'),
+            container('1i2', 'web/api', '1h2', healthState='unhealthy'),
+            container('1i3', 'db/mysql', healthState='healthy'),
+            container('1i4', state='starting'),
+        ])
+        context = index.context()
+
+        def ids(containers):
+            return [c['id'] for c in containers]
+
+        assert ids(context['containers']) == ['1i1', '1i2', '1i3', '1i4']
+        assert ids(context['running']) == ['1i1', '1i2', '1i3']
+        assert ids(context['healthy']) == ['1i1', '1i3']
+        assert ids(context['by_service']['web/nginx']) == ['1i1', '1i4']
+        assert ids(context['by_stack']['web']) == ['1i1', '1i2', '1i4']
+        assert ids(context['by_host']['1h2']) == ['1i2']
+        assert ids(context['by_label']['io.rancher.stack.name']['db']) == \
+            ['1i3']
+
+    def test_empty_index(self):
+        context = ContainerIndex().context()
+        assert context['containers'] == []
+        assert context['healthy'] == []
+        assert context['by_label'] == {}
+
+    def test_updates_incrementally(self):
+        index = ContainerIndex([container('1i1'), container('1i2'),
+                                container('1i3', 'db/mysql')])
+        before = index.context()
+
+        # Updated containers keep their position
+        index.update(container('1i1', primaryIpAddress='10.0.0.1'))
+        context = index.context()
+        assert [c['id'] for c in context['containers']] == \
+            ['1i1', '1i2', '1i3']
+        assert context['containers'][0]['primaryIpAddress'] == '10.0.0.1'
+
+        # Lists of groups that didn't change are reused
+        assert context['by_stack']['db'] is before['by_stack']['db']
+
+        # Containers that move are removed from their old groups
+        index.update(container('1i2', 'db/mysql', '1h2'))
+        context = index.context()
+        assert [c['id'] for c in context['by_service']['web/nginx']] == \
+            ['1i1']
+        assert [c['id'] for c in context['by_host']['1h2']] == ['1i2']
+
+        index.remove('1i1')
+        index.remove('1i1')
+        context = index.context()
+        assert 'web/nginx' not in context['by_service']
+        assert len(index) == 2
+
+    def test_updates_context_in_place(self):
+        index = ContainerIndex([container('1i1'), container('1i2')])
+        context = index.context()
+        containers = context['containers']
+        version = index.version
+
+        # Only the lists of the groups the container is in change
+        index.update(container('1i2', 'db/mysql', state='stopped'))
+        assert index.context() is context
+        assert context['containers'] is containers
+        assert [c['id'] for c in context['running']] == ['1i1']
+        assert [c['id'] for c in context['by_stack']['db']] == ['1i2']
+        assert index.version > version
+        version = index.version
+
+        # Tables left empty are removed
+        index.update(container('1i3', labels={'color': 'blue'}))
+        index.remove('1i3')
+        assert 'color' not in context['by_label']
+        index.remove('1i1')
+        assert context['running'] == []
+        assert [c['id'] for c in context['containers']] == ['1i2']
+
+        # Nothing changes when removing a container that isn't indexed
+        version = index.version
+        index.remove('1i1')
+        assert index.version == version
+
+    def test_keeps_order_when_removing_containers(self):
+        index = ContainerIndex([container('1i{0}'.format(i))
+                                for i in range(5)])
+        index.remove('1i1')
+        index.remove('1i3')
+        index.update(container('1i4', primaryIpAddress='10.0.0.4'))
+        index.update(container('1i5'))
+        context = index.context()
+        assert [c['id'] for c in context['containers']] == \
+            ['1i0', '1i2', '1i4', '1i5']
+        assert context['containers'][2]['primaryIpAddress'] == '10.0.0.4'
+
+
+class TestAggregateIndex:
+
+    def test_merges_projects(self):
+        first = ContainerIndex([container('1i1'),
+                                container('1i2', 'db/mysql')])
+        second = ContainerIndex([container('1i3', host='1h2')])
+        index = AggregateIndex(OrderedDict([('prod', first),
+                                            ('staging', second)]))
+        context = index.context()
+
+        def ids(containers):
+            return [c['id'] for c in containers]
+
+        assert len(index) == 3
+        assert ids(context['containers']) == ['1i1', '1i2', '1i3']
+        assert ids(context['by_service']['web/nginx']) == ['1i1', '1i3']
+        assert ids(context['by_label']['io.rancher.stack.name']['web']) == \
+            ['1i1', '1i3']
+        assert list(context['projects']) == ['prod', 'staging']
+        assert ids(context['projects']['staging']['containers']) == ['1i3']
+
+        # The projects are only merged again once one of them changes
+        assert index.context() is context
+        second.remove('1i3')
+        context = index.context()
+        assert ids(context['by_service']['web/nginx']) == ['1i1']
+        assert first.context()['by_service']['web/nginx'] is not \
+            context['by_service']['web/nginx']
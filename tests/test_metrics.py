@@ -0,0 +1,68 @@
+import pytest
+import requests
+from collections import Counter as BaseCounter
+from rancher_gen.metrics import (Counter, CounterMap, Histogram, Registry,
+                                 start_http_server)
+
+
+class TestMetrics:
+
+    def setup_method(self, method):
+        self.registry = Registry()
+
+    def test_exposes_counters(self):
+        counter = Counter('requests_total', 'Requests', ['endpoint'],
+                          registry=self.registry)
+        counter.inc(endpoint='services')
+        counter.inc(2, endpoint='a"b')
+        assert counter.get(endpoint='services') == 1
+
+        assert self.registry.expose() == (
+            '# HELP requests_total Requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{endpoint="a\\"b"} 2\n'
+            'requests_total{endpoint="services"} 1\n')
+
+    def test_checks_labels(self):
+        counter = Counter('requests_total', 'Requests', ['endpoint'],
+                          registry=self.registry)
+        with pytest.raises(ValueError):
+            counter.inc()
+
+    def test_exposes_histograms(self):
+        histogram = Histogram('render_seconds', 'Render time',
+                              buckets=(0.1, 1), registry=self.registry)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        with histogram.time():
+            pass
+        assert histogram.count() == 4
+
+        lines = self.registry.expose().splitlines()
+        assert lines[2:5] == ['render_seconds_bucket{le="0.1"} 2',
+                              'render_seconds_bucket{le="1.0"} 3',
+                              'render_seconds_bucket{le="+Inf"} 4']
+        assert lines[6] == 'render_seconds_count 4'
+
+    def test_exposes_counter_maps(self):
+        counters = BaseCounter()
+        CounterMap('events_total', 'Events', 'stage', counters,
+                   registry=self.registry)
+        counters['received'] += 3
+        assert 'events_total{stage="received"} 3' in self.registry.expose()
+
+    def test_serves_metrics_over_http(self):
+        Counter('reconnects_total', 'Reconnects',
+                registry=self.registry).inc()
+        server = start_http_server(0, registry=self.registry)
+        try:
+            res = requests.get('http://127.0.0.1:{0}/metrics'
+                               .format(server.server_port))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert res.status_code == 200
+        assert res.headers['Content-Type'].startswith('text/plain')
+        assert 'reconnects_total 1' in res.text
@@ -0,0 +1,138 @@
+import json
+import os
+import pytest
+import shutil
+import tempfile
+from mock import patch
+from rancher_gen.multi import MultiConnector, Project
+from rancher_gen.renderer import parse_template
+from rancher_gen.replay import StubAPI
+
+
+def container(container_id, ip, stack='web'):
+    return {
+        'id': container_id,
+        'type': 'container',
+        'state': 'running',
+        'primaryIpAddress': ip,
+        'labels': {
+            'io.rancher.stack.name': stack,
+            'io.rancher.stack_service.name': '{0}/nginx'.format(stack),
+        },
+    }
+
+
+def event(resource):
+    return json.dumps({'name': 'resource.change',
+                       'resourceType': 'container',
+                       'data': {'resource': resource}})
+
+
+class TestMultiConnector:
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.write('ips.j2', "{% for c in containers %}"
+                             "{{ c.primaryIpAddress }} {% endfor %}")
+        self.write('projects.j2', "{% for name, project in projects.items() "
+                                  "%}{{ name }}={{ project.containers | "
+                                  "length }} {% endfor %}")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'w') as fh:
+            fh.write(content)
+
+    def read(self, name):
+        with open(self.path(name)) as fh:
+            return fh.read().strip()
+
+    def template(self, source, dest, command=None):
+        template = '{0}:{1}'.format(self.path(source), self.path(dest))
+        if command:
+            template += ':' + command
+        return template
+
+    def connector(self):
+        projects = [
+            Project('1a5', [self.template('ips.j2', 'prod.txt', 'reload')],
+                    name='prod'),
+            Project('1a7', stack='web'),
+        ]
+        multi = MultiConnector(
+            'rancher', 8080, 'access', 'secret', projects,
+            [self.template('ips.j2', 'all.txt', 'reload'),
+             self.template('projects.j2', 'projects.txt')],
+            debounce=0, resync_interval=0)
+        multi.connectors[0].api = StubAPI([container('1i1', '10.0.0.1')])
+        multi.connectors[1].api = StubAPI([container('1i2', '10.0.0.2'),
+                                           container('1i3', '10.0.0.3',
+                                                     stack='db')])
+        return multi
+
+    def test_shares_resources(self):
+        multi = MultiConnector(
+            'rancher', 8080, 'access', 'secret',
+            [Project('1a5', [self.template('ips.j2', 'prod.txt')]),
+             Project('1a7')],
+            [self.template('ips.j2', 'all.txt')])
+        prod, staging = multi.connectors
+        assert prod.renderer is staging.renderer is multi.renderer
+        assert prod.api.session is staging.api.session is multi.session
+        assert staging.store.fields == set(['id', 'state', 'labels',
+                                            'primaryIpAddress'])
+
+        # Templates using the projects variable get every field
+        multi.templates.append(parse_template(
+            self.template('projects.j2', 'p.txt')))
+        assert staging._container_fields() is None
+
+    def test_renders_across_projects(self):
+        multi = self.connector()
+        with patch.object(multi.notifier, '_run') as run:
+            multi._prerender()
+
+        assert self.read('prod.txt') == '10.0.0.1'
+        assert self.read('all.txt') == '10.0.0.1 10.0.0.2'
+        assert self.read('projects.txt') == 'prod=1 1a7=1'
+        # The command shared by the templates only runs once
+        run.assert_called_once_with('reload')
+
+    def test_handles_events_of_every_project(self):
+        multi = self.connector()
+        with patch.object(multi.notifier, '_run'):
+            multi._prerender()
+        prod, staging = multi.connectors
+
+        multi.scheduler.start()
+        with patch.object(multi.notifier, '_run') as run:
+            staging._on_message(None, event(container('1i4', '10.0.0.4')))
+            multi.scheduler.stop()
+
+        assert self.read('prod.txt') == '10.0.0.1'
+        assert self.read('all.txt') == '10.0.0.1 10.0.0.2 10.0.0.4'
+        assert self.read('projects.txt') == 'prod=1 1a7=2'
+        run.assert_called_once_with('reload')
+
+        # Events that don't change any container render nothing
+        multi.scheduler.start()
+        with patch.object(multi.renderer, 'render_jobs') as render:
+            staging._on_message(None, event(container('1i4', '10.0.0.4')))
+            multi.scheduler.stop()
+        assert not render.called
+
+    def test_counts_events_of_every_project(self):
+        multi = self.connector()
+        multi.connectors[0].event_filter.count('received', 2)
+        multi.connectors[1].event_filter.count('received', 3)
+        assert multi.counters()['received'] == 5
+
+    def test_requires_unique_names(self):
+        with pytest.raises(ValueError):
+            MultiConnector('rancher', 8080, 'access', 'secret',
+                           [Project('1a5'), Project('1a7', name='1a5')])
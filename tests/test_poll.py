@@ -0,0 +1,106 @@
+import os
+import shutil
+import sys
+import tempfile
+from mock import Mock, patch
+from rancher_gen.handler import RESYNC
+from rancher_gen.poll import POLL, PollingConnector, diff_events
+from rancher_gen.store import ContainerStore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_rancher import Environment, FakeRancher  # noqa
+
+TEMPLATE = """\
+{% for container in containers %}{{ container.primaryIpAddress }}
+{% endfor %}"""
+
+
+def test_diff_events():
+    store = ContainerStore()
+    store.reset([{'id': '1i1', 'state': 'running'},
+                 {'id': '1i2', 'state': 'running'}])
+    events = diff_events(store, [{'id': '1i2', 'state': 'running'},
+                                 {'id': '1i3', 'state': 'running'}])
+    assert [event['data']['resource'] for event in events] == [
+        {'id': '1i2', 'state': 'running'},
+        {'id': '1i3', 'state': 'running'},
+        {'id': '1i1', 'state': 'removed'},
+    ]
+
+
+class TestPollingConnector:
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'in.j2')
+        self.dest = os.path.join(self.tmp_dir, 'out.txt')
+        with open(self.source, 'w') as fh:
+            fh.write(TEMPLATE)
+
+        self.environment = Environment(3)
+        self.server = FakeRancher(self.environment)
+        self.server.start()
+
+    def teardown_method(self, method):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        with open(self.dest) as fh:
+            return fh.read().split()
+
+    def connector(self):
+        return PollingConnector(
+            '127.0.0.1', self.server.port, self.environment.project_id,
+            'access', 'secret', ['{0}:{1}'.format(self.source, self.dest)],
+            page_size=2, resync_interval=0, interval=0.01)
+
+    def test_polls_changes(self):
+        handler = self.connector()
+        handler._prerender()
+        assert self.read() == ['10.42.0.1', '10.42.0.2', '10.42.0.3']
+
+        # Unchanged pages are not downloaded again, and nothing is rendered
+        with patch.object(handler.renderer, 'render_jobs') as render:
+            assert not handler._poll()
+        assert not render.called
+        assert self.server.requests['not_modified'] == 2
+
+        self.environment.event(0, 1)
+        del self.environment.containers[2]
+        assert handler._poll()
+        assert self.read() == ['10.42.0.1', '10.42.0.4']
+        handler.renderer.close()
+
+    def test_keeps_containers_when_rancher_fails(self):
+        handler = self.connector()
+        handler._prerender()
+
+        response = Mock(ok=False, status_code=401)
+        response.json.return_value = {'type': 'error', 'status': 401}
+        with patch.object(handler.api.session, 'get', return_value=response):
+            with patch.object(handler.notifier, '_run') as run:
+                assert not handler._poll()
+        assert not run.called
+        assert len(handler.store) == 3
+        assert self.read() == ['10.42.0.1', '10.42.0.2', '10.42.0.3']
+        handler.renderer.close()
+
+    def test_schedules_polls(self):
+        handler = self.connector()
+        handler._prerender()
+        with patch.object(handler, '_poll') as poll:
+            with patch.object(handler, '_resync') as resync:
+                handler._on_events([POLL, POLL])
+                assert poll.call_count == 1
+                handler._on_events([POLL, RESYNC])
+                assert poll.call_count == 1
+                assert resync.called
+
+        with patch.object(handler.scheduler, 'schedule') as schedule:
+            schedule.side_effect = lambda event: handler.stop()
+            handler._watch()
+        schedule.assert_called_once_with(POLL)
+        handler.renderer.close()
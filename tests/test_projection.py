@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+from jinja2 import Environment, FileSystemLoader
+from rancher_gen.projection import find_fields, project
+
+
+class TestFindFields:
+
+    def setup_method(self, method):
+        self.template_dir = tempfile.mkdtemp()
+        self.env = Environment(loader=FileSystemLoader(self.template_dir))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.template_dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.template_dir, name), 'w') as fh:
+            fh.write(content)
+
+    def test_finds_fields_used_in_loops(self):
+        self.write('t.j2', "{% for c in containers %}"
+                           "{{ c.primaryIpAddress }} {{ c['hostId'] }}"
+                           "{% endfor %}")
+        fields, files = find_fields(self.env, 't.j2')
+        assert fields == set(['id', 'state', 'labels', 'primaryIpAddress',
+                              'hostId'])
+        assert files == [os.path.join(self.template_dir, 't.j2')]
+
+    def test_finds_fields_used_by_filters(self):
+        self.write('t.j2', "{{ containers | length }}"
+                           "{% for c in containers | selectattr('name') | "
+                           "sort(attribute='created') %}"
+                           "{{ c.name }}{% endfor %}")
+        fields, files = find_fields(self.env, 't.j2')
+        assert fields == set(['id', 'state', 'labels', 'name', 'created'])
+
+    def test_finds_fields_used_with_indexes(self):
+        self.write('t.j2', "{% for service, cs in by_service.items() %}"
+                           "{% for c in cs %}{{ c.name }}{% endfor %}"
+                           "{% endfor %}"
+                           "{% for c in by_label['tier']['web'] %}"
+                           "{{ c.uuid }}{% endfor %}"
+                           "{% for c in healthy %}{{ c.hostId }}{% endfor %}"
+                           "{{ by_host | length }}")
+        fields, files = find_fields(self.env, 't.j2')
+        assert fields == set(['id', 'state', 'labels', 'name', 'uuid',
+                              'hostId', 'healthState'])
+
+    def test_templates_using_whole_index_lists_are_unsafe(self):
+        self.write('a.j2', "{{ by_service['web/nginx'] }}")
+        self.write('b.j2', "{% for pair in by_stack.items() %}"
+                           "{{ pair[1][0].name }}{% endfor %}")
+        self.write('c.j2', "{{ running | first }}")
+        for name in ('a.j2', 'b.j2', 'c.j2'):
+            fields, files = find_fields(self.env, name)
+            assert fields is None
+
+    def test_finds_fields_used_in_included_templates(self):
+        self.write('t.j2', "{% for c in containers %}"
+                           "{% include 'item.j2' %}{% endfor %}")
+        self.write('item.j2', "{{ c.uuid }}")
+        fields, files = find_fields(self.env, 't.j2')
+        assert fields == set(['id', 'state', 'labels', 'uuid'])
+        assert len(files) == 2
+
+    def test_templates_using_whole_containers_are_unsafe(self):
+        self.write('a.j2', "{{ containers | tojson }}")
+        self.write('b.j2', "{% for c in containers %}{{ c }}{% endfor %}")
+        self.write('c.j2', "{% for c in containers %}{{ c[key] }}"
+                           "{% endfor %}")
+        self.write('d.j2', "{% include name %}")
+        for name in ('a.j2', 'b.j2', 'c.j2', 'd.j2'):
+            fields, files = find_fields(self.env, name)
+            assert fields is None
+
+    def test_templates_calling_container_methods_are_unsafe(self):
+        self.write('a.j2', "{% for c in containers %}"
+                           "{{ c.get('primaryIpAddress') }}{% endfor %}")
+        self.write('b.j2', "{% for c in containers %}"
+                           "{% for k, v in c.items() %}{{ k }}={{ v }}"
+                           "{% endfor %}{% endfor %}")
+        self.write('c.j2', "{% for c in containers %}{{ c.keys }}"
+                           "{% endfor %}")
+        for name in ('a.j2', 'b.j2', 'c.j2'):
+            fields, files = find_fields(self.env, name)
+            assert fields is None
+
+    def test_templates_using_other_loop_items_are_unsafe(self):
+        self.write('t.j2', "{% for c in containers %}{{ c.id }}"
+                           "{% if loop.previtem %}{{ loop.previtem.name }}"
+                           "{% endif %}{% endfor %}")
+        fields, files = find_fields(self.env, 't.j2')
+        assert fields is None
+
+        # Other attributes of the loop are fine
+        self.write('t.j2', "{% for c in containers %}{{ c.name }}"
+                           "{% if not loop.last %},{% endif %}{% endfor %}")
+        fields, files = find_fields(self.env, 't.j2')
+        assert fields == set(['id', 'state', 'labels', 'name'])
+
+    def test_templates_using_projects_are_unsafe(self):
+        self.write('t.j2', "{% for c in projects['1a5'].containers %}"
+                           "{{ c.name }}{% endfor %}")
+        fields, files = find_fields(self.env, 't.j2')
+        assert fields is None
+
+    def test_missing_templates_are_unsafe(self):
+        fields, files = find_fields(self.env, 'missing.j2')
+        assert fields is None
+
+
+def test_project():
+    container = {'id': '1i1', 'name': 'web', 'links': {}}
+    assert project(container, set(['id', 'name'])) == {'id': '1i1',
+                                                      'name': 'web'}
+    assert project(container, None) is container
@@ -1,6 +1,19 @@
 import os
+import pytest
+import time
+from threading import Lock
+from mock import Mock, patch
+from requests.exceptions import ConnectionError, Timeout
 from rancher_gen.compat import b64encode
-from rancher_gen.rancher import API
+from rancher_gen.exception import RancherAPIError, RancherConnectionError
+from rancher_gen.metrics import API_ERRORS, API_LATENCY
+from rancher_gen.rancher import API, _endpoint, create_session
+
+
+def mock_response(data):
+    response = Mock()
+    response.json.return_value = data
+    return response
 
 
 class TestAPI:
@@ -74,3 +87,306 @@ class TestAPI:
         serv = api.get_service(None, stack['name'], 'hello1')
         instances = api.get_instances(serv)
         assert len(instances) == 1
+
+
+class TestAPISession:
+
+    def test_reuses_session(self):
+        api = API('rancher', 8080, '1a5', 'token', True, pool_size=4,
+                  timeout=7)
+        assert api.session.headers['Authorization'] == 'Basic token'
+        assert api.session.get_adapter('https://rancher')._pool_maxsize == 4
+
+        with patch.object(api.session, 'get') as get:
+            get.return_value = mock_response({'data': [{'id': '1i1'}]})
+            api.get_instances()
+            api.get_instances()
+
+        assert get.call_count == 2
+        get.assert_called_with('https://rancher:8080/v1/projects/1a5/instances',
+                               params={'limit': 100}, timeout=7)
+
+    def test_shares_session(self):
+        session = create_session('token', 4)
+        first = API('rancher', 8080, '1a5', 'token', False, session=session)
+        second = API('rancher', 8080, '1a7', 'token', False,
+                     session=session)
+        assert first.session is second.session
+        assert session.headers['Authorization'] == 'Basic token'
+
+        # Only the creator of the session closes it
+        with patch.object(session, 'close') as close:
+            first.close()
+        assert not close.called
+
+    def test_raises_connection_error(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+        for error in [ConnectionError('refused'), Timeout('timeout')]:
+            with patch.object(api.session, 'get', side_effect=error):
+                with pytest.raises(RancherConnectionError):
+                    api.get_instances()
+
+    def test_records_metrics(self):
+        endpoint = 'projects/{id}/instances'
+        requests = API_LATENCY.count(endpoint=endpoint)
+        errors = API_ERRORS.get(endpoint=endpoint)
+
+        api = API('rancher', 8080, '1a5', 'token', False)
+        with patch.object(api.session, 'get',
+                          side_effect=ConnectionError('refused')):
+            with pytest.raises(RancherConnectionError):
+                api.get_instances()
+        with patch.object(api.session, 'get') as get:
+            get.return_value = mock_response({'data': []})
+            api.get_instances()
+
+        assert API_LATENCY.count(endpoint=endpoint) == requests + 2
+        assert API_ERRORS.get(endpoint=endpoint) == errors + 1
+
+    def test_raises_api_errors(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+        for status_code in (401, 503):
+            response = mock_response({'type': 'error',
+                                      'status': status_code})
+            response.ok = False
+            response.status_code = status_code
+            with patch.object(api.session, 'get', return_value=response):
+                with pytest.raises(RancherAPIError):
+                    api.get_instances()
+
+        # Errors are never mistaken for empty collections
+        for data in ({'type': 'error'}, None, ValueError('not json')):
+            response = Mock()
+            response.json.side_effect = [data]
+            with patch.object(api.session, 'get', return_value=response):
+                with pytest.raises(RancherAPIError):
+                    api.get_instances()
+
+    def test_endpoint_names_skip_ids(self):
+        assert _endpoint('http://rancher/v1/projects/1a5/services/1s134/'
+                         'instances?limit=100') == \
+            'projects/{id}/services/{id}/instances'
+        assert _endpoint('http://rancher/v1/environments') == 'environments'
+
+
+class TestAPIPagination:
+
+    def test_follows_pagination_links(self):
+        api = API('rancher', 8080, '1a5', 'token', False, page_size=2)
+        next_url = 'http://rancher:8080/v1/projects/1a5/instances?marker=m2'
+        pages = [
+            mock_response({'data': [{'id': '1i1'}, {'id': '1i2'}],
+                           'pagination': {'next': next_url}}),
+            mock_response({'data': [{'id': '1i3'}],
+                           'pagination': {'next': None}}),
+        ]
+
+        with patch.object(api.session, 'get', side_effect=pages) as get:
+            instances = api.iter_instances()
+            assert next(instances)['id'] == '1i1'
+            # Pages are only requested when the generator gets to them
+            assert get.call_count == 1
+            assert [i['id'] for i in instances] == ['1i2', '1i3']
+
+        assert get.call_args_list[0][1]['params'] == {'limit': 2}
+        assert get.call_args_list[1][0][0] == next_url
+        assert get.call_args_list[1][1]['params'] is None
+
+    def test_filters_each_page_by_stack(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+        pages = [
+            # The stack can't be resolved, so fall back to the labels
+            mock_response({'data': []}),
+            mock_response({
+                'data': [
+                    {'id': '1i1', 'labels': {'io.rancher.stack.name': 'a'}},
+                    {'id': '1i2', 'labels': None}],
+                'pagination': {'next': 'http://rancher/next'}}),
+            mock_response({
+                'data': [
+                    {'id': '1i3', 'labels': {'io.rancher.stack.name': 'b'}},
+                    {'id': '1i4', 'labels': {'io.rancher.stack.name': 'a'}}],
+                'pagination': None}),
+        ]
+
+        with patch.object(api.session, 'get', side_effect=pages):
+            instances = api.get_instances(stack_name='a')
+        assert [i['id'] for i in instances] == ['1i1', '1i4']
+
+        with patch.object(api.session, 'get',
+                          return_value=mock_response({'data': []})):
+            assert api.get_instances() is None
+
+
+class TestAPIServerSideFiltering:
+
+    def test_loads_stack_instances_through_its_services(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+        responses = {
+            'http://rancher:8080/v1/projects/1a5/environments': {'data': [
+                {'name': 'a', 'links': {'services': 'http://rancher/s'}}]},
+            'http://rancher/s': {'data': [
+                {'name': 's1', 'links': {'instances': 'http://rancher/s1'}},
+                {'name': 's2', 'links': {'instances': 'http://rancher/s2'}}]},
+            'http://rancher/s1': {'data': [{'id': '1i1'}, {'id': '1i2'}]},
+            'http://rancher/s2': {'data': [{'id': '1i2'}, {'id': '1i3'}]},
+        }
+
+        def get(url, params=None, timeout=None):
+            return mock_response(responses[url])
+
+        with patch.object(api.session, 'get', side_effect=get) as mock:
+            instances = api.get_instances(stack_name='a')
+
+        assert [i['id'] for i in instances] == ['1i1', '1i2', '1i3']
+        assert mock.call_args_list[0][1]['params'] == {'name': 'a',
+                                                       'limit': 100}
+        called_urls = [c[0][0] for c in mock.call_args_list]
+        assert 'http://rancher:8080/v1/projects/1a5/instances' \
+            not in called_urls
+
+    def test_filters_stack_lookup_by_name(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+        responses = [
+            mock_response({'data': [
+                {'name': 'a', 'links': {'services': 'http://rancher/s'}}]}),
+            mock_response({'data': [{'name': 's2', 'id': '1s2'}]}),
+        ]
+
+        with patch.object(api.session, 'get', side_effect=responses) as mock:
+            service = api.get_service(stack='a', service='s2')
+
+        assert service['id'] == '1s2'
+        assert mock.call_args_list[0][1]['params'] == {'name': 'a',
+                                                       'limit': 100}
+
+
+class TestAPICache:
+
+    def setup_method(self, method):
+        self.responses = [
+            mock_response({'data': [
+                {'name': 'a', 'links': {'services': 'http://rancher/s'}}]}),
+            mock_response({'data': [{'name': 's1', 'id': '1s1'},
+                                    {'name': 's2', 'id': '1s2'},
+                                    {'name': 's3', 'id': '1s3'}]}),
+        ]
+
+    def test_resolves_services_with_two_requests(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+
+        with patch.object(api.session, 'get',
+                          side_effect=self.responses) as mock:
+            services = api.get_services('a', ['s1', 's3', 'missing'])
+            assert [s and s['id'] for s in services] == ['1s1', '1s3', None]
+            assert mock.call_count == 2
+
+            # Cached services don't need more requests
+            services = api.get_services('a', ['s2', 's1'])
+            assert [s['id'] for s in services] == ['1s2', '1s1']
+            assert mock.call_count == 2
+
+    def test_invalidates_cache(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+
+        with patch.object(api.session, 'get',
+                          side_effect=self.responses * 2) as mock:
+            api.get_services('a', ['s1'])
+            api.invalidate_cache()
+            api.get_services('a', ['s1'])
+        assert mock.call_count == 4
+
+    def test_expires_cache(self):
+        api = API('rancher', 8080, '1a5', 'token', False, cache_ttl=0)
+
+        with patch.object(api.session, 'get',
+                          side_effect=self.responses * 2) as mock:
+            assert api.get_services('a', ['s1'])[0]['id'] == '1s1'
+            assert api.get_services('a', ['s1'])[0]['id'] == '1s1'
+        assert mock.call_count == 4
+
+
+class TestAPIConditionalRequests:
+
+    def response(self, data, status_code=200, etag=None):
+        response = mock_response(data)
+        response.status_code = status_code
+        response.headers = {'ETag': etag} if etag else {}
+        return response
+
+    def test_reuses_pages_not_modified(self):
+        api = API('rancher', 8080, '1a5', 'token', False, conditional=True)
+        next_url = 'http://rancher:8080/v1/projects/1a5/instances?marker=m1'
+        pages = [
+            self.response({'data': [{'id': '1i1'}],
+                           'pagination': {'next': next_url}}, etag='"a"'),
+            self.response({'data': [{'id': '1i2'}]}, etag='"b"'),
+            self.response(None, 304),
+            self.response({'data': [{'id': '1i3'}]}, etag='"c"'),
+        ]
+
+        with patch.object(api.session, 'get', side_effect=pages) as get:
+            assert [i['id'] for i in api.iter_instances()] == ['1i1', '1i2']
+            assert 'headers' not in get.call_args_list[0][1]
+            assert api.pages_downloaded == 2
+
+            # Only the second page changed
+            assert [i['id'] for i in api.iter_instances()] == ['1i1', '1i3']
+            assert get.call_args_list[2][1]['headers'] == \
+                {'If-None-Match': '"a"'}
+            assert get.call_args_list[3][1]['headers'] == \
+                {'If-None-Match': '"b"'}
+            assert api.pages_downloaded == 3
+
+    def test_forgets_unused_pages(self):
+        api = API('rancher', 8080, '1a5', 'token', False, conditional=True)
+        with patch.object(api.session, 'get', return_value=self.response(
+                {'data': [{'id': '1i1'}]}, etag='"a"')):
+            api.get_instances()
+            api.forget_unused_pages()
+            assert len(api._pages) == 1
+
+            api.forget_unused_pages()
+            assert api._pages == {}
+
+
+class TestAPIConcurrentInstances:
+
+    def test_loads_services_concurrently_in_order(self):
+        api = API('rancher', 8080, '1a5', 'token', False, pool_size=3)
+        services = [{'links': {'instances': 'http://rancher/s%d' % i}}
+                    for i in range(3)]
+        delays = {'http://rancher/s0': 0.3, 'http://rancher/s1': 0.1,
+                  'http://rancher/s2': 0}
+        data = {
+            'http://rancher/s0': [{'id': '1i1'}, {'id': '1i2'}],
+            'http://rancher/s1': [{'id': '1i3'}],
+            'http://rancher/s2': [{'id': '1i2'}, {'id': '1i4'}],
+        }
+        lock = Lock()
+        state = {'running': 0, 'max': 0}
+
+        def get(url, params=None, timeout=None):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(delays[url])
+            with lock:
+                state['running'] -= 1
+            return mock_response({'data': data[url]})
+
+        with patch.object(api.session, 'get', side_effect=get):
+            instances = list(api.iter_services_instances(services + [None]))
+
+        assert [i['id'] for i in instances] == ['1i1', '1i2', '1i3', '1i4']
+        assert state['max'] > 1
+
+    def test_raises_worker_errors(self):
+        api = API('rancher', 8080, '1a5', 'token', False)
+        services = [{'links': {'instances': 'http://rancher/s%d' % i}}
+                    for i in range(2)]
+
+        with patch.object(api.session, 'get',
+                          side_effect=ConnectionError('refused')):
+            with pytest.raises(RancherConnectionError):
+                list(api.iter_services_instances(services))
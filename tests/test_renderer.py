@@ -0,0 +1,220 @@
+import errno
+import os
+import pytest
+import shutil
+import tempfile
+from mock import patch
+from rancher_gen.renderer import TemplateRenderer, parse_template
+
+
+def test_parse_template():
+    assert parse_template('/a.j2:/a.txt') == ('/a.j2', '/a.txt', None)
+    assert parse_template('/a.j2:/a.txt:') == ('/a.j2', '/a.txt', None)
+    assert parse_template('/a.j2:/a.txt:echo a:b') == \
+        ('/a.j2', '/a.txt', 'echo a:b')
+    with pytest.raises(ValueError):
+        parse_template('/a.j2')
+
+    # Templates are only parsed once
+    template = parse_template('/a.j2:/a.txt:reload')
+    assert template.dest == '/a.txt'
+    assert parse_template(template) is template
+
+
+class TestTemplateRenderer:
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'template.j2')
+        self.dest = os.path.join(self.tmp_dir, 'out.txt')
+        self.templates = ['{0}:{1}'.format(self.source, self.dest)]
+        self.write_template('{% for c in containers %}{{c.id}};{% endfor %}')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_template(self, content, mtime=None):
+        with open(self.source, 'w') as fh:
+            fh.write(content)
+        if mtime is not None:
+            os.utime(self.source, (mtime, mtime))
+
+    def read_output(self):
+        with open(self.dest) as fh:
+            return fh.read()
+
+    def test_renders_templates(self):
+        renderer = TemplateRenderer()
+        renderer.render([{'id': '1i1'}, {'id': '1i2'}], self.templates)
+        assert self.read_output() == '1i1;1i2;'
+
+    def test_renders_templates_with_indexes(self):
+        self.write_template(
+            "{% for service, containers in by_service | dictsort %}"
+            "{{ service }}={{ containers | map(attribute='id') | join(',') }};"
+            "{% endfor %}{{ running | length }}")
+        renderer = TemplateRenderer()
+        labels = {'io.rancher.stack_service.name': 'web/nginx'}
+        renderer.render([{'id': '1i1', 'state': 'running', 'labels': labels},
+                         {'id': '1i2', 'labels': labels},
+                         {'id': '1i3'}], self.templates)
+        assert self.read_output() == 'web/nginx=1i1,1i2;1'
+
+    def test_reuses_compiled_templates(self):
+        renderer = TemplateRenderer()
+        template = renderer.get_template(self.source)
+        assert renderer.get_template(self.source) is template
+
+        with patch('jinja2.environment.Environment.compile') as compile:
+            renderer.render([{'id': '1i1'}], self.templates)
+        assert not compile.called
+
+    def test_reloads_modified_templates(self):
+        renderer = TemplateRenderer()
+        renderer.render([{'id': '1i1'}], self.templates)
+        assert self.read_output() == '1i1;'
+
+        stat = os.stat(self.source)
+        self.write_template('{{containers|length}}', stat.st_mtime + 10)
+        renderer.render([{'id': '1i1'}], self.templates)
+        assert self.read_output() == '1'
+
+    def test_uses_bytecode_cache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        TemplateRenderer(cache_dir).render([], self.templates)
+        assert len(os.listdir(cache_dir)) == 1
+
+        # A new renderer loads the template from the bytecode cache
+        with patch('jinja2.environment.Environment.compile') as compile:
+            TemplateRenderer(cache_dir).render([{'id': '1i1'}],
+                                               self.templates)
+        assert not compile.called
+        assert self.read_output() == '1i1;'
+
+    def test_only_writes_changed_output(self):
+        renderer = TemplateRenderer()
+        assert renderer.render([{'id': '1i1'}], self.templates) == [self.dest]
+        mtime = os.stat(self.dest).st_mtime
+        os.utime(self.dest, (mtime - 10, mtime - 10))
+
+        assert renderer.render([{'id': '1i1'}], self.templates) == []
+        assert os.stat(self.dest).st_mtime == mtime - 10
+
+        assert renderer.render([{'id': '1i2'}], self.templates) == [self.dest]
+        assert self.read_output() == '1i2;'
+
+        # Deleted files are generated again
+        os.remove(self.dest)
+        assert renderer.render([{'id': '1i2'}], self.templates) == [self.dest]
+
+    def test_seeds_digests_from_existing_files(self):
+        with open(self.dest, 'w') as fh:
+            fh.write('1i1;')
+
+        renderer = TemplateRenderer()
+        assert renderer.render([{'id': '1i1'}], self.templates) == []
+        assert renderer.render([], self.templates) == [self.dest]
+
+    def test_streams_output(self):
+        renderer = TemplateRenderer(stream=True)
+        assert renderer.render([{'id': '1i1'}], self.templates) == [self.dest]
+        assert self.read_output() == '1i1;'
+
+        # Unchanged output doesn't replace the file or leave temp files
+        assert renderer.render([{'id': '1i1'}], self.templates) == []
+        assert sorted(os.listdir(self.tmp_dir)) == ['out.txt', 'template.j2']
+
+        assert renderer.render([{'id': '1i2'}], self.templates) == [self.dest]
+        assert self.read_output() == '1i2;'
+
+    def test_replaces_files_atomically(self):
+        with open(self.dest, 'w') as fh:
+            fh.write('old')
+        os.chmod(self.dest, 0o600)
+        inode = os.stat(self.dest).st_ino
+
+        renderer = TemplateRenderer()
+        renderer.render([{'id': '1i1'}], self.templates)
+        assert os.stat(self.dest).st_ino != inode
+        assert os.stat(self.dest).st_mode & 0o777 == 0o600
+        assert sorted(os.listdir(self.tmp_dir)) == ['out.txt', 'template.j2']
+
+    def test_writes_in_place_without_access_to_the_directory(self):
+        with open(self.dest, 'w') as fh:
+            fh.write('old')
+        inode = os.stat(self.dest).st_ino
+        mkstemp = tempfile.mkstemp
+        created = []
+
+        def temp_file(prefix, dir=None):
+            if dir is not None:
+                raise OSError(errno.EACCES, 'Permission denied', dir)
+            fd, path = mkstemp(prefix=prefix)
+            created.append(path)
+            return fd, path
+
+        denied = OSError(errno.EACCES, 'Permission denied')
+        with patch('rancher_gen.renderer.tempfile.mkstemp', temp_file), \
+                patch('rancher_gen.renderer.replace', side_effect=denied):
+            for stream in (False, True):
+                renderer = TemplateRenderer(stream=stream)
+                renderer.render([{'id': str(stream)}], self.templates)
+                assert self.read_output() == '{0};'.format(stream)
+
+        assert os.stat(self.dest).st_ino == inode
+        assert sorted(os.listdir(self.tmp_dir)) == ['out.txt', 'template.j2']
+        assert len(created) == 2
+        assert not any(os.path.exists(path) for path in created)
+
+    def test_keeps_old_file_when_rendering_fails(self):
+        self.write_template('{% for c in containers %}{{c.id}}{{ 1/0 }}'
+                            '{% endfor %}')
+        with open(self.dest, 'w') as fh:
+            fh.write('old')
+
+        renderer = TemplateRenderer(stream=True)
+        with pytest.raises(ZeroDivisionError):
+            renderer.render([{'id': '1i1'}], self.templates)
+        assert self.read_output() == 'old'
+        assert sorted(os.listdir(self.tmp_dir)) == ['out.txt', 'template.j2']
+
+    def test_renders_templates_in_worker_processes(self):
+        templates = []
+        for i in range(3):
+            source = os.path.join(self.tmp_dir, 'template{0}.j2'.format(i))
+            with open(source, 'w') as fh:
+                fh.write('{0}:{{{{containers|length}}}}'.format(i))
+            templates.append('{0}:{1}'.format(
+                source, os.path.join(self.tmp_dir, 'out{0}.txt'.format(i))))
+
+        renderer = TemplateRenderer(processes=2)
+        try:
+            changed = renderer.render([{'id': '1i1'}], templates)
+            assert changed == [t.split(':')[1] for t in templates]
+            for i, template in enumerate(templates):
+                with open(template.split(':')[1]) as fh:
+                    assert fh.read() == '{0}:1'.format(i)
+
+            assert renderer.render([{'id': '1i1'}], templates) == []
+            assert renderer.render([], templates[1:]) == \
+                [t.split(':')[1] for t in templates[1:]]
+        finally:
+            renderer.close()
+        assert not [f for f in os.listdir(self.tmp_dir) if f.startswith('.')]
+
+    def test_reports_worker_errors(self):
+        bad = os.path.join(self.tmp_dir, 'bad.j2')
+        with open(bad, 'w') as fh:
+            fh.write('{{ 1/0 }}')
+        templates = ['{0}:{1}'.format(bad, self.dest + '.bad')] + \
+            self.templates
+
+        renderer = TemplateRenderer(processes=2)
+        try:
+            with pytest.raises(ZeroDivisionError):
+                renderer.render([{'id': '1i1'}], templates)
+        finally:
+            renderer.close()
+
+        # The other templates are still generated
+        assert self.read_output() == '1i1;'
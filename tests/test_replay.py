@@ -0,0 +1,97 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from rancher_gen.replay import Recorder, StubAPI, paced, read_log
+
+
+class TestRecorder:
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_records_and_reads_frames(self):
+        for name in ('events.log', 'events.log.gz'):
+            path = os.path.join(self.tmp_dir, name)
+            recorder = Recorder(path)
+            recorder.record('{"name":"ping"}', 10.0)
+            recorder.record(b'{"name":"resource.change"}\n', 10.5)
+            recorder.close()
+
+            # Recording again appends to the log
+            recorder = Recorder(path)
+            recorder.record('{}', 11.0)
+            recorder.close()
+
+            assert list(read_log(path)) == [
+                (10.0, '{"name":"ping"}'),
+                (10.5, '{"name":"resource.change"}\n'),
+                (11.0, '{}')]
+
+        with gzip.open(path, 'rb') as fh:
+            assert json.loads(fh.readline().decode('utf-8')) == \
+                [10.0, '{"name":"ping"}']
+
+    def test_skips_incomplete_lines(self):
+        path = os.path.join(self.tmp_dir, 'events.log')
+        with open(path, 'w') as fh:
+            fh.write('[1.0,"{}"]\n[2.0,"{')
+        assert list(read_log(path)) == [(1.0, '{}')]
+
+    def test_reads_truncated_gzip_logs(self):
+        path = os.path.join(self.tmp_dir, 'events.log.gz')
+        recorder = Recorder(path)
+        recorder.record('{"name":"ping"}', 1.0)
+        recorder.close()
+        size = os.path.getsize(path)
+
+        # The app was killed while writing the second part of the log
+        recorder = Recorder(path)
+        for i in range(100):
+            recorder.record(json.dumps({'id': i}), 2.0 + i)
+        recorder.close()
+        entries = list(read_log(path))
+        with open(path, 'rb') as fh:
+            content = fh.read()
+
+        for end in range(size + 1, len(content), 7):
+            with open(path, 'wb') as fh:
+                fh.write(content[:end])
+            truncated = list(read_log(path))
+            assert truncated[0] == (1.0, '{"name":"ping"}')
+            assert truncated == entries[:len(truncated)]
+
+
+def test_paced():
+    delays = []
+    entries = [(100.0, 'a'), (100.0, 'b'), (102.0, 'c')]
+    assert list(paced(entries, 2, delays.append)) == ['a', 'b', 'c']
+    assert len(delays) == 1
+    assert 0.9 < delays[0] <= 1
+
+    delays = []
+    assert list(paced(entries, 0, delays.append)) == ['a', 'b', 'c']
+    assert delays == []
+
+
+def test_stub_api():
+    def instance(container_id, stack, service):
+        return {'id': container_id, 'labels': {
+            'io.rancher.stack.name': stack,
+            'io.rancher.stack_service.name': '{0}/{1}'.format(stack,
+                                                              service)}}
+
+    api = StubAPI([instance('1i1', 'web', 'nginx'),
+                   instance('1i2', 'web', 'api'),
+                   instance('1i3', 'db', 'mysql')])
+    assert len(api.iter_instances()) == 3
+    assert [i['id'] for i in api.iter_instances(stack_name='web')] == \
+        ['1i1', '1i2']
+    services = api.get_services('web', ['api', 'missing'])
+    assert [i['id'] for i in api.iter_services_instances(services)] == \
+        ['1i2']
+    assert api.calls == 4
@@ -0,0 +1,116 @@
+import time
+from mock import patch
+from threading import Event, Thread
+from rancher_gen.scheduler import Backoff, EventScheduler, Notifier
+
+
+class TestEventScheduler:
+
+    def test_coalesces_burst_of_events(self):
+        batches = []
+        done = Event()
+
+        def callback(events):
+            batches.append(events)
+            done.set()
+
+        scheduler = EventScheduler(callback, debounce=0.2, max_wait=5)
+        scheduler.start()
+        for i in range(50):
+            scheduler.schedule(i)
+        assert done.wait(5)
+        scheduler.stop(5)
+
+        assert len(batches) == 1
+        assert batches[0] == list(range(50))
+
+    def test_max_wait_bounds_delay(self):
+        batches = []
+        scheduler = EventScheduler(batches.append, debounce=0.2, max_wait=0.3)
+        scheduler.start()
+
+        # Keep events coming faster than the debounce window
+        start = time.time()
+        while time.time() - start < 1:
+            scheduler.schedule()
+            time.sleep(0.05)
+        scheduler.stop(5)
+
+        assert len(batches) >= 2
+
+    def test_stop_flushes_pending_events(self):
+        batches = []
+        scheduler = EventScheduler(batches.append, debounce=10, max_wait=10)
+        scheduler.start()
+        scheduler.schedule('a')
+        scheduler.stop(5)
+
+        assert batches == [['a']]
+
+    def test_callback_errors_do_not_stop_worker(self):
+        batches = []
+        done = Event()
+
+        def callback(events):
+            batches.append(events)
+            if len(batches) == 1:
+                raise ValueError('boom')
+            done.set()
+
+        scheduler = EventScheduler(callback, debounce=0, max_wait=0)
+        scheduler.start()
+        scheduler.schedule('a')
+        time.sleep(0.2)
+        scheduler.schedule('b')
+        assert done.wait(5)
+        scheduler.stop(5)
+
+        assert batches == [['a'], ['b']]
+
+
+class TestNotifier:
+
+    def test_deduplicates_commands(self):
+        notifier = Notifier()
+        with patch('rancher_gen.scheduler.call') as call:
+            notifier.notify(['a', None, 'b', 'a'])
+        assert [c[0][0] for c in call.call_args_list] == ['a', 'b']
+
+    def test_collapses_requests_while_running(self):
+        notifier = Notifier()
+        started = Event()
+        release = Event()
+        calls = []
+
+        def call(command, shell):
+            calls.append(command)
+            if len(calls) == 1:
+                started.set()
+                release.wait(5)
+
+        with patch('rancher_gen.scheduler.call', side_effect=call):
+            thread = Thread(target=notifier.notify, args=(['a'],))
+            thread.start()
+            assert started.wait(5)
+
+            # These requests return immediately and collapse into one run
+            for i in range(5):
+                notifier.notify(['a'])
+            assert calls == ['a']
+
+            release.set()
+            thread.join(5)
+
+        assert calls == ['a', 'a']
+
+
+class TestBackoff:
+
+    def test_grows_exponentially_with_jitter(self):
+        backoff = Backoff(1, 10)
+        delays = [backoff.next() for i in range(6)]
+        for delay, limit in zip(delays, [1, 2, 4, 8, 10, 10]):
+            assert limit / 2.0 <= delay <= limit
+
+        backoff.reset()
+        assert backoff.next() <= 1
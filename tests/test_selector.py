@@ -0,0 +1,64 @@
+import pytest
+from rancher_gen.selector import Fingerprints, Selector
+
+
+def container(container_id, stack='web', service='nginx', **labels):
+    labels.update({
+        'io.rancher.stack.name': stack,
+        'io.rancher.stack_service.name': '{0}/{1}'.format(stack, service)
+    })
+    return {'id': container_id, 'labels': labels}
+
+
+class TestSelector:
+
+    def test_parses_selectors(self):
+        selector = Selector.parse('stack=web, service=nginx,service=api,'
+                                  'label.io.example.tier=frontend')
+        assert selector.stack == 'web'
+        assert selector.services == ['nginx', 'api']
+        assert selector.labels == {'io.example.tier': 'frontend'}
+
+        with pytest.raises(ValueError):
+            Selector.parse('stack')
+        with pytest.raises(ValueError):
+            Selector.parse('host=1h1')
+
+    def test_matches_containers(self):
+        selector = Selector.parse('stack=web,service=nginx,label.tier=front')
+        assert selector.matches(container('1i1', tier='front'))
+        assert not selector.matches(container('1i1', tier='back'))
+        assert not selector.matches(container('1i1', service='api',
+                                              tier='front'))
+        assert not selector.matches(container('1i1', stack='db',
+                                              tier='front'))
+        assert not selector.matches({'id': '1i1', 'labels': None})
+        assert Selector().matches({'id': '1i1', 'labels': None})
+
+
+class TestFingerprints:
+
+    def test_tracks_changes_per_template(self):
+        selectors = {
+            'nginx': Selector(services=['nginx']),
+            'api': Selector(services=['api']),
+            'all': None
+        }
+        fingerprints = Fingerprints()
+        containers = [container('1i1'), container('1i2', service='api')]
+
+        # Every template is new
+        assert fingerprints.reset(selectors, containers) == \
+            set(['nginx', 'api', 'all'])
+        assert fingerprints.reset(selectors, containers) == set()
+
+        updated = container('1i1', tier='front')
+        assert fingerprints.update(selectors, '1i1', updated) == \
+            set(['nginx', 'all'])
+        assert fingerprints.update(selectors, '1i1', updated) == set()
+
+        assert fingerprints.update(selectors, '1i2', None) == \
+            set(['api', 'all'])
+        assert fingerprints.update(selectors, '1i3', None) == set()
+
+        assert fingerprints.reset(selectors, [updated]) == set()
@@ -0,0 +1,118 @@
+import gzip
+import os
+import shutil
+import tempfile
+from rancher_gen.store import ContainerStore
+
+
+def container(container_id, state='running', **kwargs):
+    resource = {'id': container_id, 'type': 'container', 'state': state}
+    resource.update(kwargs)
+    return resource
+
+
+class TestContainerStore:
+
+    def test_reset_skips_inactive_containers(self):
+        store = ContainerStore()
+        assert not store.seeded
+
+        store.reset([container('1i1'), container('1i2', 'stopped'),
+                     container('1i3', 'removed'), container('1i4')])
+        assert store.seeded
+        assert [c['id'] for c in store.instances()] == ['1i1', '1i4']
+
+        store.reset(None)
+        assert store.seeded
+        assert store.instances() == []
+
+    def test_apply_upserts_running_containers(self):
+        store = ContainerStore()
+        store.reset([container('1i1', primaryIpAddress='10.0.0.1')])
+
+        assert store.apply(container('1i2'))
+        assert '1i2' in store
+
+        # Updating an existing container keeps its position
+        assert store.apply(container('1i1', primaryIpAddress='10.0.0.2'))
+        instances = store.instances()
+        assert [c['id'] for c in instances] == ['1i1', '1i2']
+        assert instances[0]['primaryIpAddress'] == '10.0.0.2'
+
+        assert store.index.instances() == instances
+
+        # Applying the same resource twice is not a change
+        assert not store.apply(container('1i1', primaryIpAddress='10.0.0.2'))
+
+    def test_apply_deletes_stopped_and_removed_containers(self):
+        store = ContainerStore()
+        store.reset([container('1i1'), container('1i2')])
+
+        assert store.apply(container('1i1', 'stopped'))
+        assert store.apply(container('1i2', 'removed'))
+        assert len(store) == 0
+        assert store.index.instances() == []
+
+        # Unknown containers are ignored
+        assert not store.apply(container('1i3', 'removed'))
+
+    def test_apply_ignores_transitioning_states(self):
+        store = ContainerStore()
+        store.reset([])
+        assert not store.apply(container('1i1', 'starting'))
+        assert not store.apply({'state': 'running'})
+        assert len(store) == 0
+
+    def test_keeps_only_specified_fields(self):
+        store = ContainerStore(set(['id', 'state', 'name']))
+        store.reset([container('1i1', name='web', links={})])
+        assert store.instances() == [{'id': '1i1', 'state': 'running',
+                                      'name': 'web'}]
+
+        # Changes to fields that are dropped are not changes
+        assert not store.apply(container('1i1', name='web', links={'a': 1}))
+        assert store.apply(container('1i1', name='api'))
+
+
+class TestContainerStoreSnapshot:
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'snapshot.gz')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_saves_and_loads_snapshot(self):
+        store = ContainerStore()
+        store.reset([container('1i1', primaryIpAddress='10.0.0.1'),
+                     container('1i2')])
+        store.save(self.path, ['1a5', 'web', None])
+        assert os.listdir(self.tmp_dir) == ['snapshot.gz']
+
+        loaded = ContainerStore()
+        assert loaded.load(self.path, ['1a5', 'web', None])
+        assert loaded.seeded
+        assert loaded.instances() == store.instances()
+
+    def test_ignores_snapshots_with_other_settings(self):
+        store = ContainerStore()
+        store.reset([container('1i1')])
+        store.save(self.path, ['1a5', 'web', None])
+
+        loaded = ContainerStore()
+        assert not loaded.load(self.path, ['1a5', 'other', None])
+        assert not loaded.seeded
+
+    def test_ignores_missing_and_corrupt_snapshots(self):
+        store = ContainerStore()
+        assert not store.load(self.path)
+
+        with open(self.path, 'wb') as fh:
+            fh.write(b'garbage')
+        assert not store.load(self.path)
+
+        with gzip.open(self.path, 'wb') as fh:
+            fh.write(b'{not json')
+        assert not store.load(self.path)
+        assert not store.seeded